@@ -0,0 +1,255 @@
+import asyncio
+from ampConfig import amplifierConfig, replyFramer
+from ampConfig import sourceCommand, formatToneValue, formatBalanceValue
+
+# asyncio version of the amplifierConfig protocol methods, for programs that
+# control one or more amps from an event loop (home automation etc.) instead of
+# from the GUI. It is driven by the same JSON config files - the amplifierConfig
+# is only used for its config data and its command/query translation, the
+# connection itself is an asyncio stream owned by this class.
+#
+# The return values follow amplifierConfig's convention: a tuple of a true/false
+# return code and the value/reply dict or an error string. Every operation takes
+# an optional 'deadline' (seconds) that bounds the whole call. The replies a
+# cancelled call was still waiting for are thrown away as they turn up, before
+# the next exchange sends anything (for up to the config's timeout, like any
+# other late reply), so they aren't taken for the next call's replies.
+#
+# Example, querying two amps at the same time:
+#   amps = [asyncAmplifierClient('configs/zone1.json'), asyncAmplifierClient('configs/zone2.json')]
+#   await asyncio.gather(*[a.connect() for a in amps])
+#   results = await asyncio.gather(*[a.querySourceInfo(deadline=1) for a in amps])
+
+class asyncAmplifierClient:
+
+    # Constructor, takes an amplifierConfig or the name of a config file
+    def __init__(self, config):
+        if isinstance(config, str):
+            config = amplifierConfig(config)
+        self.ampConfig = config
+        self.reader = None
+        self.writer = None
+        self.readerTask = None
+        self.connected = False
+        self.framer = replyFramer()
+        # complete replies from the reader task, None means the connection closed
+        self.replies = asyncio.Queue()
+        # only one exchange at a time per connection, replies aren't tagged
+        self.lock = asyncio.Lock()
+        # what a cancelled exchange was still waiting for, see skipStale
+        self.stale = None
+
+    # try to connect to the amplifier's IP address/port
+    async def connect(self, deadline=5):
+        if not self.ampConfig.configValid:
+            return (False, "Invalid configuration")
+        configData = self.ampConfig.configData
+        if configData['address'] == "":
+            return (False, "Missing IP address")
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(configData['address'], configData['port']), deadline)
+        except asyncio.TimeoutError:
+            return (False, "Timeout error")
+        except ConnectionRefusedError:
+            return (False, "Connection refused")
+        except OSError as e:
+            return (False, str(e))
+        self.framer.reset()
+        self.replies = asyncio.Queue()
+        self.stale = None
+        self.connected = True
+        self.readerTask = asyncio.create_task(self.readLoop())
+        return (True, "Success")
+
+    # Access method to query connection state
+    def isConnected(self):
+        return self.connected
+
+    # Close the current connection
+    async def close(self):
+        if self.readerTask != None:
+            self.readerTask.cancel()
+            self.readerTask = None
+        if self.writer != None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = None
+        self.writer = None
+        self.connected = False
+
+    # Background task: parse everything the amp sends into the reply queue
+    async def readLoop(self):
+        try:
+            while True:
+                data = await self.reader.read(1024)
+                if len(data) == 0:
+                    break
+                for reply in self.framer.feed(data):
+                    self.replies.put_nowait(reply)
+        except OSError:
+            pass
+        self.connected = False
+        self.replies.put_nowait(None)
+
+    # Send a protocol string and collect the replies, same rules as
+    # amplifierConfig.readReplies - stop once every expected term is in, or
+    # after the first reply if doLoop is False, with the config's timeout as
+    # the fallback for when the amp has gone quiet.
+    async def exchange(self, payload, expectTerms=None, doLoop=True):
+        async with self.lock:
+            if not await self.skipStale():
+                return None
+            # anything else still queued is an unsolicited update
+            while not self.replies.empty():
+                if self.replies.get_nowait() == None:
+                    return None
+            replies = []
+            pending = None
+            if expectTerms != None:
+                pending = set(expectTerms)
+            idleTimeout = self.ampConfig.configData['timeout']
+            self.writer.write(payload.encode('utf-8'))
+            try:
+                await self.writer.drain()
+                while True:
+                    if pending != None and len(pending) == 0:
+                        break
+                    if pending == None and doLoop == False and len(replies) > 0:
+                        break
+                    try:
+                        reply = await asyncio.wait_for(self.replies.get(), idleTimeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if reply == None:
+                        # connection closed, leave the marker for the next caller
+                        self.replies.put_nowait(None)
+                        break
+                    replies.append(reply)
+                    if pending != None:
+                        pending.discard(reply[0])
+            except asyncio.CancelledError:
+                # the deadline ran out - the replies we were waiting for (any
+                # replies at all, if we didn't know what to expect) are late now
+                self.stale = (pending, asyncio.get_running_loop().time() + idleTimeout)
+                raise
+            return replies
+
+    # Throw away the late replies of a cancelled exchange, until they're all
+    # in or the amp has been given the config's timeout to send them. Returns
+    # false if the connection closed meanwhile.
+    async def skipStale(self):
+        loop = asyncio.get_running_loop()
+        while self.stale != None:
+            pending, until = self.stale
+            wait = until - loop.time()
+            if (pending != None and len(pending) == 0) or wait <= 0:
+                break
+            try:
+                reply = await asyncio.wait_for(self.replies.get(), wait)
+            except asyncio.TimeoutError:
+                break
+            if reply == None:
+                self.replies.put_nowait(None)
+                return False
+            if pending != None:
+                pending.discard(reply[0])
+        self.stale = None
+        return True
+
+    # Run an exchange with an optional deadline on the whole thing
+    async def timedExchange(self, payload, expectTerms, doLoop, deadline):
+        if not self.connected:
+            return None
+        try:
+            return await asyncio.wait_for(self.exchange(payload, expectTerms, doLoop), deadline)
+        except asyncio.TimeoutError:
+            return None
+
+    # Async equivalent of amplifierConfig.doCommand
+    async def doCommand(self, commandString, optArg=None, argLength=None, doLoop=True, expect=None, deadline=None):
+        if not self.ampConfig.configValid:
+            return (False, "Invalid config")
+        if not self.connected:
+            return (False, "Not connected")
+        (ret, cmdString) = self.ampConfig.buildCommand(commandString, optArg, argLength)
+        if not ret:
+            return (False, cmdString)
+
+        replies = await self.timedExchange(cmdString, self.ampConfig.expectTerms(expect), doLoop, deadline)
+        if replies == None:
+            return (False, "Deadline exceeded or connection lost")
+        respdict = dict()
+        for name, value in replies:
+            respdict[name] = value
+        return (True, respdict)
+
+    # Async equivalent of amplifierConfig.doQuery
+    async def doQuery(self, queries, deadline=None):
+        if not self.ampConfig.configValid:
+            return (False, "Invalid config")
+        if not self.connected:
+            return (False, "Not connected")
+        (ret, queryStr) = self.ampConfig.buildQuery(queries)
+        if not ret:
+            return (False, queryStr)
+
+        replies = await self.timedExchange(queryStr, self.ampConfig.expectTerms(queries), True, deadline)
+        if replies == None:
+            return (False, "Deadline exceeded or connection lost")
+        return (True, self.ampConfig.mapQueryReplies(replies))
+
+    ## Query wrappers, same as amplifierConfig's
+
+    async def queryPower(self, deadline=None):
+        return await self.doQuery(["power"], deadline)
+
+    async def querySource(self, deadline=None):
+        return await self.doQuery(["source"], deadline)
+
+    async def queryVolume(self, deadline=None):
+        return await self.doQuery(["volume"], deadline)
+
+    async def querySourceInfo(self, deadline=None):
+        return await self.doQuery(['source', 'volume', 'bass', 'treble', 'mute',
+                                   'balance', 'bypass'], deadline)
+
+    ## Command wrappers, same as amplifierConfig's
+
+    async def setVolume(self, volValue, deadline=None):
+        return await self.doCommand('volume_set', volValue, 2, doLoop=False, expect=['volume'], deadline=deadline)
+
+    async def setSource(self, sourceId, deadline=None):
+        if not self.connected:
+            return (False, "Not connected")
+        sourceTerm = self.ampConfig.queryTerm('source')
+        replies = await self.timedExchange(sourceCommand(sourceId), [sourceTerm], True, deadline)
+        if replies != None:
+            for name, value in replies:
+                if name == sourceTerm:
+                    return (True, value)
+        return (False, 'Timeout during query')
+
+    async def powerToggle(self, deadline=None):
+        return await self.doCommand('power_toggle', expect=['power'], deadline=deadline)
+
+    async def muteToggle(self, deadline=None):
+        return await self.doCommand('mute_toggle', expect=['mute'], deadline=deadline)
+
+    async def setBypass(self, bypassVal, deadline=None):
+        if bypassVal == False:
+            return await self.doCommand('bypass_off', expect=['bypass'], deadline=deadline)
+        else:
+            return await self.doCommand('bypass_on', expect=['bypass'], deadline=deadline)
+
+    async def setBass(self, bassValue, deadline=None):
+        return await self.doCommand('bass_set', formatToneValue(bassValue), doLoop=False, expect=['bass'], deadline=deadline)
+
+    async def setTreble(self, trebValue, deadline=None):
+        return await self.doCommand('treble_set', formatToneValue(trebValue), doLoop=False, expect=['treble'], deadline=deadline)
+
+    async def setBalance(self, balValue, deadline=None):
+        return await self.doCommand('balance_set', formatBalanceValue(balValue), doLoop=False, expect=['balance'], deadline=deadline)
@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from ampConfig import amplifierConfig
+from ampSimulator import ampSimulator
+
+# Latency/throughput benchmark for the protocol layer. Each run starts an
+# ampSimulator on the loopback interface, points a copy of an amp config at it
+# and times the usual amplifierConfig operations:
+#   query1      - doQuery() with a single key
+#   query7      - querySourceInfo() (7 keys in one request)
+#   volume      - setVolume() sweeping up and down the range
+#   source      - setSource() alternating between analog and digital inputs
+#   power       - powerToggle() off and back on
+#
+# For each one it reports p50/p95/p99 latency, operations per second and bytes
+# on the wire (as counted by the simulator), and the whole report can be saved
+# as JSON so runs from different revisions can be compared:
+#   python3 ampBench.py --iterations 200 --latency 0.002 --output bench.json
+
+defaultConfig = os.path.join("configs", "Rotel_A14_mkii_fw3_08.json")
+
+# Nearest-rank percentile of an already sorted list
+def percentile(sortedValues, pct):
+    if len(sortedValues) == 0:
+        return None
+    rank = int(round(pct / 100.0 * len(sortedValues) + 0.5)) - 1
+    rank = max(0, min(len(sortedValues) - 1, rank))
+    return sortedValues[rank]
+
+# Summarize a list of per-operation timings (seconds) plus traffic counters
+def summarize(timings, elapsed, bytesIn, bytesOut, failures):
+    timings = sorted(timings)
+    ms = lambda value: round(value * 1000, 3) if value != None else None
+    return {
+        'count': len(timings),
+        'failures': failures,
+        'p50_ms': ms(percentile(timings, 50)),
+        'p95_ms': ms(percentile(timings, 95)),
+        'p99_ms': ms(percentile(timings, 99)),
+        'max_ms': ms(timings[-1] if len(timings) > 0 else None),
+        'mean_ms': ms(sum(timings) / len(timings) if len(timings) > 0 else None),
+        'ops_per_sec': round(len(timings) / elapsed, 1) if elapsed > 0 else None,
+        'bytes_to_amp': bytesIn,
+        'bytes_from_amp': bytesOut,
+    }
+
+# Time 'iterations' calls of op(i), op returns the usual (ret, value) tuple
+def runOperation(sim, op, iterations):
+    timings = []
+    failures = 0
+    bytesIn, bytesOut = sim.bytesIn, sim.bytesOut
+    start = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        (ret, value) = op(i)
+        timings.append(time.perf_counter() - t0)
+        if not ret:
+            failures += 1
+    elapsed = time.perf_counter() - start
+    return summarize(timings, elapsed, sim.bytesIn - bytesIn, sim.bytesOut - bytesOut, failures)
+
+# Short git revision of the tree we're benchmarking, if we can get it
+def gitRevision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5)
+        if out.returncode == 0:
+            return out.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        pass
+    return None
+
+def runBenchmarks(configFile, iterations, latency=0.0, jitter=0.0, fragment=0, operations=None):
+    sim = ampSimulator(configFile, port=0, latency=latency, jitter=jitter, fragment=fragment)
+    sim.start()
+
+    # a throwaway copy of the config pointing at the simulator
+    with open(configFile, 'r') as file:
+        data = json.load(file)
+    data['address'] = '127.0.0.1'
+    data['port'] = sim.port
+    # with a rate limit we'd only be measuring the limit
+    data.pop('rate_limit', None)
+    tmp = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump(data, tmp)
+    tmp.close()
+
+    amp = amplifierConfig(tmp.name)
+    results = dict()
+    try:
+        (ret, message) = amp.connect()
+        if not ret:
+            raise RuntimeError('Could not connect to simulator: ' + message)
+
+        minVol, maxVol = amp.getVolumeMinMax()
+        span = maxVol - minVol
+        sweep = lambda i: minVol + (i % span if (i // span) % 2 == 0 else span - i % span)
+        sourceIds = amp.getSourceIds()
+        switchTo = [s for s in ('cd', 'coax1', 'phono', 'opt1') if s in sourceIds] or sourceIds
+
+        benchmarks = [
+            ('query1', lambda i: amp.doQuery(['volume'])),
+            ('query7', lambda i: amp.querySourceInfo()),
+            ('volume', lambda i: amp.setVolume(sweep(i))),
+            ('source', lambda i: amp.setSource(switchTo[i % len(switchTo)])),
+            ('power', lambda i: amp.powerToggle()),
+        ]
+        for name, op in benchmarks:
+            if operations != None and name not in operations:
+                continue
+            # the power benchmark needs an even count to leave the amp on
+            count = iterations + (iterations % 2) if name == 'power' else iterations
+            results[name] = runOperation(sim, op, count)
+    finally:
+        amp.close()
+        sim.stop()
+        os.unlink(tmp.name)
+
+    return {
+        'revision': gitRevision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': configFile,
+        'iterations': iterations,
+        'latency': latency,
+        'jitter': jitter,
+        'fragment': fragment,
+        'results': results,
+    }
+
+def printReport(report):
+    print('revision ' + str(report['revision']) + ', ' + str(report['iterations']) + ' iterations, latency '
+          + str(report['latency']) + 's, jitter ' + str(report['jitter']) + 's, fragment ' + str(report['fragment']))
+    print('%-8s %9s %9s %9s %9s %10s %9s %9s' % ('op', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'ops/sec', 'bytes->', 'bytes<-'))
+    for name, r in report['results'].items():
+        print('%-8s %9s %9s %9s %9s %10s %9s %9s' % (name, r['p50_ms'], r['p95_ms'], r['p99_ms'], r['max_ms'],
+                                                   r['ops_per_sec'], r['bytes_to_amp'], r['bytes_from_amp']))
+        if r['failures'] > 0:
+            print('         ' + str(r['failures']) + ' failed')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark amplifierConfig against a simulated amp')
+    parser.add_argument('--config', default=defaultConfig, help='amp config to benchmark with')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated reply delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='simulated random extra delay in seconds')
+    parser.add_argument('--fragment', type=int, default=0, help='simulated reply fragment size in bytes')
+    parser.add_argument('--only', action='append', help='only run this benchmark (repeatable)')
+    parser.add_argument('--output', help='save the report as JSON to this file')
+    args = parser.parse_args()
+
+    report = runBenchmarks(args.config, args.iterations, args.latency, args.jitter, args.fragment, args.only)
+    printReport(report)
+    if args.output != None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
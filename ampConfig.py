@@ -1,27 +1,243 @@
 import os
 import json
 import socket
-
-def findConfigs():
-    # search for config JSON files in the 'configs' directory
-    configPath = "configs"
-    contents = os.listdir(configPath)
+import select
+import time
+from ampState import ampState, valueParsers
+from ampTimeout import replyTimeouts, operationName
+from ampRateLimit import tokenBucket
+
+def findConfigs(configPath="configs"):
+    # search for config JSON files in the 'configs' directory, returns a list
+    # of dicts with the file name and the amp name for every amp config found
+    # (other JSON files, like settings.json, are skipped)
+    contents = sorted(os.listdir(configPath))
     configList = []
     for item in contents:
+        if not item.endswith('.json'):
+            continue
+        filename = os.path.join(configPath, item)
         try:
-            with open(item, 'r') as file:
+            with open(filename, 'r') as file:
                 data = json.load(file)
+                if not isinstance(data, dict):
+                    continue
+                if 'sources' not in data or 'queries' not in data or 'commands' not in data:
+                    continue
                 configName = None
                 if 'name' in data:
                     configName = data['name']
 
-                configList.add({ filename: item, name: configName })
+                configList.append({ 'filename': filename, 'name': configName })
         except FileNotFoundError:
             pass
         except json.JSONDecodeError:
             pass
     return configList
 
+# This isn't ideal, but the query source returns just the source ID, but
+# to set the source one needs 'amp:source!' instead of just 'source!'. Maybe
+# another config item is needed in the sources JSON. This will likely
+# not work for older amp firmware versions.
+def sourceCommand(sourceId):
+    return 'amp:' + sourceId + '!'
+
+# Bass and treble values are 000 for none, or -## or +##
+def formatToneValue(toneValue):
+    toneInt = int(toneValue)
+    if toneInt == 0:
+        return "000"
+    elif toneInt > 0:
+        # zfill will pad with zeroes but not add the '+'
+        return '+' + str(toneInt).zfill(2)
+    else:
+        # zfill handles negative numbers properly
+        return str(toneInt).zfill(3)
+
+# Balance value is 000 (centered), or L## or R##
+def formatBalanceValue(balValue):
+    balInt = int(balValue)
+    if balInt == 0:
+        return "000"
+    elif balInt > 0:
+        return 'r' + str(balInt).zfill(2)
+    else:
+        return 'l' + str(abs(balInt)).zfill(2)
+
+# Volume ramp curves - progress through the ramp's duration (0..1) to how far
+# along the way to the target volume we should be (0..1)
+rampCurves = {
+    'linear': lambda p: p,
+    'ease-in': lambda p: p * p,
+    'ease-out': lambda p: 1 - (1 - p) * (1 - p),
+    'ease-in-out': lambda p: p * p * (3 - 2 * p),
+}
+
+# Commands that change the amp relative to where it is - sending one twice
+# isn't the same as sending it once, so they're never retried (see ampWorker)
+relativeCommands = ['power_toggle', 'mute_toggle', 'volume_up', 'volume_down']
+
+# The settings a preset can hold, in the order applyPreset sends them: source
+# first (it can change the volume), bypass before the tone controls it enables,
+# and mute last so a preset never unmutes at the old volume.
+presetKeys = ['source', 'bypass', 'bass', 'treble', 'balance', 'volume', 'mute']
+
+# Normalize a preset value to the way the state cache stores it, so presets can
+# say "bypass": true or "volume": "30" and still compare equal
+def presetValue(key, value):
+    if isinstance(value, bool):
+        return 'on' if value else 'off'
+    if isinstance(value, str) and key in valueParsers:
+        return valueParsers[key](value)
+    return value
+
+# The config keys with the range of each numeric setting, and the range used
+# if they're not there
+settingRanges = {
+    'volume': ('volume_min', 'volume_max', 0, 100),
+    'bass': ('tone_min', 'tone_max', -10, 10),
+    'treble': ('tone_min', 'tone_max', -10, 10),
+    'balance': ('balance_min', 'balance_max', -10, 10),
+}
+
+# The (min, max) range of a numeric setting in config data
+def settingRange(data, key):
+    low, high, defaultLow, defaultHigh = settingRanges[key]
+    return data.get(low, defaultLow), data.get(high, defaultHigh)
+
+# Check a preset's settings against presetKeys and the config data ('sources'
+# and the ranges). Returns (True, preset) or (False, what's wrong with it).
+def validatePreset(name, preset, data):
+    if not isinstance(preset, dict):
+        return (False, "Preset '" + name + "' must be a JSON object")
+    for key, value in preset.items():
+        if key not in presetKeys:
+            return (False, "Preset '" + name + "' has an unknown setting '" + key + "'")
+        try:
+            value = presetValue(key, value)
+        except ValueError:
+            return (False, "Preset '" + name + "' has a bad " + key + ": " + str(value))
+        if key == 'source':
+            ok = isinstance(value, str) and value in data['sources']
+        elif key in ('mute', 'bypass'):
+            ok = value in ('on', 'off')
+        else:
+            low, high = settingRange(data, key)
+            ok = isinstance(value, int) and not isinstance(value, bool) and low <= value <= high
+        if not ok:
+            return (False, "Preset '" + name + "' has a bad " + key + ": " + str(preset[key]))
+    return (True, preset)
+
+# What a config file may contain - the types allowed for each top-level key.
+# The three lists are required, everything else has a default.
+configSchema = {
+    'name': (str,),
+    'address': (str,),
+    'port': (int,),
+    'timeout': (int, float),
+    'volume_min': (int,),
+    'volume_max': (int,),
+    'tone_min': (int,),
+    'tone_max': (int,),
+    'balance_min': (int,),
+    'balance_max': (int,),
+    'command_interval': (int, float),
+    'keepalive_interval': (int, float),
+    'reconnect_max_delay': (int, float),
+    'power_timeout': (int, float),
+    'ramp_step_interval': (int, float),
+    'config_check_interval': (int, float),
+    'adaptive_timeout': (bool,),
+    'trace': (dict, bool),
+    'history': (dict, bool),
+    'rate_limit': (dict,),
+    'presets': (dict,),
+    'sources': (dict,),
+    'queries': (dict,),
+    'commands': (dict,),
+}
+requiredConfigKeys = ['sources', 'queries', 'commands']
+
+# Check config data against configSchema, plus the few things the protocol
+# code relies on. Returns (True, data) or (False, what's wrong with it).
+def validateConfig(data):
+    if not isinstance(data, dict):
+        return (False, "Config is not a JSON object")
+    for key in requiredConfigKeys:
+        if key not in data:
+            return (False, "Missing '" + key + "'")
+    for key, types in configSchema.items():
+        # bool is an int to isinstance, but true isn't a port number
+        if key in data and (not isinstance(data[key], types) or (isinstance(data[key], bool) and bool not in types)):
+            return (False, "'" + key + "' must be " + ' or '.join(t.__name__ for t in types))
+    for key, qstring in data['queries'].items():
+        if not isinstance(qstring, str) or not qstring.endswith('?'):
+            return (False, "Query '" + key + "' must be a string ending in '?'")
+    for key, cmdString in data['commands'].items():
+        if not isinstance(cmdString, str):
+            return (False, "Command '" + key + "' must be a string")
+    for key, source in data['sources'].items():
+        if not isinstance(source, dict) or not isinstance(source.get('label'), str):
+            return (False, "Source '" + key + "' needs a label")
+    for low, high in (('volume_min', 'volume_max'), ('tone_min', 'tone_max'), ('balance_min', 'balance_max')):
+        if low in data and high in data and data[low] > data[high]:
+            return (False, "'" + low + "' is more than '" + high + "'")
+    if 'port' in data and not 0 < data['port'] < 65536:
+        return (False, "'port' is out of range")
+    if 'timeout' in data and data['timeout'] <= 0:
+        return (False, "'timeout' must be more than 0")
+    if 'rate_limit' in data:
+        rate = data['rate_limit'].get('rate')
+        burst = data['rate_limit'].get('burst', 1)
+        if not isinstance(rate, (int, float)) or isinstance(rate, bool) or rate <= 0:
+            return (False, "'rate_limit' needs a 'rate' of more than 0 requests a second")
+        if not isinstance(burst, (int, float)) or isinstance(burst, bool) or burst < 1:
+            return (False, "'rate_limit' 'burst' must be at least 1")
+    for name, preset in data.get('presets', dict()).items():
+        (ret, message) = validatePreset(name, preset, data)
+        if not ret:
+            return (False, message)
+    return (True, data)
+
+# The config keys each of buildIndexes' parts depends on, see applyConfig
+indexedConfigKeys = {'buildLookups': ['queries', 'commands'],
+                     'buildReplyTimeouts': ['timeout', 'adaptive_timeout'],
+                     'buildRateLimiter': ['rate_limit']}
+
+# Modification time and size of a file, None if it can't be read - enough to
+# tell it's been rewritten without reading it
+def configFileStamp(fname):
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+# Incremental parser for the amp's reply stream. Replies look like 'amp:volume=30$'
+# but TCP can split them anywhere (or bundle several into one packet), so any
+# trailing partial reply is kept in the buffer until the rest of it arrives.
+class replyFramer:
+    def __init__(self):
+        self.buffer = bytes()
+
+    # Add newly received bytes, returns a list of complete (name, value) replies
+    def feed(self, data):
+        self.buffer += data
+        chunks = self.buffer.split(b'$')
+        # the last chunk is whatever followed the final '$', keep it for later
+        self.buffer = chunks.pop()
+        replies = []
+        for chunk in chunks:
+            reply = chunk.decode('utf-8', errors='replace')
+            if '=' in reply:
+                name, value = reply.split('=', 1)
+                replies.append((name, value))
+        return replies
+
+    # Throw away any partial reply (used when the connection is reset)
+    def reset(self):
+        self.buffer = bytes()
+
 # This class attempts to implement an abstraction layer between an integrated amp
 # or preamp's usual functions (source selection, tone controls, volume, mute, etc.)
 # and translate those functions to IP-based commands based on a configuration file.
@@ -39,6 +255,7 @@ class amplifierConfig:
     # Parse a JSON configuration file that provides command and query info.
     def readConfig(self, fname):
         try:
+            self.configStamp = configFileStamp(fname)
             with open(fname, 'r') as file:
                 # Use json lib to parse the file
                 data = json.load(file)
@@ -47,11 +264,16 @@ class amplifierConfig:
                 self.configName = None
                 if 'name' in data:
                     self.configName = data['name']
-                # see if our three main lists are in the file - we need all 3 to work.
-                if 'sources' in data and 'queries' in data and 'commands' in data:
+                # see if our three main lists are in the file - we need all 3 to
+                # work - and the rest of it makes sense
+                (valid, message) = validateConfig(data)
+                if valid:
                     self.configValid = True
                     self.configData = data
+                    self.buildIndexes()
+                    self.startRecorders()
                 else:
+                    print('Invalid config: ' + fname + ': ' + message)
                     self.configValid = False
                     self.configData = None
         # the usual exceoption handling for files.
@@ -63,6 +285,49 @@ class amplifierConfig:
             pass
 
 
+    # Set up everything that's worked out from the config data
+    def buildIndexes(self):
+        self.buildLookups()
+        self.buildReplyTimeouts()
+        self.buildRateLimiter()
+
+    # Work out the lookups doCommand/doQuery need once, rather than on every
+    # call - the command and query lists don't change while we're running.
+    def buildLookups(self):
+        # query key -> reply term, e.g. 'volume' -> 'amp:volume' (the query
+        # string without its '?'), and the reverse for mapping replies back
+        self.queryTerms = dict()
+        self.replyIndex = dict()
+        for key, qstring in self.configData['queries'].items():
+            self.queryTerms[key] = qstring[:-1]
+            self.replyIndex[qstring[:-1]] = key
+
+        # commands that take an argument, pre-split around the '#' so we
+        # just need to join the pieces with the argument
+        self.commandTemplates = dict()
+        for key, cmdString in self.configData['commands'].items():
+            if '#' in cmdString:
+                self.commandTemplates[key] = cmdString.split('#')
+
+        # what relativeCommands look like on the wire, see noteSent
+        self.relativePayloads = [self.configData['commands'][key] for key in relativeCommands
+                                 if key in self.configData['commands']]
+
+    # Reply timeouts learned per operation, starting from (and never longer
+    # than) the configured timeout - see readReplies
+    def buildReplyTimeouts(self):
+        self.replyTimeouts = None
+        if self.getAdaptiveTimeout():
+            self.replyTimeouts = replyTimeouts(self.configData['timeout'])
+        self.earlyTimeout = None
+
+    # How many requests a second the amp can take, see ampRateLimit
+    def buildRateLimiter(self):
+        self.rateLimiter = None
+        rateLimit = self.getRateLimit()
+        if rateLimit != None:
+            self.rateLimiter = tokenBucket(rateLimit[0], rateLimit[1])
+
     # Constructor for the ampConfig
     def __init__(self, fname):
 
@@ -72,11 +337,90 @@ class amplifierConfig:
         self.configValid = False
         self.connected = False
         self.ampSocket = None
+        self.queryTerms = dict()
+        self.replyIndex = dict()
+        self.commandTemplates = dict()
+        self.framer = replyFramer()
+        # last known amp settings, kept up to date by every exchange
+        self.state = ampState()
+        # optional ampTracer, see setTracer
+        self.tracer = None
+        # optional ampHistory, see setHistory
+        self.history = None
+        # who the requests we send are recorded as coming from, see setRequestOrigin
+        self.requestOrigin = 'local'
+        # called for the waits in long operations, see pause
+        self.pauseHook = None
+        # set when one of the relativeCommands is sent, see noteSent
+        self.relativePayloads = []
+        self.sentRelative = False
+        self.readTrace = None
+        self.replyTimeouts = None
+        self.earlyTimeout = None
+        self.rateLimiter = None
+        # the config file's mtime/size when we last read or wrote it
+        self.configStamp = None
 
         if fname != None:
             self.filename = fname
             self.readConfig(fname)
 
+    # Hot reload - if the config file has been changed since we read (or
+    # saved) it, check the new contents and switch to them without dropping
+    # the connection. Returns (True, the top-level keys that changed), which is
+    # empty if the file hasn't changed, or (False, message) if the new file
+    # isn't a usable config - we then carry on with the one we have.
+    def reloadIfChanged(self):
+        if self.filename == None:
+            return (True, [])
+        stamp = configFileStamp(self.filename)
+        if stamp == None or stamp == self.configStamp:
+            return (True, [])
+        # a file that's being written shows up again with a new stamp when
+        # it's finished, so a half-written one is only complained about once
+        self.configStamp = stamp
+        try:
+            with open(self.filename, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            return (False, "Config not reloaded: " + str(e))
+        (ret, message) = validateConfig(data)
+        if not ret:
+            return (False, "Config not reloaded: " + message)
+        return (True, self.applyConfig(data))
+
+    # Switch to new (valid) config data, only redoing what the changes affect.
+    # The learned reply timeouts, for one, are kept unless the timeout
+    # settings changed. Returns the top-level keys that changed.
+    def applyConfig(self, data):
+        old = self.configData if self.configData != None else dict()
+        changed = sorted(key for key in set(old) | set(data) if old.get(key) != data.get(key))
+        self.configData = data
+        self.configName = data.get('name')
+        self.configValid = True
+        for build, keys in indexedConfigKeys.items():
+            if any(key in changed for key in keys):
+                getattr(self, build)()
+        self.startRecorders(changed)
+        return changed
+
+    # Start the tracer and history the config asks for, if their config
+    # section is in 'keys' - replacing (or stopping) the ones we have
+    def startRecorders(self, keys=('trace', 'history')):
+        if 'trace' in keys:
+            self.tracer = None
+            if 'trace' in self.configData:
+                # only loaded when it's wanted
+                from ampTrace import ampTracer
+                self.tracer = ampTracer.fromConfig(self.configData['trace'])
+        if 'history' in keys:
+            if self.history != None:
+                self.history.close()
+            self.setHistory(None)
+            if 'history' in self.configData:
+                from ampHistory import ampHistory
+                self.setHistory(ampHistory.fromConfig(self.configData['history']))
+
     # access methods - config name
     def setConfigName(self, configName):
         self.configName = configName
@@ -86,6 +430,40 @@ class amplifierConfig:
     def setConfigAddress(self, ipaddress):
         self.configData['address'] = ipaddress
 
+    # Record timings, byte counts and (optionally) a transcript of every
+    # exchange with an ampTracer, None turns tracing off again
+    def setTracer(self, tracer):
+        self.tracer = tracer
+
+    def getTraceStats(self):
+        if self.tracer == None:
+            return (False, "Tracing is off")
+        return (True, self.tracer.snapshot())
+
+    # Record every state change and request in an ampHistory, None stops
+    # recording (the history itself is left open)
+    def setHistory(self, history):
+        if self.history != None:
+            self.state.removeCallback(self.historyCallback)
+        self.history = history
+        if history != None:
+            self.state.addCallback(self.historyCallback)
+
+    # Record the requests we send from now on as coming from 'origin' ('gui',
+    # 'cli', a daemon client...) in the history
+    def setRequestOrigin(self, origin):
+        self.requestOrigin = origin
+
+    def historyCallback(self, key, oldValue, newValue, origin):
+        self.history.recordState(self.configName, key, oldValue, newValue, origin)
+
+    # Recorded events between 'start' and 'end' (seconds since the epoch),
+    # optionally only for one key - see ampHistory.query
+    def getHistory(self, start=None, end=None, key=None, limit=1000):
+        if self.history == None:
+            return (False, "History is off")
+        return (True, self.history.query(start, end, key, self.configName, limit=limit))
+
     # try to connect tot he amplifier's IP address/port
     def connect(self):
         if not self.configValid:
@@ -96,6 +474,8 @@ class amplifierConfig:
         # Construct our address
         addr = (self.configData['address'], self.configData['port'])
         self.ampSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.framer.reset()
+        self.state.clear()
 
         # Timeout defines how long we wait until we decide the amp has
         # stopped sending data for the current action. On initial connect,
@@ -106,11 +486,23 @@ class amplifierConfig:
             self.ampSocket.connect(addr)
             self.connected = True
             self.ampSocket.settimeout(self.configData['timeout'])
-            return (True, "Success")
+            # a new connection, maybe to a rebooted amp or over a different
+            # network - learn its reply times afresh
+            self.buildReplyTimeouts()
+            result = (True, "Success")
         except TimeoutError:
-            return (False, "Timeout error" )
+            self.close()
+            result = (False, "Timeout error" )
         except ConnectionRefusedError:
-            return (False, "Connection refused")
+            self.close()
+            result = (False, "Connection refused")
+        except OSError as e:
+            # unreachable network, bad address etc.
+            self.close()
+            result = (False, str(e))
+        if self.tracer != None:
+            self.tracer.recordEvent('connects' if result[0] else 'connect_failures', result[1])
+        return result
 
     # Access method to query connection state
     def isConnected(self):
@@ -118,71 +510,345 @@ class amplifierConfig:
 
     # Close the current connection
     def close(self):
-        if self.connected:
+        if self.tracer != None and self.connected:
+            self.tracer.recordEvent('disconnects')
+        if self.ampSocket != None:
             self.ampSocket.close()
         self.connected = False
         self.ampSocket = None
-
-    # Utility method to bundle a command and read the replies
-    def doCommand(self, commandString, optArg=None, argLength=None, doLoop=True):
-
-        # Check our setup before trying to send
-        if not self.configValid:
-            return (False, "Invalid config")
+        self.framer.reset()
+
+    # Translate a query key ('volume') to the term the amp uses in its replies
+    # ('amp:volume'), this is just the query string without the trailing '?'.
+    def queryTerm(self, queryKey):
+        return self.queryTerms.get(queryKey)
+
+    # Pick up anything the amp sent since our last exchange (late replies,
+    # unsolicited updates) without blocking, so it doesn't get mistaken for
+    # the reply to the next thing we send.
+    def drainInput(self):
+        replies = []
+        while True:
+            readable, _, _ = select.select([self.ampSocket], [], [], 0)
+            if not readable:
+                break
+            data = self.ampSocket.recv(1024)
+            if len(data) == 0:
+                # the amp closed the connection
+                self.close()
+                break
+            if self.tracer != None:
+                self.tracer.recordUnsolicited(data)
+            replies += self.framer.feed(data)
+        self.checkEarlyTimeout(replies)
+        return replies
+
+    # If replies turn up shortly after readReplies stopped waiting with a
+    # learned timeout, the timeout was too short - go back to the configured
+    # one for that operation until it's learned again
+    def checkEarlyTimeout(self, replies):
+        if self.earlyTimeout == None:
+            return
+        op, gaveUp = self.earlyTimeout
+        if time.monotonic() - gaveUp > self.configData['timeout'] * 2:
+            self.earlyTimeout = None
+        elif len(replies) > 0:
+            self.earlyTimeout = None
+            self.replyTimeouts.anomaly(op)
+            if self.tracer != None:
+                self.tracer.recordEvent('late_replies', op)
+
+    # Read replies until every term in expectTerms has arrived. The socket
+    # timeout is only a fallback now - if we know which replies we're waiting
+    # for, we return as soon as they're all in instead of waiting for the amp
+    # to go quiet. Without expectTerms we read until the timeout, or until the
+    # first complete reply if doLoop is False. A term that's in expectTerms
+    # more than once has to arrive that many times (see doBatch).
+    # Given the operation name ('op', see ampTimeout) the timeout is the one
+    # learned for the operation, and the waits are used to learn it. If the
+    # learned timeout runs out while replies we're expecting are still missing,
+    # or before any reply at all has come in, the amp is just slower than
+    # usual - so we forget what we learned and keep waiting with the
+    # configured timeout. Giving up on a reply that's on its way would have it
+    # turn up in the middle of the next exchange, as that one's reply.
+    def readReplies(self, expectTerms=None, doLoop=True, op=None):
+        replies = []
+        pending = None
+        if expectTerms != None:
+            pending = dict()
+            for term in expectTerms:
+                pending[term] = pending.get(term, 0) + 1
+        # when tracing, note when the bytes came in for exchange() to record
+        trace = None
+        if self.tracer != None:
+            trace = {'first': None, 'last': None, 'parse': 0.0, 'data': bytes(), 'timedOut': False}
+        self.readTrace = trace
+        timeouts = self.replyTimeouts if op != None else None
+        phase = 'first'
+        sent = time.perf_counter()
+        lastData = None
+        try:
+            while True:
+                if pending != None and len(pending) == 0:
+                    break
+                if pending == None and doLoop == False and len(replies) > 0:
+                    break
+                if timeouts != None:
+                    self.ampSocket.settimeout(timeouts.timeout(op, phase, time.perf_counter() - sent))
+                else:
+                    self.ampSocket.settimeout(self.configData['timeout'])
+                try:
+                    data = self.ampSocket.recv(1024)
+                except TimeoutError:
+                    if timeouts == None or not timeouts.isLearned(op, phase):
+                        raise
+                    if pending == None and phase == 'last':
+                        # no telling how many replies there are, the amp
+                        # going quiet for this long is how we know they're in
+                        raise
+                    timeouts.anomaly(op)
+                    if self.tracer != None:
+                        self.tracer.recordEvent('late_replies', op)
+                    timeouts = None
+                    lastData = None
+                    continue
+                if timeouts != None:
+                    lastData = time.perf_counter()
+                    if phase == 'first':
+                        timeouts.observe(op, 'first', lastData - sent)
+                        phase = 'last'
+                if len(data) == 0:
+                    # the amp closed the connection, nothing more is coming
+                    self.close()
+                    break
+                if trace != None:
+                    received = time.perf_counter()
+                    if trace['first'] == None:
+                        trace['first'] = received
+                    trace['last'] = received
+                    trace['data'] += data
+                for name, value in self.framer.feed(data):
+                    replies.append((name, value))
+                    if pending != None and name in pending:
+                        pending[name] -= 1
+                        if pending[name] == 0:
+                            del pending[name]
+                if trace != None:
+                    trace['parse'] += time.perf_counter() - received
+        except TimeoutError:
+            # drop out of the recv() loop
+            if trace != None:
+                trace['timedOut'] = True
+            if timeouts != None and timeouts.isLearned(op, phase):
+                self.earlyTimeout = (op, time.monotonic())
+        if lastData != None:
+            timeouts.observe(op, 'last', lastData - sent)
+        return replies
+
+    # Have pause() call hook(seconds, wait) instead of just waiting - an
+    # ampWorker uses this to run clicks that come in during a long job
+    def setPauseHook(self, hook):
+        self.pauseHook = hook
+
+    # Wait in the middle of a long operation (a ramp, a power change) with
+    # wait(seconds), time.sleep by default - it can return true to stop
+    # waiting early. With a pause hook other work may be done meanwhile.
+    # Returns what wait() last returned.
+    def pause(self, seconds, wait=None):
+        if wait == None:
+            wait = time.sleep
+        if self.pauseHook != None:
+            return self.pauseHook(seconds, wait)
+        return wait(seconds)
+
+    # Pass replies from the amp on to the state cache
+    def recordReplies(self, replies, origin):
+        mapped = self.mapQueryReplies(replies)
+        for key, value in mapped.items():
+            self.state.update(key, value, origin)
+
+    # Wait up to 'timeout' seconds for anything the amp sends on its own (front
+    # panel, IR remote) and pass it to the state cache. Call this whenever the
+    # connection is otherwise idle, returns the list of replies received.
+    def pollUpdates(self, timeout=0):
         if not self.connected:
-            return (False, "Not connected")
-
+            return []
+        try:
+            readable, _, _ = select.select([self.ampSocket], [], [], timeout)
+            if not readable:
+                return []
+            replies = self.drainInput()
+        except OSError:
+            # connection reset etc. - we're not connected any more
+            self.close()
+            raise
+        self.recordReplies(replies, 'update')
+        return replies
+
+    # Send a protocol string and collect the replies to it (see readReplies).
+    # Anything that arrived before we sent is treated as an unsolicited update.
+    # If the connection breaks we're marked as disconnected and the error is
+    # passed on (an ampWorker will reconnect and retry). With 'adaptive' False
+    # we wait the configured timeout rather than a learned one (see probePower).
+    def exchange(self, payload, expectTerms=None, doLoop=True, adaptive=True):
+        try:
+            self.recordReplies(self.drainInput(), 'update')
+            if not self.connected:
+                raise ConnectionResetError("Connection closed by amp")
+            self.waitToSend()
+            started = time.perf_counter()
+            self.noteSent(payload)
+            self.ampSocket.sendall(payload.encode('utf-8'))
+            sent = time.perf_counter()
+            if self.history != None:
+                self.history.recordRequest(self.configName, payload, self.requestOrigin)
+            op = operationName(payload) if adaptive and self.replyTimeouts != None else None
+            replies = self.readReplies(expectTerms, doLoop, op)
+        except OSError as e:
+            if self.tracer != None:
+                self.tracer.recordEvent('errors', str(e))
+            self.close()
+            raise
+        if self.tracer != None:
+            self.traceExchange(payload, started, sent)
+        self.recordReplies(replies, 'reply')
+        return replies
+
+    # Set sentRelative if 'payload' has any of the relativeCommands in it. The
+    # owner (an ampWorker) clears it, and checks it before retrying a job.
+    def noteSent(self, payload):
+        for relative in self.relativePayloads:
+            if relative in payload:
+                self.sentRelative = True
+
+    # Hold off sending until the rate limit allows it
+    def waitToSend(self):
+        if self.rateLimiter == None:
+            return
+        waited = self.rateLimiter.acquire()
+        if waited > 0 and self.tracer != None:
+            self.tracer.observe('rate limit wait', waited)
+
+    # Pass the timings of the last exchange on to the tracer
+    def traceExchange(self, payload, started, sent):
+        trace = self.readTrace
+        timings = {'send': sent - started, 'total': time.perf_counter() - started}
+        received = bytes()
+        timedOut = False
+        if trace != None:
+            timings['parse'] = trace['parse']
+            if trace['first'] != None:
+                timings['first_byte'] = trace['first'] - sent
+                timings['last_byte'] = trace['last'] - sent
+            received = trace['data']
+            timedOut = trace['timedOut']
+        self.tracer.recordExchange(payload, timings, len(payload), received, timedOut)
+
+    # Send a protocol string without waiting for any replies - they're picked
+    # up by the next exchange/drain and go to the state cache with 'origin'.
+    def transmit(self, payload, origin='update'):
+        try:
+            self.recordReplies(self.drainInput(), origin)
+            if not self.connected:
+                raise ConnectionResetError("Connection closed by amp")
+            self.waitToSend()
+            started = time.perf_counter()
+            self.noteSent(payload)
+            self.ampSocket.sendall(payload.encode('utf-8'))
+            if self.history != None:
+                self.history.recordRequest(self.configName, payload, self.requestOrigin)
+        except OSError as e:
+            if self.tracer != None:
+                self.tracer.recordEvent('errors', str(e))
+            self.close()
+            raise
+        if self.tracer != None:
+            self.tracer.recordExchange(payload, {'send': time.perf_counter() - started}, len(payload), bytes(), False)
+
+    # Translate a command name from the config to a protocol command string,
+    # subbing in the argument if the command takes one. Returns a tuple of a
+    # true/false return code and the command string or an error string.
+    def buildCommand(self, commandString, optArg=None, argLength=None):
         # See if we recognize this command
         if commandString not in self.configData["commands"]:
             return (False, "Missing command")
 
-        # Translate the command to a protocol command string
-        cmdString = self.configData["commands"][commandString]
-
         # Sub in an argument if we need to (this could be more flexible, we have
         # a few special cases/formatting in the methods below)
-        if optArg != None and '#' in cmdString:
+        if optArg != None and commandString in self.commandTemplates:
             if argLength != None:
                 # Rotel's arguments all need to be the same length, so '5' becomes '05'
                 # for 2-digit numbers.
-                newCmd = cmdString.replace('#', str(optArg).zfill(argLength))
-            else:
-                newCmd = cmdString.replace('#', str(optArg))
-            cmdString = newCmd
-
-        # send the command on the socket
-        self.ampSocket.sendall(cmdString.encode('utf-8'))
-        data = bytes()
-        # this took a bit to figure out - multiple responses could be sent for a single
-        # command, so we loop on the recv() until we run out of replies.
-        try:
-            if doLoop == True:
-                while True:
-                    data += self.ampSocket.recv(1024)
+                argString = str(optArg).zfill(argLength)
             else:
-                data += self.ampSocket.recv(1024)
-        except TimeoutError:
-            # drop out of the recv() loop
-            pass
+                argString = str(optArg)
+            return (True, argString.join(self.commandTemplates[commandString]))
+
+        # Otherwise it's just the protocol command string from the config
+        return (True, self.configData["commands"][commandString])
+
+    # Translate a list of query keys to the reply terms we expect back, None
+    # (meaning 'we don't know') stays None.
+    def expectTerms(self, expect):
+        if expect == None:
+            return None
+        return [self.queryTerms[k] for k in expect if k in self.queryTerms]
+
+    # Translate a list of query names to one protocol string with all of the
+    # queries in it. Returns a true/false return code and the string or an error.
+    def buildQuery(self, queries):
+        queryStr = ''
+        # Loop through the query string list and translate them to queries.
+        # Queries don't have any arguments so no need to sub in numbers.
+        for queryString in queries:
+            if queryString not in self.configData["queries"]:
+                return (False, "Missing query")
+            queryStr += self.configData["queries"][queryString]
+        return (True, queryStr)
+
+    # The replies are using the Rotel amp's nomenclature for the values - for
+    # example, if we query for 'volume' from the ampConfig's query list,
+    # the reply will have 'amp:volume=##$'. So to give the GUI the same key
+    # back that it asked for, we have to map the query string back to the
+    # query key (replyIndex is built when the config is loaded).
+    def mapQueryReplies(self, replies):
+        respdict = dict()
+        replyIndex = self.replyIndex
+        for name, value in replies:
+            # a query like 'amp:volume?' will come back as 'amp:volume=##$'.
+            if name in replyIndex:
+                respdict[replyIndex[name]] = value
+        return respdict
+
+    # Utility method to bundle a command and read the replies
+    def doCommand(self, commandString, optArg=None, argLength=None, doLoop=True, expect=None):
+
+        # Check our setup before trying to send
+        if not self.configValid:
+            return (False, "Invalid config")
+        if not self.connected:
+            return (False, "Not connected")
 
-        # the data is a 'bytes' object so we need to decode it
-        dataStr = data.decode('utf-8')
-        # responses are delimited my dollar signs, so let's make a list and check it
-        responses = dataStr.split('$')
+        (ret, cmdString) = self.buildCommand(commandString, optArg, argLength)
+        if not ret:
+            return (False, cmdString)
+
+        # If the caller told us which values the command changes, we know which
+        # replies to wait for and can return as soon as they arrive.
+        # This took a bit to figure out - multiple responses could be sent for a
+        # single command, so otherwise we keep reading until we run out of replies.
+        replies = self.exchange(cmdString, self.expectTerms(expect), doLoop)
         respdict = dict()
-        for r in responses:
-            if '=' in r:
-                elems = r.split('=')
-                respdict[elems[0]] = elems[1]
+        for name, value in replies:
+            respdict[name] = value
         # Generally the GUI ignores the responses from the commands and does its own new
         # queries after a command finishes - so we don't do any special processing on the
         # responses here for now. For queries we handle these differently (see below)
         return (True, respdict)
 
     # Send a configuration query to the amp and read the reply
-    def doQuery(self, queries):
+    def doQuery(self, queries, adaptive=True):
         # Contrary to the Rotel specs, we can get multiple responses from a single query.
-        queryStr = ''
 
         # Check if our config state is valid
         if not self.configValid:
@@ -190,48 +856,131 @@ class amplifierConfig:
         if not self.connected:
             return (False, "Not connected")
 
-        # Loop through the query string list and translate them to queries.
-        # Queries don't have any arguments so no need to sub in numbers.
-        for queryString in queries:
-            if queryString not in self.configData["queries"]:
-                return (False, "Missing query")
-            queryStr += self.configData["queries"][queryString]
-        # Send all of thr queries in one packet/stream
-        self.ampSocket.sendall(queryStr.encode('utf-8'))
+        (ret, queryStr) = self.buildQuery(queries)
+        if not ret:
+            return (False, queryStr)
+
+        # Send all of thr queries in one packet/stream. Responses may come back
+        # in pieces, but since we know what we asked for we can stop reading as
+        # soon as we have an answer to every query.
+        replies = self.exchange(queryStr, self.expectTerms(queries), adaptive=adaptive)
+        return (True, self.mapQueryReplies(replies))
+
+    # Send a command that's expected to change the values in 'optimistic' (a
+    # dict of query key -> expected value, None if we can't predict it). The
+    # expected values go into the state cache straight away so the GUI can show
+    # them, then the amp's reply confirms (or corrects) them. Only keys the amp
+    # didn't confirm are queried afterwards, instead of re-reading everything.
+    # Returns the list of replies.
+    def reconcile(self, optimistic, payload, doLoop=True):
+        previous = dict()
+        for key, value in optimistic.items():
+            previous[key] = self.state.get(key)
+            if value != None:
+                self.state.update(key, value, 'optimistic')
 
-        # Responses may come back in pieces so we loop until we get a timeout
-        data = bytes()
         try:
-            while True:
-                data += self.ampSocket.recv(1024)
-        except TimeoutError:
-            # drop out of the recv() loop
-            pass
-        dataStr = data.decode('utf-8')
-        responses = dataStr.split('$')
+            replies = self.exchange(payload, self.expectTerms(list(optimistic.keys())), doLoop)
+        except OSError:
+            # the command never made it, put the old values back
+            for key, value in previous.items():
+                if value != None:
+                    self.state.update(key, value, 'revert')
+            raise
+
+        confirmed = self.mapQueryReplies(replies)
+        missing = [key for key in optimistic.keys() if key not in confirmed]
+        if len(missing) > 0:
+            self.doQuery(missing)
+        return replies
+
+    # doCommand with optimistic state updates, see reconcile()
+    def reconcileCommand(self, optimistic, commandString, optArg=None, argLength=None, doLoop=True):
+        if not self.configValid:
+            return (False, "Invalid config")
+        if not self.connected:
+            return (False, "Not connected")
+
+        (ret, cmdString) = self.buildCommand(commandString, optArg, argLength)
+        if not ret:
+            return (False, cmdString)
+
+        replies = self.reconcile(optimistic, cmdString, doLoop)
         respdict = dict()
-        # The replies are using the Rotel amp's nomenclature for the values - for
-        # example, if we query for 'volume' from the ampConfig's query list,
-        # the reply will have 'amp:volume=##$'. So to give the GUI the same key
-        # back that it asked for, we have to map the query string back to the
-        # query key.
-        for r in responses:
-            if '=' in r:
-                elems = r.split('=')
-                # a query like 'amp:volume?' will come back as 'amp:volume=##$'.
-                for q, qstring in self.configData['queries'].items():
-                    # strip the last character ('?') off the qstring
-                    qTerm = qstring[:-1]
-                    if elems[0] == qTerm:
-                        respdict[q] = elems[1]
+        for name, value in replies:
+            respdict[name] = value
         return (True, respdict)
 
+    # Send a list of requests (built by an ampBatch) in one write and hand each
+    # one its own replies. Every request is a dict with the protocol 'payload',
+    # the query keys it 'expect's replies for (None if we can't tell) and whether
+    # it's a 'query'. Returns a true/false return code and a list with one
+    # result per request - a reply dict like doQuery's for queries and like
+    # doCommand's for commands.
+    def doBatch(self, requests):
+        if not self.configValid:
+            return (False, "Invalid config")
+        if not self.connected:
+            return (False, "Not connected")
+
+        # what we're waiting for, per request and in total - if any request
+        # has unpredictable replies we fall back to reading until the timeout
+        payload = ''
+        waiting = []
+        expectTerms = []
+        for request in requests:
+            payload += request['payload']
+            terms = self.expectTerms(request['expect'])
+            if terms == None:
+                expectTerms = None
+                terms = []
+            elif expectTerms != None:
+                expectTerms += terms
+            waiting.append(list(terms))
+
+        replies = self.exchange(payload, expectTerms)
+
+        # The amp answers in order, so each reply goes to the first request
+        # still waiting for that term. Anything nobody is waiting for (like
+        # the frequency after a source change) goes with the previous reply.
+        perRequest = [[] for request in requests]
+        lastIndex = 0
+        for name, value in replies:
+            index = lastIndex
+            for i in range(len(requests)):
+                if name in waiting[i]:
+                    waiting[i].remove(name)
+                    index = i
+                    break
+            perRequest[index].append((name, value))
+            lastIndex = index
+
+        results = []
+        for request, requestReplies in zip(requests, perRequest):
+            if request['query']:
+                results.append(self.mapQueryReplies(requestReplies))
+            else:
+                respdict = dict()
+                for name, value in requestReplies:
+                    respdict[name] = value
+                results.append(respdict)
+        return (True, results)
+
+    # Start a new batch of pipelined requests, see ampBatch
+    def batch(self):
+        return ampBatch(self)
+
     ## Wrapper functions to send the supported queries
 
     # query power state
     def queryPower(self):
         return self.doQuery(["power"])
 
+    # query power state to see if the amp is still there - with the configured
+    # timeout, so a slow moment on the network isn't taken for a dead link
+    def probePower(self):
+        return self.doQuery(["power"], adaptive=False)
+
     # get current source
     def querySource(self):
         return self.doQuery(["source"])
@@ -249,33 +998,136 @@ class amplifierConfig:
 
     # set a new volume level
     def setVolume(self, volValue):
+        # inputs set to a fixed volume ignore volume commands, don't wait for
+        # a reply that's never coming once we know that
+        source = self.state.get('source')
+        if self.isFixedVolume(source):
+            return (False, "Volume is fixed on this input")
+
         # volume numeric value, needs to be zero-padded if < 10
-        return self.doCommand('volume_set', volValue, 2, doLoop=False)
+        result = self.reconcileCommand({'volume': volValue}, 'volume_set', volValue, 2, doLoop=False)
+
+        # If the amp answered, the input's volume isn't fixed. If it didn't and
+        # the volume reconcile() then queried isn't what we asked for, it is
+        # (a slow reply would have turned up by then and set the volume).
+        (ret, replies) = result
+        if ret and source != None and self.state.get('source') == source:
+            if self.queryTerm('volume') in replies:
+                self.setSourceCapability(source, 'fixed_volume', False)
+            elif self.state.get('volume') != int(volValue):
+                self.setSourceCapability(source, 'fixed_volume', True)
+        return result
+
+    # Fade the volume to 'target' over 'duration' seconds. The steps are sent
+    # without waiting for the amp's replies (those go to the state cache as
+    # they come in, so the cache trails the ramp by the amp's latency),
+    # on a fixed schedule from the start time so the ramp takes as long as it
+    # should however slow the amp is to answer. 'curve' is one of rampCurves.
+    # Setting the 'cancel' event (a threading.Event) stops the ramp where it
+    # is, e.g. when a new target comes in. The waits between steps go through
+    # pause(), so on an ampWorker other clicks are answered during the ramp.
+    # The last step is a normal setVolume so the final level is confirmed by
+    # the amp.
+    def rampVolume(self, target, duration, curve='linear', cancel=None):
+        if not self.configValid:
+            return (False, "Invalid config")
+        if not self.connected:
+            return (False, "Not connected")
+        if curve not in rampCurves:
+            return (False, "Unknown ramp curve")
+        volMin, volMax = self.getVolumeMinMax()
+        target = max(volMin, min(volMax, int(target)))
+
+        start = self.state.get('volume')
+        if not isinstance(start, int):
+            self.queryVolume()
+            start = self.state.get('volume')
+            if not isinstance(start, int):
+                return (False, "Volume unknown (fixed volume input?)")
+
+        steps = abs(target - start)
+        if steps > 1 and duration > 0:
+            # one tick per volume step if there's time, but never faster than
+            # the amp is happy to take them
+            interval = max(self.getRampStepInterval(), duration / steps)
+            shape = rampCurves[curve]
+            startTime = time.monotonic()
+            tick = 1
+            lastSent = start
+            while tick * interval < duration:
+                # wait for this tick, but wake up straight away if cancelled
+                wait = startTime + tick * interval - time.monotonic()
+                if self.pause(max(0, wait), cancel.wait if cancel != None else None):
+                    return (False, "Ramp cancelled")
+                value = start + round((target - start) * shape(tick * interval / duration))
+                if value != lastSent:
+                    (ret, cmdString) = self.buildCommand('volume_set', value, 2)
+                    if not ret:
+                        return (False, cmdString)
+                    self.transmit(cmdString, 'reply')
+                    lastSent = value
+                tick += 1
+            wait = startTime + duration - time.monotonic()
+            if self.pause(max(0, wait), cancel.wait if cancel != None else None):
+                return (False, "Ramp cancelled")
+            # the amp answers the steps in its own time - wait for the answer
+            # to the last one so it isn't taken for the answer to the final step
+            volumeTerm = self.queryTerm('volume')
+            try:
+                while lastSent != start and self.state.get('volume') != lastSent:
+                    replies = self.readReplies([volumeTerm])
+                    self.recordReplies(replies, 'reply')
+                    if volumeTerm not in [name for name, value in replies]:
+                        break
+            except OSError:
+                self.close()
+                raise
+        return self.setVolume(target)
 
     # Set a new active source
     def setSource(self, sourceId):
-        # This isn't ideal, but the query source returns just the source ID, but
-        # to set the source one needs 'amp:source!' instead of just 'source!'. Maybe
-        # another config item is needed in the sources JSON. This will likely
-        # not work for older amp firmware versions.
-        sourceCmd = 'amp:' + sourceId + '!'
+        sourceCmd = sourceCommand(sourceId)
 
-        # Send the command
-        self.ampSocket.sendall(sourceCmd.encode('utf-8'))
+        if not self.connected:
+            return (False, "Not connected")
 
-        # We only expect a single reply back so no need for a loop
-        try:
-            data = self.ampSocket.recv(1024)
-        except TimeoutError:
+        # Send the command and wait for the source reply, and the frequency if
+        # we know this is a digital input (so it doesn't turn up late).
+        optimistic = {'source': sourceId}
+        digital = self.getSourceCapability(sourceId, 'digital')
+        freqTerm = self.queryTerm('frequency')
+        if digital == True and freqTerm != None:
+            optimistic['frequency'] = None
+        replies = self.reconcile(optimistic, sourceCmd)
+        confirmed = self.mapQueryReplies(replies)
+        if 'source' not in confirmed:
             return (False, 'Timeout during query')
 
-        # decode the reply and return it
-        dataStr = data.decode('utf-8')
-        if dataStr.endswith('$'):
-            dataStr = dataStr[:-1]
-        dataStr.replace('$', '')
-        value = dataStr.split('=')[1]
-        return (True, value)
+        # Only a frequency that came after the amp confirmed the source is the
+        # new source's - one from before could be a late one from the old
+        # source
+        frequency = None
+        if freqTerm != None:
+            names = [name for name, value in replies]
+            sourceAt = len(names) - 1 - names[::-1].index(self.queryTerm('source'))
+            for name, value in replies[sourceAt + 1:]:
+                if name == freqTerm:
+                    frequency = value
+        self.checkSourceFrequency(confirmed['source'], frequency)
+        return (True, confirmed['source'])
+
+    # After a source change: ask for the new source's sample rate unless we
+    # have it already ('frequency'), and learn from it whether the source is
+    # a digital input (only they report one, analog ones say 'off')
+    def checkSourceFrequency(self, sourceId, frequency=None):
+        if self.queryTerm('frequency') == None:
+            return
+        if frequency == None:
+            (ret, resp) = self.doQuery(['frequency'])
+            if ret:
+                frequency = resp.get('frequency')
+        if frequency != None and self.state.get('source') == sourceId:
+            self.setSourceCapability(sourceId, 'digital', frequency != 'off')
 
     # Utility methods for getting source list and mapping indexes to labels
 
@@ -304,6 +1156,60 @@ class amplifierConfig:
                 return self.configData['sources'][sourceid]['label']
         return None
 
+    # What we've learned about a source (see setSourceCapability) - True,
+    # False or None if we don't know yet
+    def getSourceCapability(self, sourceId, capability):
+        if sourceId in self.configData['sources']:
+            return self.configData['sources'][sourceId].get(capability)
+        return None
+
+    def isFixedVolume(self, sourceId):
+        return self.getSourceCapability(sourceId, 'fixed_volume') == True
+
+    # Remember something we found out about a source - 'fixed_volume' (the
+    # amp ignores volume commands on it) or 'digital' (it reports a sample
+    # rate). It's stored in the source's entry in the config file, so it only
+    # has to be found out once.
+    def setSourceCapability(self, sourceId, capability, value):
+        if sourceId not in self.configData['sources']:
+            return (False, "Unknown source")
+        source = self.configData['sources'][sourceId]
+        if source.get(capability) == value:
+            return (True, value)
+        source[capability] = value
+        if self.filename == None:
+            return (True, value)
+
+        def update(data):
+            data['sources'][sourceId][capability] = value
+        # if it can't be saved (read-only config, the source has gone from
+        # the file) we'll just have to find out again next time
+        (ret, message) = self.updateConfigFile(update)
+        if not ret:
+            return (ret, message)
+        return (True, value)
+
+    # Change just one thing in the config file: update(data) changes what's in
+    # the file now, and that's written back. configData can have changes the
+    # user hasn't saved (the settings dialog), and the file changes we haven't
+    # reloaded yet - neither is lost. Returns (True, None) or (False, message).
+    def updateConfigFile(self, update):
+        if self.filename == None:
+            return (False, "No file name")
+        try:
+            unchanged = configFileStamp(self.filename) == self.configStamp
+            with open(self.filename, 'r') as file:
+                data = json.load(file)
+            update(data)
+            with open(self.filename, 'w') as file:
+                json.dump(data, file, indent=4)
+            # our own change doesn't need reloading, anyone else's does
+            if unchanged:
+                self.configStamp = configFileStamp(self.filename)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            return (False, "Not saved: " + str(e))
+        return (True, None)
+
     # get the configured IP address
     def getAddress(self):
         if 'address' in self.configData:
@@ -312,31 +1218,77 @@ class amplifierConfig:
 
     # fetch the volume parameters
     def getVolumeMinMax(self):
-        min = 0
-        max = 100
-        if 'volume_min' in self.configData:
-            min = self.configData['volume_min']
-        if 'volume_max' in self.configData:
-            max = self.configData['volume_max']
-        return min, max
+        return settingRange(self.configData, 'volume')
 
     def getToneMinMax(self):
-        min = -10
-        max = 10
-        if 'tone_min' in self.configData:
-            min = self.configData['tone_min']
-        if 'tone_max' in self.configData:
-            max = self.configData['tone_max']
-        return min, max
+        return settingRange(self.configData, 'bass')
 
     def getBalanceMinMax(self):
-        min = -10
-        max = 10
-        if 'balance_min' in self.configData:
-            min = self.configData['balance_min']
-        if 'balance_max' in self.configData:
-            max = self.configData['balance_max']
-        return min, max
+        return settingRange(self.configData, 'balance')
+
+    # minimum time between two sends of the same slider-type control (volume,
+    # tone, balance) in seconds, see ampWorker.submitLatest
+    def getCommandInterval(self):
+        interval = 0.1
+        if 'command_interval' in self.configData:
+            interval = self.configData['command_interval']
+        return interval
+
+    # learn reply timeouts from the amp's actual response times (see
+    # ampTimeout), the configured timeout is then only the upper limit
+    def getAdaptiveTimeout(self):
+        adaptive = True
+        if 'adaptive_timeout' in self.configData:
+            adaptive = self.configData['adaptive_timeout']
+        return adaptive
+
+    def getReplyTimeouts(self):
+        if self.replyTimeouts == None:
+            return (False, "Adaptive timeouts are off")
+        return (True, self.replyTimeouts.snapshot())
+
+    # shortest time between two steps of a volume ramp (seconds)
+    def getRampStepInterval(self):
+        interval = 0.04
+        if 'ramp_step_interval' in self.configData:
+            interval = self.configData['ramp_step_interval']
+        return interval
+
+    # how long the connection can sit idle before an ampWorker checks it's
+    # still alive, and the longest wait between reconnect attempts (seconds)
+    def getKeepaliveInterval(self):
+        interval = 10
+        if 'keepalive_interval' in self.configData:
+            interval = self.configData['keepalive_interval']
+        return interval
+
+    def getReconnectMaxDelay(self):
+        delay = 30
+        if 'reconnect_max_delay' in self.configData:
+            delay = self.configData['reconnect_max_delay']
+        return delay
+
+    # the most requests a second we send the amp, and how many of them can go
+    # back to back, as a (rate, burst) tuple - None for no limit
+    def getRateLimit(self):
+        if 'rate_limit' not in self.configData:
+            return None
+        rateLimit = self.configData['rate_limit']
+        return (rateLimit['rate'], rateLimit.get('burst', 1))
+
+    # how often an ampWorker looks for changes to the config file (seconds)
+    def getConfigCheckInterval(self):
+        interval = 2
+        if 'config_check_interval' in self.configData:
+            interval = self.configData['config_check_interval']
+        return interval
+
+    # how long to wait for a power on/off to finish (seconds)
+    def getPowerTimeout(self):
+        timeout = 15
+        if 'power_timeout' in self.configData:
+            timeout = self.configData['power_timeout']
+        return timeout
 
     # fetch the amplifier config name
     def getName(self):
@@ -350,71 +1302,226 @@ class amplifierConfig:
     def getAddress(self):
         return self.configData['address']
 
+    # get the TCP port the amp listens on
+    def getPort(self):
+        return self.configData['port']
+
     # set the IP address
     def setAddress(self, newaddress):
         self.configData['address'] = newaddress
 
     # More command wrappers - toggle the power value
     def powerToggle(self):
-        return self.doCommand('power_toggle')
+        return self.doCommand('power_toggle', expect=['power'])
+
+    # Wait until the amp reports it's on (powerOn true) or in standby. Coming out
+    # of standby takes a few seconds during which the amp may not answer, so we
+    # listen for its power update and also ask with power queries, starting at
+    # short intervals and backing off. Returns a true/false return code and the
+    # power state or an error string if it didn't happen within 'timeout' seconds
+    # (the config's power_timeout by default).
+    def waitForPower(self, powerOn, timeout=None):
+        if timeout == None:
+            timeout = self.getPowerTimeout()
+        deadline = time.monotonic() + timeout
+        interval = 0.1
+        while True:
+            power = self.state.get('power')
+            if power != None and (power == 'on') == powerOn:
+                return (True, power)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return (False, 'Amp did not power ' + ('on' if powerOn else 'off') + ' within ' + str(timeout) + ' seconds')
+            if not self.connected:
+                return (False, "Not connected")
+            # give the amp a chance to tell us on its own, then ask
+            self.pause(min(interval, remaining), self.pollUpdates)
+            power = self.state.get('power')
+            if power == None or (power == 'on') != powerOn:
+                self.probePower()
+            interval = min(interval * 2, 1.0)
+
+    # Turn the power on or off and wait for the amp to get there (see waitForPower)
+    def setPower(self, powerOn, timeout=None):
+        (ret, resp) = self.doCommand('power_on' if powerOn else 'power_off', expect=['power'])
+        if not ret:
+            return (ret, resp)
+        return self.waitForPower(powerOn, timeout)
+
+    # Toggle the power and wait for the amp to get there (see waitForPower)
+    def powerToggleAndWait(self, timeout=None):
+        # we need to know where we're starting from to know what to wait for
+        if self.state.get('power') == None:
+            (ret, resp) = self.queryPower()
+            if not ret:
+                return (ret, resp)
+        powerOn = self.state.get('power') != 'on'
+        (ret, resp) = self.powerToggle()
+        if not ret:
+            return (ret, resp)
+        return self.waitForPower(powerOn, timeout)
 
     # Toggle the muting status
     def muteToggle(self):
-        return self.doCommand('mute_toggle')
+        # we can guess the new value if we know the current one
+        newMute = {'on': 'off', 'off': 'on'}.get(self.state.get('mute'))
+        return self.reconcileCommand({'mute': newMute}, 'mute_toggle')
+
+    # Set the muting status
+    def setMute(self, muteVal):
+        if muteVal == False:
+            return self.reconcileCommand({'mute': 'off'}, 'mute_off')
+        else:
+            return self.reconcileCommand({'mute': 'on'}, 'mute_on')
 
     # Set the tone bypass status
     def setBypass(self, bypassVal):
         if bypassVal == False:
-            return self.doCommand('bypass_off')
+            return self.reconcileCommand({'bypass': 'off'}, 'bypass_off')
         else:
-            return self.doCommand('bypass_on')
+            return self.reconcileCommand({'bypass': 'on'}, 'bypass_on')
 
     # set the new bass level, note the special formatting
     def setBass(self, bassValue):
-        # bass value is 000 for none, or -## or +##
-        bassInt = int(bassValue)
-        if bassInt == 0:
-            bstring = "000"
-        elif bassInt > 0:
-            bstring = '+' + str(bassInt).zfill(2)
-        else:
-            bstring = str(bassInt).zfill(3)
-        return self.doCommand('bass_set', bstring, doLoop=False)
+        return self.reconcileCommand({'bass': int(bassValue)}, 'bass_set', formatToneValue(bassValue), doLoop=False)
 
     # set the new treble level, note the special formatting (same as bass)
     def setTreble(self, trebValue):
-        # treb value is 000 for none, or -## or +##
-        trebInt = int(trebValue)
-        if trebInt == 0:
-            tstring = "000"
-        elif trebInt > 0:
-            # zfill will pad with zeroes but not add the '+'
-            tstring = '+' + str(trebInt).zfill(2)
-        else:
-            # zfill handles negative numbers properly
-            tstring = str(trebInt).zfill(3)
-        return self.doCommand('treble_set', tstring, doLoop=False)
+        return self.reconcileCommand({'treble': int(trebValue)}, 'treble_set', formatToneValue(trebValue), doLoop=False)
 
     # set the new balance level, note the special formatting (subtly different)
     def setBalance(self, balValue):
-        balInt = int(balValue)
-        # balance value is 000 (centered), or L## or R##
-        if balInt == 0:
-            bstring = "000"
-        elif balInt > 0:
-            # zfill will pad with zeroes but not add the '+'
-            bstring = 'r' + str(balInt).zfill(2)
-        else:
-            # zfill handles negative numbers properly
-            bstring = 'l' + str(abs(balInt)).zfill(2)
-        return self.doCommand('balance_set', bstring, doLoop=False)
+        return self.reconcileCommand({'balance': int(balValue)}, 'balance_set', formatBalanceValue(balValue), doLoop=False)
+
+    ## Presets - named sets of settings stored in the config's 'presets' section,
+    ## e.g. "presets": { "TV": { "source": "opt1", "volume": 35, "bypass": "on" } }
+
+    # Names of the presets in the config
+    def getPresetNames(self):
+        if 'presets' in self.configData:
+            return list(self.configData['presets'].keys())
+        return []
 
-    # write config data to a JSON file
+    def getPreset(self, name):
+        if 'presets' in self.configData:
+            return self.configData['presets'].get(name)
+        return None
+
+    # Store the amp's current settings (from the state cache) as a preset, or
+    # the given dict of settings. Use storePreset() to keep it.
+    def savePreset(self, name, values=None):
+        if values == None:
+            state = self.state.snapshot()
+            values = dict()
+            for key in presetKeys:
+                if key in state:
+                    values[key] = state[key]
+        (ret, message) = validatePreset(name, values, self.configData)
+        if not ret:
+            return (ret, message)
+        if 'presets' not in self.configData:
+            self.configData['presets'] = dict()
+        self.configData['presets'][name] = values
+        return (True, values)
+
+    # savePreset, and write the preset to the config file - without anything
+    # else that's been changed in configData
+    def storePreset(self, name, values=None):
+        (ret, values) = self.savePreset(name, values)
+        if not ret:
+            return (ret, values)
+
+        def update(data):
+            if 'presets' not in data:
+                data['presets'] = dict()
+            data['presets'][name] = values
+        (ret, message) = self.updateConfigFile(update)
+        if not ret:
+            return (ret, message)
+        return (True, values)
+
+    def deletePreset(self, name):
+        if name in self.getPresetNames():
+            del self.configData['presets'][name]
+            return (True, name)
+        return (False, "Unknown preset")
+
+    # Recall a preset. The amp is powered on if needed, then only the settings
+    # that differ from the state cache are sent, all in one batch - recalling a
+    # preset that's mostly active already costs one or two commands. Returns a
+    # true/false return code and the list of keys that were changed.
+    def applyPreset(self, name):
+        preset = self.getPreset(name)
+        if preset == None:
+            return (False, "Unknown preset")
+        # the config was checked when it was loaded, but presets can be
+        # changed since
+        (ret, message) = validatePreset(name, preset, self.configData)
+        if not ret:
+            return (ret, message)
+        if not self.connected:
+            return (False, "Not connected")
+
+        # the amp ignores everything else in standby
+        if self.state.get('power') == None:
+            self.queryPower()
+        if self.state.get('power') != 'on':
+            (ret, message) = self.setPower(True)
+            if not ret:
+                return (ret, message)
+
+        # fill in anything the cache doesn't know yet, or we can't diff it
+        wanted = [key for key in presetKeys if key in preset]
+        unknown = [key for key in wanted if self.state.get(key) == None and key in self.queryTerms]
+        if len(unknown) > 0:
+            self.doQuery(unknown)
+
+        state = self.state.snapshot()
+        batch = self.batch()
+        changed = []
+        source = presetValue('source', preset['source']) if 'source' in preset else state.get('source')
+        for key in wanted:
+            value = presetValue(key, preset[key])
+            if key in state and state[key] == value:
+                continue
+            if key == 'volume' and self.isFixedVolume(source):
+                # the amp would ignore it, and we'd wait for its reply
+                continue
+            if key == 'source':
+                batch.setSource(value)
+            elif key == 'volume':
+                batch.setVolume(value)
+            elif key == 'mute':
+                batch.setMute(value == 'on')
+            elif key == 'bypass':
+                batch.setBypass(value == 'on')
+            elif key == 'bass':
+                batch.setBass(value)
+            elif key == 'treble':
+                batch.setTreble(value)
+            elif key == 'balance':
+                batch.setBalance(value)
+            changed.append(key)
+
+        (ret, results) = batch.run()
+        if not ret:
+            return (ret, results)
+        # the old source's sample rate is still in the cache
+        if 'source' in changed:
+            self.checkSourceFrequency(source)
+        return (True, changed)
+
+    # write config data to a JSON file - unless someone else changed the file
+    # since we read it, that would be lost (the worker reloads it instead)
     def saveConfig(self):
         if self.filename == None:
             return False, "No file name"
+        if configFileStamp(self.filename) != self.configStamp:
+            return False, "The config file has been changed since it was loaded, not saved"
         with open(self.filename, 'w') as json_file:
             json.dump(self.configData, json_file, indent=4)
+        # our own changes don't need reloading
+        self.configStamp = configFileStamp(self.filename)
         return True, "Save successful"
 
     # these show/hide methods may be used in the future but they are just stubs for now
@@ -426,6 +1533,76 @@ class amplifierConfig:
         if sourceName in self.sources:
             sources[sourceName].visible = True
 
+# A list of commands and queries to be sent to the amp in a single write, with
+# the replies sorted back out to each request - so a scene like 'select phono,
+# volume 30, bypass on, balance 0' costs about one round trip instead of four.
+# The builder methods mirror amplifierConfig's wrappers and can be chained:
+#   (ret, results) = amp.batch().setSource('phono').setVolume(30).setBypass(True).query(['volume']).run()
+# Note the amp ignores most commands in standby and doesn't answer while it's
+# powering up, so power the amp on (and wait for it) before sending a batch.
+class ampBatch:
+
+    def __init__(self, ampConfig):
+        self.ampConfig = ampConfig
+        self.requests = []
+        self.error = None
+
+    # Add a command from the config's command list, 'expect' lists the query
+    # keys the command changes (None if we can't tell, which means the batch
+    # has to wait for the timeout)
+    def command(self, commandString, optArg=None, argLength=None, expect=None):
+        (ret, cmdString) = self.ampConfig.buildCommand(commandString, optArg, argLength)
+        if not ret:
+            self.error = cmdString
+        else:
+            self.requests.append({'payload': cmdString, 'expect': expect, 'query': False})
+        return self
+
+    # Add one or more queries
+    def query(self, queries):
+        (ret, queryStr) = self.ampConfig.buildQuery(queries)
+        if not ret:
+            self.error = queryStr
+        else:
+            self.requests.append({'payload': queryStr, 'expect': list(queries), 'query': True})
+        return self
+
+    def setVolume(self, volValue):
+        return self.command('volume_set', volValue, 2, expect=['volume'])
+
+    def setSource(self, sourceId):
+        self.requests.append({'payload': sourceCommand(sourceId), 'expect': ['source'], 'query': False})
+        return self
+
+    def setMute(self, muteVal):
+        return self.command('mute_on' if muteVal else 'mute_off', expect=['mute'])
+
+    def setBypass(self, bypassVal):
+        return self.command('bypass_on' if bypassVal else 'bypass_off', expect=['bypass'])
+
+    def setBass(self, bassValue):
+        return self.command('bass_set', formatToneValue(bassValue), expect=['bass'])
+
+    def setTreble(self, trebValue):
+        return self.command('treble_set', formatToneValue(trebValue), expect=['treble'])
+
+    def setBalance(self, balValue):
+        return self.command('balance_set', formatBalanceValue(balValue), expect=['balance'])
+
+    # Number of requests so far
+    def size(self):
+        return len(self.requests)
+
+    # Send everything, returns a true/false return code and a list with one
+    # result per request (in the order they were added) or an error string
+    def run(self):
+        if self.error != None:
+            return (False, self.error)
+        if len(self.requests) == 0:
+            return (True, [])
+        return self.ampConfig.doBatch(self.requests)
+
+
 
 
 
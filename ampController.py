@@ -0,0 +1,114 @@
+import os
+from ampConfig import amplifierConfig, findConfigs
+from ampWorker import ampWorker, priorityInteractive
+
+# Controller for a whole house of amps. Every amp config found in the configs
+# directory gets its own amplifierConfig and ampWorker, so each amp has its own
+# connection (kept up by the worker) and its own state cache, and switching
+# between amps in the GUI doesn't mean reconnecting.
+#
+# Operations can be fanned out to all amps (or a subset) at once. Each amp's
+# worker runs its part in parallel with the others, so e.g. querying the state
+# of every zone takes about as long as querying the slowest one:
+#   controller = multiAmpController()
+#   controller.start()
+#   states = controller.fanOut('querySourceInfo')
+#   controller.fanOut('setMute', True)
+
+class multiAmpController:
+
+    # Constructor - load every amp config in configPath, or use the given list
+    # of amplifierConfigs instead
+    def __init__(self, configPath="configs", amps=None):
+        self.amps = dict()
+        self.workers = dict()
+
+        if amps == None:
+            amps = []
+            for entry in findConfigs(configPath):
+                amps.append(amplifierConfig(entry['filename']))
+
+        for amp in amps:
+            if not amp.configValid:
+                continue
+            # amps are known by their config name, made unique with the file
+            # name if two configs share a name
+            name = amp.configName
+            if name == None:
+                name = os.path.basename(amp.filename)
+            if name in self.amps:
+                name += ' (' + os.path.basename(amp.filename) + ')'
+            self.amps[name] = amp
+            self.workers[name] = ampWorker(amp)
+
+    # Start every worker and connect to every amp (in parallel)
+    def start(self):
+        for worker in self.workers.values():
+            worker.start()
+            worker.submit(worker.connectAmp)
+
+    # Stop the workers and close the connections
+    def stop(self):
+        for worker in self.workers.values():
+            worker.stop()
+        for name, worker in self.workers.items():
+            if worker.is_alive():
+                worker.join()
+            self.amps[name].close()
+            # write out what's left of the history
+            if self.amps[name].history != None:
+                self.amps[name].history.close()
+
+    # Names of the amps, in config file order
+    def getAmpNames(self):
+        return list(self.amps.keys())
+
+    def getAmp(self, name):
+        return self.amps.get(name)
+
+    def getWorker(self, name):
+        return self.workers.get(name)
+
+    # The amp to show first - the first one with an address configured
+    def getDefaultAmpName(self):
+        for name, amp in self.amps.items():
+            if amp.getAddress():
+                return name
+        names = self.getAmpNames()
+        if len(names) > 0:
+            return names[0]
+        return None
+
+    # Call amplifierConfig.<methodName>(*args) on every amp in 'names' (all
+    # amps by default) at the same time and wait for them all. Returns a dict of
+    # amp name -> the method's (ret, value) tuple; amps that don't answer within
+    # 'timeout' seconds get a false return code. 'priority' is the workers' job
+    # priority (see ampWorker).
+    def fanOut(self, methodName, *args, names=None, timeout=None, priority=priorityInteractive):
+        if names == None:
+            names = self.getAmpNames()
+        pending = dict()
+        for name in names:
+            func = getattr(self.amps[name], methodName)
+            pending[name] = self.workers[name].callAsync(func, *args, priority=priority, timeout=timeout)
+        results = dict()
+        for name, call in pending.items():
+            results[name] = call.wait(timeout)
+        return results
+
+    # Query everything about every amp's current source in one go
+    def queryAll(self, timeout=None):
+        return self.fanOut('querySourceInfo', timeout=timeout)
+
+    # Mute or unmute every amp
+    def muteAll(self, mute=True, timeout=None):
+        return self.fanOut('setMute', mute, timeout=timeout)
+
+    # Last known state of every amp from the state caches, no network traffic
+    def snapshot(self):
+        states = dict()
+        for name, amp in self.amps.items():
+            state = amp.state.snapshot()
+            state['connected'] = amp.isConnected()
+            states[name] = state
+        return states
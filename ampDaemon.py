@@ -0,0 +1,352 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import socketserver
+from ampConfig import validateConfig, settingRange
+from ampController import multiAmpController
+from ampWorker import pendingCall, priorityNames, priorityInteractive, priorityScene
+
+# Long-running service that owns the amp connections, so the GUI, the command
+# line remote and any scripts can all use the amps at the same time - the amps
+# only take a few clients, and every client connecting on its own means they
+# end up fighting over them. The daemon keeps one connection per amp (through
+# a multiAmpController, so it's supervised and reconnected like the GUI's) and
+# the state caches, and serves a small JSON protocol on a local socket:
+#
+#   python3 ampDaemon.py                          (127.0.0.1:9597)
+#   python3 ampDaemon.py --unix /tmp/rotel.sock   (and a Unix socket too)
+#
+# Requests and replies are one JSON object per line. A request names a method,
+# its parameters and (optionally) the amp, the reply has the request's id and
+# the method's result - the usual [true/false, value] pair:
+#   {"id": 1, "amp": "Rotel A14 mkII fw3_08", "method": "setVolume", "params": [30]}
+#   {"id": 1, "result": [true, {"amp:volume": "30"}]}
+#
+# Amp methods (setVolume, doQuery, applyPreset ...) are run by the amp's
+# worker, so requests from all clients are sent to the amp one at a time. A
+# request can give its priority - "interactive" (the default), "scene" (the
+# default for presets and ramps) or "polling" - and more urgent requests go
+# first, otherwise they go in the order they came in:
+#   {"id": 2, "method": "doQuery", "params": [["volume"]], "priority": "polling"}
+# A client that sends more than the worker can queue has to wait for its
+# replies - see ampWorker. 'state' is answered from the state cache without
+# going to the amp at all. After a 'subscribe' the client is also sent every
+# state change and connection change as they happen:
+#   {"event": "state", "amp": "...", "key": "volume", "value": 31, "origin": "update"}
+#   {"event": "connection", "amp": "...", "connected": false, "message": "Connection lost"}
+#   {"event": "config", "amp": "...", "changed": ["sources"]}
+#
+# ampRemote has a client for this protocol, and an amplifierConfig that talks
+# to the amp through the daemon (which the GUI and rotel.py use with --daemon).
+
+defaultDaemonPort = 9597
+
+# amplifierConfig methods clients may call. Those in ampMethods talk to the amp
+# and are run by its worker, the configMethods just read the config.
+ampMethods = ['doQuery', 'doCommand', 'queryPower', 'querySource', 'queryVolume',
+              'querySourceInfo', 'setVolume', 'setSource', 'powerToggle', 'setPower',
+              'powerToggleAndWait', 'muteToggle', 'setMute', 'setBypass', 'setBass',
+              'setTreble', 'setBalance', 'applyPreset']
+configMethods = ['getSourceIds', 'getSourceLabel', 'getSourceCapability', 'getPresetNames', 'getPreset',
+                 'getVolumeMinMax', 'getToneMinMax', 'getBalanceMinMax', 'getName',
+                 'getAddress', 'getTraceStats', 'getReplyTimeouts', 'getHistory']
+# Methods that change the config file, with the config key they change
+configWriteMethods = {'setSourceCapability': 'sources', 'storePreset': 'presets'}
+# configMethods that return a (ret, value) tuple of their own, the others'
+# results are passed on as (True, result)
+resultMethods = ['getTraceStats', 'getReplyTimeouts', 'getHistory']
+
+# Amp methods that set a numeric setting (the first parameter), with the
+# setting whose range it must be in (see ampConfig.settingRanges)
+settingMethods = {'setVolume': 'volume', 'rampVolume': 'volume', 'setBass': 'bass',
+                  'setTreble': 'treble', 'setBalance': 'balance'}
+
+# Amp methods that run at scene priority unless the request says otherwise
+sceneMethods = ['applyPreset', 'rampVolume']
+
+# One connected client
+class ampDaemonHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.sendLock = threading.Lock()
+        self.subscriptions = set()
+
+    def finish(self):
+        self.server.daemon.unsubscribe(self)
+        super().finish()
+
+    def handle(self):
+        daemon = self.server.daemon
+        while True:
+            try:
+                line = self.rfile.readline()
+            except OSError:
+                break
+            if len(line) == 0:
+                break
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('not an object')
+            except ValueError:
+                self.send({'id': None, 'result': [False, 'Bad request']})
+                continue
+            try:
+                result = daemon.handleRequest(self, request)
+            except (TypeError, ValueError, KeyError) as e:
+                # wrong number or kind of params - the client hears about it,
+                # and the connection stays up
+                result = (False, "Bad request: " + str(e))
+            except OSError as e:
+                # e.g. the config file couldn't be saved
+                result = (False, str(e))
+            self.send({'id': request.get('id'), 'result': list(result)})
+
+    # Send one JSON message, replies and events can come from different threads
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        with self.sendLock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                return False
+        return True
+
+class ampDaemonServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class ampDaemonUnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+class ampDaemon:
+
+    # Constructor - serve the amps of a multiAmpController (by default, every
+    # amp config in configPath) on address:port, and on a Unix socket if
+    # unixPath is given
+    def __init__(self, controller=None, address='127.0.0.1', port=defaultDaemonPort,
+                 unixPath=None, configPath="configs"):
+        if controller == None:
+            controller = multiAmpController(configPath)
+        self.controller = controller
+        self.address = address
+        self.port = port
+        self.unixPath = unixPath
+        self.servers = []
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+        for name in controller.getAmpNames():
+            self.watchAmp(name)
+
+    # Pass the amp's state and connection changes on to subscribed clients
+    def watchAmp(self, name):
+        def stateChanged(key, oldValue, newValue, origin):
+            self.publish(name, {'event': 'state', 'amp': name, 'key': key,
+                                'value': newValue, 'origin': origin})
+
+        def connectionChanged(connected, message):
+            self.publish(name, {'event': 'connection', 'amp': name,
+                                'connected': connected, 'message': message})
+
+        # the config file was changed, clients need to fetch it again
+        def configChanged(ret, changed):
+            if ret:
+                self.publish(name, {'event': 'config', 'amp': name, 'changed': changed})
+
+        self.controller.getAmp(name).state.addCallback(stateChanged)
+        self.controller.getWorker(name).setConnectionCallback(connectionChanged)
+        self.controller.getWorker(name).setConfigCallback(configChanged)
+
+    def publish(self, name, event):
+        with self.lock:
+            subscribers = [s for s in self.subscribers if name in s.subscriptions]
+        for subscriber in subscribers:
+            subscriber.send(event)
+
+    def subscribe(self, handler, name):
+        handler.subscriptions.add(name)
+        with self.lock:
+            if handler not in self.subscribers:
+                self.subscribers.append(handler)
+
+    def unsubscribe(self, handler):
+        with self.lock:
+            if handler in self.subscribers:
+                self.subscribers.remove(handler)
+
+    # Connect to the amps and start listening. With port=0 the OS picks a free
+    # port, which is then available as self.port.
+    def start(self):
+        self.controller.start()
+        server = ampDaemonServer((self.address, self.port), ampDaemonHandler)
+        self.port = server.server_address[1]
+        self.servers.append(server)
+        if self.unixPath != None:
+            if os.path.exists(self.unixPath):
+                os.unlink(self.unixPath)
+            self.servers.append(ampDaemonUnixServer(self.unixPath, ampDaemonHandler))
+        for server in self.servers:
+            server.daemon = self
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+        if self.unixPath != None and os.path.exists(self.unixPath):
+            os.unlink(self.unixPath)
+        self.controller.stop()
+
+    # Work out the result of one request, returns a (ret, value) tuple
+    def handleRequest(self, handler, request):
+        method = request.get('method')
+        params = request.get('params', [])
+        if not isinstance(params, list):
+            return (False, "params must be a list")
+
+        if method == 'amps':
+            return (True, {'amps': self.controller.getAmpNames(),
+                           'default': self.controller.getDefaultAmpName()})
+
+        name = request.get('amp')
+        if name == None:
+            name = self.controller.getDefaultAmpName()
+        amp = self.controller.getAmp(name)
+        if amp == None:
+            return (False, "Unknown amp: " + str(name))
+        worker = self.controller.getWorker(name)
+
+        if method == 'state':
+            return (True, {'values': amp.state.snapshot(), 'connected': amp.isConnected()})
+        if method == 'subscribe':
+            self.subscribe(handler, name)
+            return (True, name)
+        if method == 'config':
+            return (True, amp.configData)
+        if method == 'updateConfig':
+            return self.updateConfig(name, *params)
+        if method in settingMethods:
+            (ret, message) = self.checkSetting(amp, settingMethods[method], params)
+            if not ret:
+                return (ret, message)
+        if method in configMethods:
+            result = getattr(amp, method)(*params)
+            if method in resultMethods:
+                return result
+            return (True, result)
+
+        # the amp isn't there, don't keep the client waiting for a reconnect
+        if not amp.isConnected():
+            return (False, "Not connected")
+        priority = priorityScene if method in sceneMethods else priorityInteractive
+        if 'priority' in request:
+            if request['priority'] not in priorityNames:
+                return (False, "Unknown priority: " + str(request['priority']))
+            priority = priorityNames[request['priority']]
+        # the amp's history says which client sent what
+        origin = 'daemon'
+        if 'origin' in request:
+            origin = 'daemon:' + str(request['origin'])
+        if method == 'exchange':
+            return worker.call(worker.runAs, origin, self.exchangeJob, amp, *params, priority=priority)
+        if method == 'transmit':
+            return worker.call(worker.runAs, origin, self.transmitJob, amp, *params, priority=priority)
+        if method == 'rampVolume':
+            # ramps are cancelled by the next one, whoever starts it
+            pending = pendingCall()
+            worker.submitRamp(*params, callback=pending, priority=priority, origin=origin)
+            return pending.wait()
+        if method in configWriteMethods:
+            # the worker owns the config, and the other clients want to know
+            # if it's changed
+            key = configWriteMethods[method]
+            old = json.dumps(amp.configData.get(key), sort_keys=True)
+            result = worker.call(getattr(amp, method), *params, priority=priority)
+            if result[0] and json.dumps(amp.configData.get(key), sort_keys=True) != old:
+                self.publish(name, {'event': 'config', 'amp': name, 'changed': [key]})
+            return result
+        if method in ampMethods:
+            return worker.call(worker.runAs, origin, getattr(amp, method), *params, priority=priority)
+        return (False, "Unknown method: " + str(method))
+
+    # Raw protocol access for ampRemote's amplifierConfig, these run on the
+    # amp's worker thread
+    def exchangeJob(self, amp, payload, expectTerms=None, doLoop=True, adaptive=True):
+        return (True, amp.exchange(payload, expectTerms, doLoop, adaptive))
+
+    def transmitJob(self, amp, payload):
+        amp.transmit(payload, 'reply')
+        return (True, None)
+
+    # Take a changed config from a client (e.g. a new address from the GUI's
+    # settings dialog), saving it to the config file if asked to
+    def updateConfig(self, name, configData, save=False):
+        amp = self.controller.getAmp(name)
+        (ret, message) = validateConfig(configData)
+        if not ret:
+            return (False, "Invalid configuration: " + message)
+        # the worker owns the config - and it's still there if the amp isn't
+        worker = self.controller.getWorker(name)
+        pending = pendingCall()
+        worker.submitConfigJob(self.updateConfigJob, amp, configData, save, callback=pending)
+        (ret, result) = pending.wait()
+        if not ret:
+            return (ret, result)
+        (changed, saved) = result
+        if 'address' in changed or 'port' in changed:
+            worker.restartConnection()
+        if len(changed) > 0:
+            self.publish(name, {'event': 'config', 'amp': name, 'changed': changed})
+        return saved
+
+    # Runs on the amp's worker thread, see updateConfig
+    def updateConfigJob(self, amp, configData, save):
+        changed = amp.applyConfig(configData)
+        saved = amp.saveConfig() if save else (True, "Updated")
+        return (True, (changed, saved))
+
+    # Check a setting's value from a client before it goes anywhere near the
+    # amp - an int in the config's range for it
+    def checkSetting(self, amp, key, params):
+        if len(params) == 0:
+            return (False, "Missing value for " + key)
+        value = params[0]
+        if not isinstance(value, int) or isinstance(value, bool):
+            return (False, "Invalid value for " + key + ": " + str(value))
+        low, high = settingRange(amp.configData, key)
+        if value < low or value > high:
+            return (False, key.capitalize() + " must be between " + str(low) + " and " + str(high))
+        return (True, value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Share the amp connections with local clients')
+    parser.add_argument('--configs', default='configs', help='directory with the amp configs')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=defaultDaemonPort)
+    parser.add_argument('--unix', help='also listen on this Unix socket')
+    args = parser.parse_args()
+
+    daemon = ampDaemon(None, args.address, args.port, args.unix, args.configs)
+    if len(daemon.controller.getAmpNames()) == 0:
+        print('No amp configs found in ' + args.configs)
+        return 1
+    daemon.start()
+    print('Serving ' + ', '.join(daemon.controller.getAmpNames()) + ' on ' + args.address + ':' + str(daemon.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    daemon.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import sys
+import socket
+import asyncio
+import argparse
+import ipaddress
+from ampConfig import replyFramer
+
+# Find Rotel amps on the LAN, so nobody has to look up the amp's address (or
+# pin it with a DHCP lease). Every host on the subnet is probed at the same
+# time - a few hundred connection attempts in flight, each with a short
+# deadline - on the amp's port, and anything that accepts the connection is
+# asked for its power state and source. Only hosts that answer like an amp
+# are returned, so a /24 is done in a second or two:
+#   amps = discover('192.168.1.0/24')
+#   [{'address': '192.168.1.40', 'port': 9596, 'power': 'on', 'source': 'cd'}]
+#
+# From an event loop, use 'await discoverAmps(...)' instead. It can be tried
+# out against ampSimulators listening on loopback addresses:
+#   python3 ampDiscovery.py --network 127.0.0.0/28
+
+defaultPort = 9596
+
+# The subnet this machine is on, as a /24 (the usual home network). No
+# packets are sent, connecting a UDP socket just picks the outgoing interface.
+def localNetwork():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(('10.255.255.255', 1))
+        address = sock.getsockname()[0]
+    except OSError:
+        address = '127.0.0.1'
+    finally:
+        sock.close()
+    return str(ipaddress.ip_network(address + '/24', strict=False))
+
+# Probe one host, returns its details if it answers like an amp or None
+async def probeHost(address, port, connectTimeout, replyTimeout, queries):
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(address, port), connectTimeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+
+    found = None
+    try:
+        writer.write(queries.encode('utf-8'))
+        await writer.drain()
+        # an amp in standby only answers the power query, so that's all we
+        # wait for - the source comes along with it if the amp is on
+        framer = replyFramer()
+        replies = dict()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + replyTimeout
+        while 'amp:power' not in replies or ('amp:source' not in replies and replies.get('amp:power') == 'on'):
+            wait = deadline - loop.time()
+            if wait <= 0:
+                break
+            data = await asyncio.wait_for(reader.read(1024), wait)
+            if len(data) == 0:
+                break
+            for name, value in framer.feed(data):
+                replies[name] = value
+        if 'amp:power' in replies:
+            found = {'address': address, 'port': port, 'power': replies['amp:power'],
+                     'source': replies.get('amp:source')}
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+    return found
+
+# Probe every host in 'network' (e.g. '192.168.1.0/24', the local /24 by
+# default) or the given list of 'hosts', at most 'concurrency' at a time.
+# Returns the amps found, in address order.
+async def discoverAmps(network=None, port=defaultPort, hosts=None, concurrency=256,
+                       connectTimeout=0.5, replyTimeout=0.5, queries='amp:power?amp:source?'):
+    if hosts == None:
+        if network == None:
+            network = localNetwork()
+        hosts = [str(host) for host in ipaddress.ip_network(network, strict=False).hosts()]
+    limit = asyncio.Semaphore(concurrency)
+
+    async def probe(address):
+        async with limit:
+            return await probeHost(address, port, connectTimeout, replyTimeout, queries)
+
+    results = await asyncio.gather(*[probe(address) for address in hosts])
+    return [found for found in results if found != None]
+
+# Blocking version of discoverAmps, for code that isn't running an event loop
+def discover(network=None, port=defaultPort, hosts=None, concurrency=256,
+             connectTimeout=0.5, replyTimeout=0.5, queries='amp:power?amp:source?'):
+    return asyncio.run(discoverAmps(network, port, hosts, concurrency, connectTimeout, replyTimeout, queries))
+
+# Discover with the port and queries from an amplifierConfig
+def discoverForConfig(ampConfig, network=None, **options):
+    queries = ampConfig.configData['queries']
+    return discover(network, ampConfig.getPort(), queries=queries['power'] + queries['source'], **options)
+
+def main():
+    parser = argparse.ArgumentParser(description='Find Rotel amps on the network')
+    parser.add_argument('--network', help='subnet to search, e.g. 192.168.1.0/24 (default: the local /24)')
+    parser.add_argument('--port', type=int, default=defaultPort)
+    parser.add_argument('--concurrency', type=int, default=256, help='hosts probed at the same time')
+    parser.add_argument('--timeout', type=float, default=0.5, help='connect and reply deadline in seconds')
+    args = parser.parse_args()
+
+    network = args.network if args.network != None else localNetwork()
+    print('Searching ' + network + ' on port ' + str(args.port))
+    amps = discover(network, args.port, concurrency=args.concurrency,
+                    connectTimeout=args.timeout, replyTimeout=args.timeout)
+    for amp in amps:
+        print(amp['address'] + ':' + str(amp['port']) + ' power=' + str(amp['power']) + ' source=' + str(amp['source']))
+    if len(amps) == 0:
+        print('No amps found')
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
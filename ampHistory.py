@@ -0,0 +1,208 @@
+import json
+import time
+import queue
+import sqlite3
+import threading
+from ampTimeout import operationName
+
+# On-disk history of everything that happened to the amps, to answer "who
+# turned it up to 80 at 2 a.m." and to see how the amps actually get used.
+# With a history set (amplifierConfig.setHistory, or a "history" section in
+# the amp's config) every state change is recorded with its old and new value
+# and origin ('optimistic' for what we expect a command to do, 'reply' for the
+# amp's answers, 'update' for the front panel and IR remote), and so is every
+# request we send the amp, with who sent it ('gui', 'cli', 'daemon:gui'...,
+# see amplifierConfig.setRequestOrigin):
+#   "history": {"file": "rotel_history.db", "max_rows": 1000000}
+#
+# Recording just puts the event on a queue, a writer thread stores them in a
+# SQLite database in batches - whatever came in over a second, one transaction
+# per batch - so it costs the protocol code next to nothing. If the writer
+# can't keep up (slow disk) the queue fills up and new events are dropped and
+# counted rather than holding up the amp. Once there are more than max_rows
+# events the oldest are deleted (every few batches, so there can be a few
+# thousand more for a while), and neither memory use nor the file grows
+# without limit.
+#
+# query() searches by time, key and amp:
+#   history.query(start=time.time() - 86400, key='volume')
+#   [{'time': 1760000000.1, 'amp': 'Rotel A14 mkII', 'kind': 'state', 'key': 'volume',
+#     'old': 30, 'new': 80, 'origin': 'update'}, ...]
+
+schema = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    amp TEXT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    old,
+    new,
+    origin TEXT
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE INDEX IF NOT EXISTS events_key_time ON events (key, time);
+"""
+
+# Values the state cache holds are ints and strings, which SQLite stores as
+# they are - anything else is stored as JSON
+def storedValue(value):
+    if value == None or isinstance(value, (int, float, str)):
+        return value
+    return json.dumps(value)
+
+class ampHistory:
+
+    # Constructor - 'dbFile' is the SQLite database, created if needed
+    def __init__(self, dbFile, maxRows=1000000, queueSize=10000, batchSize=500, flushInterval=1.0):
+        self.dbFile = dbFile
+        self.maxRows = maxRows
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.events = queue.Queue(maxsize=queueSize)
+        self.dropped = 0
+        self.written = 0
+
+        db = self.openDatabase()
+        db.executescript(schema)
+        db.close()
+
+        self.writer = threading.Thread(target=self.writeLoop, daemon=True)
+        self.writer.start()
+
+    # Build a history from a config's "history" section
+    @staticmethod
+    def fromConfig(historyConfig):
+        if not isinstance(historyConfig, dict):
+            historyConfig = dict()
+        return ampHistory(historyConfig.get('file', 'rotel_history.db'), historyConfig.get('max_rows', 1000000))
+
+    def openDatabase(self):
+        db = sqlite3.connect(self.dbFile, timeout=10)
+        # readers (query) don't have to wait for the writer
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    # Record one event, never blocks - if the writer has fallen behind the
+    # event is dropped
+    def record(self, amp, kind, key, oldValue, newValue, origin):
+        try:
+            self.events.put_nowait((time.time(), amp, kind, key, storedValue(oldValue),
+                                    storedValue(newValue), origin))
+        except queue.Full:
+            self.dropped += 1
+
+    # A state cache change, as passed to ampState callbacks
+    def recordState(self, amp, key, oldValue, newValue, origin):
+        self.record(amp, 'state', key, oldValue, newValue, origin)
+
+    # A request sent to the amp, stored under its operation name (the request
+    # without its arguments, see ampTimeout.operationName)
+    def recordRequest(self, amp, payload, origin):
+        self.record(amp, 'request', operationName(payload), None, payload, origin)
+
+    # Writer thread: store events in batches, trimming the oldest ones now
+    # and then. A None on the queue stops it, a threading.Event is set once
+    # everything before it has been written (see flush).
+    def writeLoop(self):
+        db = self.openDatabase()
+        batches = 0
+        running = True
+        while running:
+            try:
+                event = self.events.get(timeout=self.flushInterval)
+            except queue.Empty:
+                continue
+            batch = []
+            waiting = []
+            # collect events for a while rather than write each one as it
+            # comes, unless someone's waiting for them
+            deadline = time.monotonic() + self.flushInterval
+            while True:
+                if event == None:
+                    running = False
+                elif isinstance(event, threading.Event):
+                    waiting.append(event)
+                else:
+                    batch.append(event)
+                wait = deadline - time.monotonic()
+                if not running or len(waiting) > 0 or len(batch) >= self.batchSize or wait <= 0:
+                    break
+                try:
+                    event = self.events.get(timeout=wait)
+                except queue.Empty:
+                    break
+            if len(batch) > 0:
+                try:
+                    with db:
+                        db.executemany('INSERT INTO events (time, amp, kind, key, old, new, origin) '
+                                       'VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+                    self.written += len(batch)
+                    batches += 1
+                    if batches % 20 == 0:
+                        self.trim(db)
+                except sqlite3.Error:
+                    # disk full, locked for too long... lose the batch
+                    # rather than the thread
+                    self.dropped += len(batch)
+            for flushed in waiting:
+                flushed.set()
+        self.trim(db)
+        db.close()
+
+    # Delete the oldest events beyond maxRows. The ids only go up, so this is
+    # a range delete on the primary key.
+    def trim(self, db):
+        try:
+            with db:
+                db.execute('DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?', (self.maxRows,))
+        except sqlite3.Error:
+            pass
+
+    # Wait until everything recorded so far has been written
+    def flush(self, timeout=5):
+        flushed = threading.Event()
+        try:
+            self.events.put(flushed, timeout=timeout)
+        except queue.Full:
+            return False
+        return flushed.wait(timeout)
+
+    # Write what's still queued and stop the writer
+    def close(self, timeout=5):
+        if not self.writer.is_alive():
+            return
+        try:
+            self.events.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.writer.join(timeout)
+
+    # Events between 'start' and 'end' (seconds since the epoch, either can be
+    # None), optionally only for one key/amp/kind, oldest first - or the most
+    # recent 'limit' of them if there are more
+    def query(self, start=None, end=None, key=None, amp=None, kind=None, limit=1000):
+        conditions = []
+        params = []
+        for column, op, value in (('time', '>=', start), ('time', '<=', end), ('key', '=', key),
+                                  ('amp', '=', amp), ('kind', '=', kind)):
+            if value != None:
+                conditions.append(column + ' ' + op + ' ?')
+                params.append(value)
+        sql = 'SELECT time, amp, kind, key, old, new, origin FROM events'
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY id DESC LIMIT ?'
+        params.append(limit)
+        db = self.openDatabase()
+        try:
+            rows = db.execute(sql, params).fetchall()
+        finally:
+            db.close()
+        columns = ['time', 'amp', 'kind', 'key', 'old', 'new', 'origin']
+        return [dict(zip(columns, row)) for row in reversed(rows)]
+
+    # How the recording is going
+    def stats(self):
+        return {'written': self.written, 'dropped': self.dropped, 'queued': self.events.qsize()}
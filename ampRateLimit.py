@@ -0,0 +1,48 @@
+import time
+
+# Token bucket for the requests we send an amp. Some firmware is known to drop
+# or ignore commands when it gets too many of them too quickly, so with a
+# "rate_limit" section in the amp's config amplifierConfig waits here before
+# every send. It's off unless the config has one, and it holds up everything
+# we send including a dragged slider's updates, so only add one for an amp
+# that needs it:
+#   "rate_limit": {"rate": 25, "burst": 10}
+# lets through bursts of up to 10 requests back to back, and 25 a second on
+# average after that. The bucket starts full, and refills at 'rate' tokens a
+# second up to 'burst'.
+#
+# Only the amp's worker sends, so waiting here holds up that one thread - the
+# worker's queue decides what goes next (see ampWorker's priorities).
+
+class tokenBucket:
+
+    # Constructor - 'rate' requests a second, 'burst' at most in one go
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take a token if there is one, without waiting
+    def tryAcquire(self):
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    # Take a token, waiting for one if need be. Returns how long we waited.
+    def acquire(self):
+        self.refill()
+        waited = 0.0
+        if self.tokens < 1:
+            waited = (1 - self.tokens) / self.rate
+            time.sleep(waited)
+            self.refill()
+        self.tokens -= 1
+        return waited
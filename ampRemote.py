@@ -0,0 +1,359 @@
+import json
+import time
+import queue
+import socket
+import threading
+from ampConfig import amplifierConfig
+from ampWorker import pendingCall
+
+# Client side of ampDaemon. ampDaemonClient speaks the daemon's JSON protocol,
+# for scripts that just want to call amp methods or read the state cache:
+#   client = ampDaemonClient()
+#   client.connect()
+#   client.call('setVolume', 30)
+#   (ret, state) = client.call('state', amp='Rotel A14 mkII fw3_08')
+#
+# remoteAmplifierConfig is an amplifierConfig whose connection goes through
+# the daemon instead of straight to the amp. Everything built on exchange()
+# (queries, commands, batches, presets, ramps ...) works as usual, and its
+# state cache is filled from the daemon's and kept current with the daemon's
+# state events - so the GUI runs on it unchanged.
+
+defaultDaemonAddress = '127.0.0.1:9597'
+
+class ampDaemonClient:
+
+    # Constructor - 'address' is host:port, or the path of a Unix socket
+    def __init__(self, address=defaultDaemonAddress, timeout=60):
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+        self.connected = False
+        self.nextId = 1
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.sendLock = threading.Lock()
+        self.readerThread = None
+        # state/connection events we've subscribed to, per amp name
+        self.events = dict()
+        # passed on with every request for the daemon's history, e.g. 'gui'
+        self.origin = None
+
+    def connect(self):
+        try:
+            if '/' in self.address:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.address)
+            else:
+                host, port = self.address.rsplit(':', 1)
+                self.sock = socket.create_connection((host, int(port)), 5)
+                self.sock.settimeout(None)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (OSError, ValueError) as e:
+            self.sock = None
+            return (False, "Could not connect to daemon at " + self.address + ": " + str(e))
+        self.connected = True
+        self.readerThread = threading.Thread(target=self.readLoop, args=(self.sock,), daemon=True)
+        self.readerThread.start()
+        return (True, "Success")
+
+    def isConnected(self):
+        return self.connected
+
+    def close(self):
+        if self.sock != None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+        self.sock = None
+        self.connected = False
+
+    # Background thread: hand replies to their callers and queue up events
+    def readLoop(self, sock):
+        reader = sock.makefile('rb')
+        while True:
+            try:
+                line = reader.readline()
+            except (OSError, ValueError):
+                break
+            if len(line) == 0:
+                break
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if 'event' in message:
+                self.eventQueue(message.get('amp')).put(message)
+                continue
+            with self.lock:
+                call = self.pending.pop(message.get('id'), None)
+            if call != None:
+                call.set(tuple(message.get('result', [False, "Bad reply"])))
+        self.connected = False
+        # nobody is going to answer the calls still waiting
+        with self.lock:
+            calls = list(self.pending.values())
+            self.pending = dict()
+        for call in calls:
+            call.set((False, "Connection to daemon lost"))
+
+    def eventQueue(self, name):
+        with self.lock:
+            if name not in self.events:
+                self.events[name] = queue.Queue()
+            return self.events[name]
+
+    # Call a daemon method and wait for its (ret, value) result. Safe to use
+    # from several threads at once. 'priority' is the name of the daemon's
+    # job priority for amp methods ('interactive', 'scene' or 'polling').
+    def call(self, method, *params, amp=None, timeout=None, priority=None):
+        if not self.connected:
+            return (False, "Not connected to daemon")
+        call = pendingCall()
+        with self.lock:
+            requestId = self.nextId
+            self.nextId += 1
+            self.pending[requestId] = call
+        request = {'id': requestId, 'method': method, 'params': list(params)}
+        if amp != None:
+            request['amp'] = amp
+        if priority != None:
+            request['priority'] = priority
+        if self.origin != None:
+            request['origin'] = self.origin
+        sock = self.sock
+        if sock == None:
+            return (False, "Not connected to daemon")
+        try:
+            with self.sendLock:
+                sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        except OSError as e:
+            with self.lock:
+                self.pending.pop(requestId, None)
+            self.close()
+            return (False, str(e))
+        return call.wait(timeout if timeout != None else self.timeout)
+
+    # Wait up to 'timeout' seconds for the next event for an amp (None if
+    # there isn't one), after a 'subscribe' call for that amp
+    def nextEvent(self, name, timeout=0):
+        try:
+            if timeout > 0:
+                return self.eventQueue(name).get(timeout=timeout)
+            return self.eventQueue(name).get_nowait()
+        except queue.Empty:
+            return None
+
+class remoteAmplifierConfig(amplifierConfig):
+
+    # Constructor - the amp called 'ampName' on the daemon at 'address' (the
+    # daemon's default amp if ampName is None). The config is fetched from the
+    # daemon when we connect.
+    def __init__(self, ampName=None, address=defaultDaemonAddress, client=None):
+        super().__init__(None)
+        self.client = client if client != None else ampDaemonClient(address)
+        self.ampName = ampName
+        # set when the daemon tells us the config changed, see reloadIfChanged
+        self.configChanged = False
+        if not self.client.isConnected():
+            self.client.connect()
+        if self.ampName == None:
+            (ret, amps) = self.client.call('amps')
+            if ret:
+                self.ampName = amps['default']
+        self.loadConfig()
+
+    # Take the amp's config from the daemon
+    def loadConfig(self):
+        (ret, configData) = self.client.call('config', amp=self.ampName)
+        if not ret or not isinstance(configData, dict):
+            self.configValid = False
+            return (False, configData)
+        self.configData = configData
+        self.configName = configData.get('name')
+        self.configValid = True
+        self.buildIndexes()
+        return (True, self.configName)
+
+    # The daemon records what we send as coming from 'daemon:' + origin
+    def setRequestOrigin(self, origin):
+        self.requestOrigin = origin
+        self.client.origin = origin
+
+    # "Connecting" means making sure the daemon is connected to the amp, and
+    # picking up its state cache and state events
+    def connect(self):
+        if not self.client.isConnected():
+            (ret, message) = self.client.connect()
+            if not ret:
+                return (False, message)
+            # we'd have missed any config events while we were gone
+            self.configChanged = True
+        if not self.configValid:
+            (ret, message) = self.loadConfig()
+            if not ret:
+                return (False, message)
+        (ret, message) = self.client.call('subscribe', amp=self.ampName)
+        if not ret:
+            return (False, message)
+        (ret, state) = self.client.call('state', amp=self.ampName)
+        if not ret:
+            return (False, state)
+        if not state['connected']:
+            return (False, "Daemon is not connected to the amp")
+        # throw away state events from before our snapshot (but not the news
+        # that the config changed)
+        self.eventReplies()
+        self.state.clear()
+        for key, value in state['values'].items():
+            self.state.update(key, value, 'update')
+        self.connected = True
+        return (True, "Success")
+
+    # The client connection goes too, connect() opens a new one
+    def close(self):
+        self.connected = False
+        self.framer.reset()
+        self.client.close()
+
+    # The daemon sends state changes rather than the amp's replies, so turn
+    # events back into (reply term, value) pairs for recordReplies - values
+    # are already converted, which the state cache takes as they are
+    def eventReplies(self, timeout=0):
+        replies = []
+        event = self.client.nextEvent(self.ampName, timeout)
+        while event != None:
+            if event['event'] == 'state':
+                term = self.queryTerm(event['key'])
+                if term != None:
+                    replies.append((term, event['value']))
+            elif event['event'] == 'connection' and not event['connected']:
+                self.connected = False
+            elif event['event'] == 'config':
+                self.configChanged = True
+            event = self.client.nextEvent(self.ampName)
+        return replies
+
+    def drainInput(self):
+        replies = self.eventReplies()
+        if not self.client.isConnected():
+            self.connected = False
+        return replies
+
+    # Wait for state events instead of reading the amp's socket, same rules
+    # as amplifierConfig.readReplies
+    def readReplies(self, expectTerms=None, doLoop=True):
+        replies = []
+        pending = None
+        if expectTerms != None:
+            pending = list(expectTerms)
+        deadline = time.monotonic() + self.configData['timeout']
+        while True:
+            if pending != None and len(pending) == 0:
+                break
+            if pending == None and doLoop == False and len(replies) > 0:
+                break
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                break
+            for name, value in self.eventReplies(wait):
+                replies.append((name, value))
+                if pending != None and name in pending:
+                    pending.remove(name)
+                # go on waiting the full timeout after each reply
+                deadline = time.monotonic() + self.configData['timeout']
+        return replies
+
+    def pollUpdates(self, timeout=0):
+        if not self.connected:
+            return []
+        replies = self.eventReplies(timeout)
+        if not self.client.isConnected():
+            self.connected = False
+        self.recordReplies(replies, 'update')
+        return replies
+
+    # The daemon's worker does the actual exchange with the amp
+    def exchange(self, payload, expectTerms=None, doLoop=True, adaptive=True):
+        self.recordReplies(self.drainInput(), 'update')
+        if not self.connected:
+            raise ConnectionResetError("Not connected to the amp")
+        self.noteSent(payload)
+        (ret, replies) = self.client.call('exchange', payload, expectTerms, doLoop, adaptive)
+        if not ret:
+            self.connected = False
+            raise ConnectionResetError(replies)
+        replies = [(name, value) for name, value in replies]
+        # the daemon has sent us state events for these replies already, pass
+        # on anything else that came in (front panel changes etc.) as updates
+        ours = self.mapQueryReplies(replies)
+        others = []
+        for name, value in self.eventReplies():
+            key = self.replyIndex.get(name)
+            if key in ours:
+                continue
+            others.append((name, value))
+        self.recordReplies(others, 'update')
+        self.recordReplies(replies, 'reply')
+        return replies
+
+    def transmit(self, payload, origin='update'):
+        self.recordReplies(self.drainInput(), origin)
+        if not self.connected:
+            raise ConnectionResetError("Not connected to the amp")
+        self.noteSent(payload)
+        (ret, message) = self.client.call('transmit', payload)
+        if not ret:
+            self.connected = False
+            raise ConnectionResetError(message)
+
+    # The daemon watches the config file, we just fetch the config again when
+    # it says it changed. The daemon reconnects to the amp if the address
+    # changed, our connection to the daemon stays as it is.
+    def reloadIfChanged(self):
+        if not self.configChanged or not self.client.isConnected():
+            return (True, [])
+        (ret, configData) = self.client.call('config', amp=self.ampName)
+        if not ret or not isinstance(configData, dict):
+            # try again next time
+            return (True, [])
+        self.configChanged = False
+        changed = self.applyConfig(configData)
+        return (True, [key for key in changed if key not in ('address', 'port')])
+
+    # Tracing and history are the daemon's business, we don't start a
+    # transcript or a history database of our own
+    def startRecorders(self, keys=('trace', 'history')):
+        pass
+
+    # The daemon keeps the history
+    def getHistory(self, start=None, end=None, key=None, limit=1000):
+        return self.client.call('getHistory', start, end, key, limit, amp=self.ampName)
+
+    # Config changes go to the daemon, which owns the config file
+    def setName(self, newname):
+        super().setName(newname)
+        self.client.call('updateConfig', self.configData, False, amp=self.ampName)
+
+    def setAddress(self, newaddress):
+        super().setAddress(newaddress)
+        self.client.call('updateConfig', self.configData, False, amp=self.ampName)
+
+    def saveConfig(self):
+        return self.client.call('updateConfig', self.configData, True, amp=self.ampName)
+
+    # The preset is made from our state cache, the daemon writes it
+    def storePreset(self, name, values=None):
+        (ret, values) = self.savePreset(name, values)
+        if not ret:
+            return (ret, values)
+        return self.client.call('storePreset', name, values, amp=self.ampName)
+
+    # What we find out about a source goes to the daemon's config too
+    def setSourceCapability(self, sourceId, capability, value):
+        (ret, message) = super().setSourceCapability(sourceId, capability, value)
+        if not ret:
+            return (ret, message)
+        return self.client.call('setSourceCapability', sourceId, capability, value, amp=self.ampName)
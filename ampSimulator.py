@@ -0,0 +1,335 @@
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+import socketserver
+from ampConfig import formatToneValue, formatBalanceValue
+from ampState import parseToneValue, parseBalanceValue
+
+# A stand-in for a Rotel amp on the LAN, for testing and benchmarking without
+# the real thing. It speaks the IP protocol as described in the README:
+#   - 'amp:...!' commands change a setting, the amp answers with the new value
+#   - 'amp:...?' queries answer with 'amp:name=value$'
+#   - switching to a digital input also sends the input's frequency
+#   - inputs with a fixed volume silently ignore 'amp:vol_##!'
+#   - in standby only the power commands and 'amp:power?' get an answer
+#   - front panel/remote changes (see frontPanel) are pushed to every client
+#
+# Network conditions can be made worse on purpose: 'latency' and 'jitter' delay
+# every reply, 'fragment' splits replies into pieces of that many bytes.
+#
+# Run it on its own with e.g.
+#   python3 ampSimulator.py --port 9596 --latency 0.01 --fragment 4
+# and point a config's address at 127.0.0.1, or use it from a script:
+#   sim = ampSimulator(port=0)
+#   sim.start()
+#   ... connect to ('127.0.0.1', sim.port) ...
+#   sim.stop()
+
+# Inputs that report a sample rate, and the one we pretend they're receiving
+digitalSources = ['coax1', 'coax2', 'opt1', 'opt2', 'usb', 'pcusb', 'bluetooth']
+digitalFrequency = '44.1'
+
+# One connected client
+class ampSimulatorHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.sendLock = threading.Lock()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.sim.addClient(self)
+
+    def finish(self):
+        self.server.sim.removeClient(self)
+
+    # Read commands/queries until the client goes away. Requests aren't
+    # separated by anything, they just end in '!' or '?'.
+    def handle(self):
+        sim = self.server.sim
+        buffer = ''
+        while True:
+            try:
+                data = self.request.recv(1024)
+            except OSError:
+                break
+            if len(data) == 0:
+                break
+            sim.countBytes(len(data), 0)
+            buffer += data.decode('utf-8', errors='replace')
+            # everything that came in one packet is answered in one go, so
+            # the simulated latency applies once per packet like a real network
+            replies = []
+            while True:
+                ends = [i for i in (buffer.find('!'), buffer.find('?')) if i >= 0]
+                if len(ends) == 0:
+                    break
+                end = min(ends)
+                request = buffer[:end + 1]
+                buffer = buffer[end + 1:]
+                replies += sim.handleRequest(request)
+            if len(replies) > 0:
+                sim.delay()
+                self.send(replies)
+
+    # Send a list of (name, value) replies, fragmented if we've been asked to
+    def send(self, replies):
+        sim = self.server.sim
+        payload = ''.join(name + '=' + value + '$' for name, value in replies).encode('utf-8')
+        with self.sendLock:
+            try:
+                if sim.fragment > 0:
+                    for i in range(0, len(payload), sim.fragment):
+                        self.request.sendall(payload[i:i + sim.fragment])
+                        time.sleep(0.001)
+                else:
+                    self.request.sendall(payload)
+            except OSError:
+                return
+        sim.countBytes(0, len(payload))
+
+class ampSimulatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class ampSimulator:
+
+    # Constructor - configFile gives the list of sources and the volume range,
+    # the rest sets up the simulated network conditions and amp behaviour.
+    def __init__(self, configFile=None, address='127.0.0.1', port=9596, latency=0.0,
+                 jitter=0.0, fragment=0, fixedSources=None, powerOnDelay=0.0, power='on'):
+        self.address = address
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.fragment = fragment
+        self.powerOnDelay = powerOnDelay
+        self.fixedSources = fixedSources if fixedSources != None else []
+
+        self.sources = ['cd', 'coax1', 'coax2', 'opt1', 'opt2', 'aux1', 'aux2',
+                        'tuner', 'phono', 'usb', 'bluetooth', 'pcusb']
+        self.volumeMin = 0
+        self.volumeMax = 96
+        if configFile != None:
+            with open(configFile, 'r') as file:
+                data = json.load(file)
+            self.sources = list(data['sources'].keys())
+            self.volumeMin = data.get('volume_min', self.volumeMin)
+            self.volumeMax = data.get('volume_max', self.volumeMax)
+
+        # the amp's settings, values are kept the way the amp reports them
+        self.state = {
+            'power': power,
+            'source': self.sources[0],
+            'volume': 20,
+            'mute': 'off',
+            'bass': 0,
+            'treble': 0,
+            'balance': 0,
+            'bypass': 'on',
+        }
+        self.fixedVolume = 50
+        self.updatesOn = True
+        self.lock = threading.Lock()
+        self.clients = []
+        self.server = None
+        self.thread = None
+
+        # traffic counters, handy for benchmarks
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.requests = 0
+
+    # Start listening on a background thread. With port=0 the OS picks a free
+    # port, which is then available as self.port.
+    def start(self):
+        self.server = ampSimulatorServer((self.address, self.port), ampSimulatorHandler)
+        self.server.sim = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            # serve_forever is done, but clients may still be connected
+            for client in list(self.clients):
+                try:
+                    client.request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.server = None
+
+    def addClient(self, client):
+        with self.lock:
+            self.clients.append(client)
+
+    def removeClient(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def countBytes(self, bytesIn, bytesOut):
+        with self.lock:
+            self.bytesIn += bytesIn
+            self.bytesOut += bytesOut
+
+    # Wait out the simulated network latency
+    def delay(self):
+        wait = self.latency
+        if self.jitter > 0:
+            wait += random.uniform(0, self.jitter)
+        if wait > 0:
+            time.sleep(wait)
+
+    # Current value of a setting, formatted the way the amp sends it
+    def formatValue(self, key):
+        if key == 'volume':
+            if self.state['source'] in self.fixedSources:
+                return str(self.fixedVolume)
+            return str(self.state['volume']).zfill(2)
+        if key == 'bass' or key == 'treble':
+            return formatToneValue(self.state[key])
+        if key == 'balance':
+            return formatBalanceValue(self.state[key])
+        if key == 'freq':
+            if self.state['source'] in digitalSources:
+                return digitalFrequency
+            return 'off'
+        return self.state[key]
+
+    def reply(self, key):
+        return ('amp:' + key, self.formatValue(key))
+
+    # Change a setting as if the front panel or the IR remote had been used,
+    # and push the new value to every connected client
+    def frontPanel(self, key, value):
+        with self.lock:
+            self.state[key] = value
+            update = self.reply(key)
+            clients = list(self.clients)
+        if self.updatesOn:
+            for client in clients:
+                client.send([update])
+
+    # Work out the replies to one command or query
+    def handleRequest(self, request):
+        with self.lock:
+            self.requests += 1
+            if request == 'rs232_update_off!':
+                self.updatesOn = False
+                return []
+            if request == 'rs232_update_on!':
+                self.updatesOn = True
+                return []
+            if not request.startswith('amp:'):
+                return []
+            name = request[4:-1]
+
+            if request.endswith('?'):
+                if name == 'power':
+                    return [self.reply('power')]
+                if self.state['power'] != 'on':
+                    return []
+                if name in self.state or name == 'freq':
+                    return [self.reply(name)]
+                return []
+
+            # commands
+            if name in ('power_on', 'power_off', 'power_toggle'):
+                return self.powerCommand(name)
+            if self.state['power'] != 'on':
+                return []
+            return self.ampCommand(name)
+
+    def powerCommand(self, name):
+        if name == 'power_toggle':
+            name = 'power_off' if self.state['power'] == 'on' else 'power_on'
+        if name == 'power_off':
+            self.state['power'] = 'standby'
+            return [self.reply('power')]
+        if self.state['power'] != 'on' and self.powerOnDelay > 0:
+            # warming up - the amp says nothing until it's ready
+            threading.Timer(self.powerOnDelay, self.frontPanel, ('power', 'on')).start()
+            return []
+        self.state['power'] = 'on'
+        return [self.reply('power')]
+
+    def ampCommand(self, name):
+        if name in self.sources:
+            self.state['source'] = name
+            replies = [self.reply('source')]
+            if name in digitalSources:
+                replies.append(self.reply('freq'))
+            return replies
+
+        if name.startswith('vol_'):
+            if self.state['source'] in self.fixedSources:
+                # fixed volume inputs ignore volume changes without a reply
+                return []
+            arg = name[4:]
+            if arg == 'up':
+                volume = self.state['volume'] + 1
+            elif arg == 'down':
+                volume = self.state['volume'] - 1
+            else:
+                try:
+                    volume = int(arg)
+                except ValueError:
+                    return []
+            self.state['volume'] = max(self.volumeMin, min(self.volumeMax, volume))
+            return [self.reply('volume')]
+
+        if name in ('mute', 'mute_on', 'mute_off'):
+            if name == 'mute':
+                self.state['mute'] = 'off' if self.state['mute'] == 'on' else 'on'
+            else:
+                self.state['mute'] = name[5:]
+            return [self.reply('mute')]
+
+        if name in ('bypass_on', 'bypass_off'):
+            self.state['bypass'] = name[7:]
+            return [self.reply('bypass')]
+
+        for key in ('bass', 'treble', 'balance'):
+            if name.startswith(key + '_'):
+                arg = name[len(key) + 1:]
+                try:
+                    if key == 'balance':
+                        self.state[key] = parseBalanceValue(arg)
+                    else:
+                        self.state[key] = parseToneValue(arg)
+                except ValueError:
+                    return []
+                return [self.reply(key)]
+        return []
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated Rotel amplifier for testing')
+    parser.add_argument('--config', help='amp config file to take the sources/volume range from')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9596)
+    parser.add_argument('--latency', type=float, default=0.0, help='reply delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra reply delay in seconds')
+    parser.add_argument('--fragment', type=int, default=0, help='split replies into pieces of this many bytes')
+    parser.add_argument('--fixed', action='append', default=[], help='source with a fixed volume (repeatable)')
+    parser.add_argument('--power-on-delay', type=float, default=0.0, help='seconds to come out of standby')
+    parser.add_argument('--standby', action='store_true', help='start in standby')
+    args = parser.parse_args()
+
+    sim = ampSimulator(args.config, args.address, args.port, args.latency, args.jitter,
+                       args.fragment, args.fixed, args.power_on_delay,
+                       'standby' if args.standby else 'on')
+    sim.start()
+    print('Simulated amp listening on ' + args.address + ':' + str(sim.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+
+if __name__ == "__main__":
+    sys.exit(main())
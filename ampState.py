@@ -0,0 +1,83 @@
+import threading
+
+# Cache of the amp's last known settings. Everything the amp tells us - replies
+# to our own commands and queries as well as the updates it sends on its own
+# when the front panel or IR remote is used - goes through update(), so the
+# GUI can render from here instead of asking the amp again.
+#
+# Keys are the query names from the config file ('power', 'source', 'volume',
+# 'mute', 'bass', 'treble', 'balance', 'bypass', 'frequency'). Numeric settings
+# are converted to ints (tone and balance use the amp's +05/-05 and l05/r05
+# formats), everything else is kept as the string the amp sent.
+
+# Bass and treble come back as 000, +## or -##
+def parseToneValue(toneStr):
+    return int(toneStr)
+
+# Balance comes back as 000, l## or r## (left is negative)
+def parseBalanceValue(balStr):
+    balStr = balStr.lower()
+    if balStr.startswith('l'):
+        return -int(balStr[1:])
+    if balStr.startswith('r'):
+        return int(balStr[1:])
+    return int(balStr)
+
+valueParsers = {
+    'volume': int,
+    'bass': parseToneValue,
+    'treble': parseToneValue,
+    'balance': parseBalanceValue,
+}
+
+class ampState:
+
+    # Constructor - empty cache, no callbacks
+    def __init__(self):
+        self.values = dict()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    # Register a function to call when a value changes. It's called as
+    # callback(key, oldValue, newValue, origin) from whichever thread made the
+    # change (usually the amp worker), origin says where the value came from
+    # ('reply' for answers to our commands/queries, 'update' for unsolicited ones).
+    def addCallback(self, callback):
+        self.callbacks.append(callback)
+
+    def removeCallback(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    # Get a cached value, or the default if we haven't heard about it yet
+    def get(self, key, default=None):
+        with self.lock:
+            return self.values.get(key, default)
+
+    # Get a copy of all cached values
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    # Store a value (raw strings from the amp are converted), callbacks are
+    # only called if the value actually changed. Returns true if it changed.
+    def update(self, key, value, origin='reply'):
+        if isinstance(value, str) and key in valueParsers:
+            try:
+                value = valueParsers[key](value)
+            except ValueError:
+                # keep whatever the amp sent rather than lose it
+                pass
+        with self.lock:
+            oldValue = self.values.get(key)
+            if key in self.values and oldValue == value:
+                return False
+            self.values[key] = value
+        for callback in list(self.callbacks):
+            callback(key, oldValue, value, origin)
+        return True
+
+    # Forget everything (e.g. after losing the connection)
+    def clear(self):
+        with self.lock:
+            self.values = dict()
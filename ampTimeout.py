@@ -0,0 +1,73 @@
+import re
+import collections
+
+# Reply timeouts learned from how quickly the amp actually answers. The
+# config's "timeout" is a guess that has to cover the slowest amp on the worst
+# network, and readReplies waits that long every time it can't tell whether
+# more replies are coming - after the last reply of a command with a variable
+# number of replies, or for a command the amp ignores (fixed volume inputs).
+#
+# replyTimeouts keeps recent reply times per operation, measured from the end
+# of the send: when the first piece of the reply came in ('first') and when the
+# last one did ('last'). Once it has enough of them it waits until their 99th
+# percentile plus a margin instead of the configured timeout (which it never
+# goes over) - so after the last reply we only wait as long as this operation's
+# replies have actually been known to keep coming.
+# If a reply turns up after we stopped waiting for it (see anomaly()), the
+# operation goes back to the configured timeout until it's learned again.
+
+# A request's operation name - the protocol string with the numeric arguments
+# replaced by '#', e.g. 'amp:vol_#!' or 'amp:balance_#!'
+def operationName(payload):
+    return re.sub(r'_[lLrR+-]?\d+', '_#', payload)
+
+class replyTimeouts:
+
+    # Constructor - 'fallback' is the configured timeout in seconds
+    def __init__(self, fallback, minimum=0.02, margin=1.5, samples=200, learnAfter=20):
+        self.fallback = fallback
+        self.minimum = minimum
+        self.margin = margin
+        self.learnAfter = learnAfter
+        self.samples = samples
+        self.waits = dict()
+        self.cached = dict()
+
+    # Note when (seconds after the send) a reply arrived
+    def observe(self, op, phase, seconds):
+        key = (op, phase)
+        waits = self.waits.get(key)
+        if waits == None:
+            waits = self.waits[key] = collections.deque(maxlen=self.samples)
+        waits.append(seconds)
+        # the percentile is worked out again every few samples, not every time
+        if len(waits) >= self.learnAfter and len(waits) % 10 == 0:
+            ordered = sorted(waits)
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            self.cached[key] = min(self.fallback, max(self.minimum, p99 * self.margin + self.minimum))
+
+    # How long to wait for the first reply or for more of it, 'elapsed' seconds
+    # after the send
+    def timeout(self, op, phase, elapsed):
+        learned = self.cached.get((op, phase))
+        if learned == None:
+            return self.fallback
+        return max(self.minimum, min(self.fallback, learned - elapsed))
+
+    # True if we're using a learned timeout for this rather than the fallback
+    def isLearned(self, op, phase):
+        return (op, phase) in self.cached
+
+    # A reply came in after we gave up on it - forget what we learned about
+    # the operation and go back to the configured timeout
+    def anomaly(self, op):
+        for phase in ('first', 'last'):
+            self.waits.pop((op, phase), None)
+            self.cached.pop((op, phase), None)
+
+    # Everything learned so far, in milliseconds
+    def snapshot(self):
+        learned = dict()
+        for (op, phase), seconds in self.cached.items():
+            learned[op + ' ' + phase] = round(seconds * 1000, 3)
+        return learned
@@ -0,0 +1,161 @@
+import bisect
+import logging
+import threading
+import logging.handlers
+from ampTimeout import operationName
+
+# Opt-in instrumentation for amplifierConfig, to find out where the time goes
+# when things feel slow. With a tracer set (amplifierConfig.setTracer, or a
+# "trace" section in the amp's config) every exchange with the amp records:
+#   send       - how long sendall() took
+#   first_byte - from the end of the send to the first byte of the reply
+#   last_byte  - from the end of the send to the last byte we read
+#   parse      - time spent splitting the bytes into replies
+#   total      - the whole exchange
+# per operation (the request with its arguments taken out, so 'amp:vol_30!'
+# and 'amp:vol_31!' count as the same one), plus counters for calls, bytes
+# each way, timeouts (reads that ended because the amp went quiet) and errors.
+# Anything else can be timed with observe() - the GUI times its rendering.
+#
+# The numbers are kept in fixed-size histograms, so memory use doesn't grow
+# and recording is just a few additions. If a file name is given, the raw
+# traffic is also written to a rotating transcript:
+#   "trace": {"file": "rotel_trace.log", "max_bytes": 1000000, "backups": 3}
+#
+# snapshot() gives everything as a dict, report() as text.
+
+# Histogram bucket upper bounds in milliseconds, the last bucket is open ended
+bucketBounds = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+class latencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * (len(bucketBounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    # add one observation, in seconds
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.buckets[bisect.bisect_left(bucketBounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    # Approximate percentile in ms - the upper bound of the bucket it falls in
+    # (the largest value seen for the open ended bucket)
+    def percentile(self, pct):
+        if self.count == 0:
+            return None
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count > 0:
+                if index < len(bucketBounds):
+                    return round(min(bucketBounds[index], self.max), 3)
+                return round(self.max, 3)
+        return round(self.max, 3)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count, 3) if self.count > 0 else None,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'max_ms': round(self.max, 3),
+        }
+
+class ampTracer:
+
+    # Constructor - traceFile is the transcript file (None for no transcript)
+    def __init__(self, traceFile=None, maxBytes=1000000, backupCount=3):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.transcript = None
+        if traceFile != None:
+            # a logger of our own, so the transcript doesn't end up anywhere else
+            self.transcript = logging.getLogger('ampTrace.' + traceFile)
+            self.transcript.propagate = False
+            self.transcript.setLevel(logging.INFO)
+            if len(self.transcript.handlers) == 0:
+                handler = logging.handlers.RotatingFileHandler(traceFile, maxBytes=maxBytes, backupCount=backupCount)
+                handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                self.transcript.addHandler(handler)
+
+    # Build a tracer from a config's "trace" section
+    @staticmethod
+    def fromConfig(traceConfig):
+        if not isinstance(traceConfig, dict):
+            traceConfig = dict()
+        return ampTracer(traceConfig.get('file'), traceConfig.get('max_bytes', 1000000),
+                         traceConfig.get('backups', 3))
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Record how long something took (seconds) under 'name'
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram == None:
+                histogram = self.histograms[name] = latencyHistogram()
+            histogram.add(seconds)
+
+    # Record one exchange with the amp. 'timings' has the phases above that
+    # were measured (in seconds), 'received' is the raw bytes that came back.
+    def recordExchange(self, payload, timings, bytesOut, received, timedOut):
+        op = operationName(payload)
+        with self.lock:
+            for phase, seconds in timings.items():
+                key = op + ' ' + phase
+                histogram = self.histograms.get(key)
+                if histogram == None:
+                    histogram = self.histograms[key] = latencyHistogram()
+                histogram.add(seconds)
+            self.counters['calls'] = self.counters.get('calls', 0) + 1
+            self.counters['bytes_out'] = self.counters.get('bytes_out', 0) + bytesOut
+            self.counters['bytes_in'] = self.counters.get('bytes_in', 0) + len(received)
+            if timedOut:
+                self.counters['timeouts'] = self.counters.get('timeouts', 0) + 1
+                self.counters[op + ' timeouts'] = self.counters.get(op + ' timeouts', 0) + 1
+        if self.transcript != None:
+            self.transcript.info('> ' + payload)
+            if len(received) > 0:
+                self.transcript.info('< ' + received.decode('utf-8', errors='replace'))
+            if timedOut:
+                self.transcript.info('  (timed out after %.1f ms)' % (timings.get('total', 0) * 1000))
+
+    # Bytes the amp sent on its own (front panel updates etc.)
+    def recordUnsolicited(self, received):
+        self.count('bytes_in_unsolicited', len(received))
+        if self.transcript != None:
+            self.transcript.info('< ' + received.decode('utf-8', errors='replace'))
+
+    # Connects, disconnects, errors
+    def recordEvent(self, name, message=''):
+        self.count(name)
+        if self.transcript != None:
+            self.transcript.info('* ' + name + ' ' + message)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timings': {name: h.summary() for name, h in self.histograms.items()},
+            }
+
+    def report(self):
+        snap = self.snapshot()
+        lines = []
+        for name in sorted(snap['counters']):
+            lines.append('%-40s %d' % (name, snap['counters'][name]))
+        lines.append('%-40s %7s %9s %9s %9s %9s' % ('timing', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+        for name in sorted(snap['timings']):
+            t = snap['timings'][name]
+            lines.append('%-40s %7d %9s %9s %9s %9s' % (name, t['count'], t['p50_ms'], t['p95_ms'], t['p99_ms'], t['max_ms']))
+        return '\n'.join(lines)
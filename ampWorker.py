@@ -0,0 +1,506 @@
+import queue
+import itertools
+import threading
+import time
+
+# Background thread that owns the amplifier connection. Callers (the GUI, for
+# now) hand it jobs - a function and its arguments - and the worker runs them
+# one at a time, so only one thread ever touches the amp's socket and a slow
+# reply never freezes the caller.
+#
+# Jobs have a priority: interactive (someone clicked something - the default),
+# scene (presets, ramps, automation) or polling (background refreshes). The
+# most urgent job waiting always goes next, jobs of the same priority go in
+# the order they came, so a click never waits behind a queue of refreshes.
+# Only so many jobs of each priority can be waiting (queueLimits): submit()
+# turns any more away, call() and callAsync() wait for room - so a script
+# that floods the amp is slowed down to the amp's pace instead of piling up
+# minutes of work. How fast requests actually go out to the amp is up to the
+# ampConfig's rate limit (see ampRateLimit).
+#
+# A job that takes a while (a power change, a volume ramp) doesn't hold up
+# the interactive jobs that come in meanwhile: while it waits (see
+# amplifierConfig.pause) the worker runs them, so a mute click in the middle
+# of a fade goes out straight away. The jobs run like that don't get to run
+# others in turn.
+#
+# Results are not handed back directly: tkinter widgets may only be touched
+# from the mainloop's thread, so each finished job's callback is put on a
+# result queue and the owner calls dispatchResults() from its own thread
+# (the GUI does this from a periodic after() timer).
+#
+# Slider-type controls should use submitLatest() rather than submit(): dragging
+# a slider produces a value for every step, and there's no point in sending the
+# amp every one of them. Only the newest pending value for each control is sent,
+# and no more often than the config's command interval.
+#
+# Volume fades go through submitRamp(). Interactive jobs are run between a
+# ramp's steps, but only one ramp runs at a time: starting a new one (or
+# calling cancelRamp(), which the GUI does when the volume slider is moved)
+# stops the one that's running.
+#
+# When there's nothing to do, the worker listens for updates the amp sends on
+# its own (front panel, IR remote) so the ampConfig's state cache stays current.
+#
+# The worker also supervises the connection once connectAmp() has been run: if
+# the amp goes quiet for a while it's probed with a cheap power query, and if
+# the connection drops (amp rebooted, Wi-Fi outage) it reconnects with an
+# exponential backoff. Queued jobs wait for the reconnect, and a job that was
+# cut off by the drop is run again once we're back. Connection changes are
+# reported through connectionCallback (see setConnectionCallback).
+#
+# Every few seconds of idle time the worker also checks whether the amp's
+# config file has been changed, and if so has the ampConfig switch to the new
+# one (see amplifierConfig.reloadIfChanged) - the connection is only restarted
+# if the address or port changed. The owner hears about it through
+# configCallback (see setConfigCallback), e.g. to redraw the source list.
+# Config changes from elsewhere (ampDaemon's clients) come in through
+# submitConfigJob(), whose jobs are run even while the amp is away - the
+# change may well be the fix for a wrong address.
+
+# Job priorities, most urgent first
+priorityInteractive = 0
+priorityScene = 1
+priorityPolling = 2
+priorityNames = {'interactive': priorityInteractive, 'scene': priorityScene, 'polling': priorityPolling}
+
+# How many jobs of each priority can be waiting to run
+queueLimits = {priorityInteractive: 100, priorityScene: 20, priorityPolling: 10}
+
+# Returned by ampWorker.callAsync() - the job's result is delivered here on the
+# worker thread, and wait() blocks the caller until it's available.
+class pendingCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+    def set(self, result):
+        self.result = result
+        self.done.set()
+
+    # Wait for the result, gives a false return code if it takes too long
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            return (False, "Timed out waiting for amp")
+        return self.result
+
+class ampWorker(threading.Thread):
+
+    # Constructor - the worker needs the ampConfig it will be driving
+    def __init__(self, ampConfig):
+        super().__init__(daemon=True)
+        self.ampConfig = ampConfig
+        # (priority, sequence number, job) - the sequence number keeps jobs of
+        # the same priority in order
+        self.jobs = queue.PriorityQueue()
+        self.jobNumbers = itertools.count()
+        self.queued = dict((priority, 0) for priority in queueLimits)
+        self.queueSpace = threading.Condition()
+        self.results = queue.Queue()
+
+        # pending latest-value-wins jobs, keyed by control name
+        self.latest = dict()
+        self.latestLock = threading.Lock()
+        self.lastSent = dict()
+        self.minInterval = ampConfig.getCommandInterval()
+
+        # cancel event of the most recently submitted volume ramp
+        self.rampCancel = None
+
+        # interactive jobs are run while long jobs wait, see runUrgent
+        self.pausing = False
+        ampConfig.setPauseHook(self.runUrgent)
+
+        # how long to wait for a job before checking the amp for updates
+        self.pollInterval = 0.05
+
+        # connection supervision - wantConnected is set by connectAmp()
+        self.wantConnected = False
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.restartRequested = False
+        self.lastActivity = time.monotonic()
+        self.keepaliveInterval = ampConfig.getKeepaliveInterval()
+        self.reconnectMaxDelay = ampConfig.getReconnectMaxDelay()
+        self.connectionCallback = None
+
+        # config file hot reload, see checkConfig
+        self.configCheckInterval = ampConfig.getConfigCheckInterval()
+        self.lastConfigCheck = time.monotonic()
+        self.configCallback = None
+        self.configJobs = queue.Queue()
+
+    # Put a job on the queue if there's room for another one of its priority,
+    # waiting up to 'wait' seconds for some (None waits as long as it takes).
+    # Returns false if there wasn't any.
+    def queueJob(self, priority, job, wait=0):
+        with self.queueSpace:
+            if not self.queueSpace.wait_for(lambda: self.queued[priority] < queueLimits[priority], wait):
+                return False
+            self.queued[priority] += 1
+        self.jobs.put((priority, next(self.jobNumbers), job))
+        return True
+
+    # Tell a job's caller it was turned away, the same way it would have got
+    # the job's result
+    def rejectJob(self, callback):
+        self.deliver(callback, (False, "Amp is busy, try again later"))
+
+    # Hand a job's result to its callback - a pendingCall gets it right away,
+    # anything else the next time dispatchResults() runs
+    def deliver(self, callback, result):
+        if isinstance(callback, pendingCall):
+            callback.set(result)
+        elif callback != None:
+            self.results.put((callback, result))
+
+    # Fail a job that's not going to be run, e.g. we're stopping before we
+    # could get connected again. A submitLatest() job's callback is waiting
+    # in 'latest'.
+    def dropJob(self, job, message):
+        func, args, callback = job
+        if func == self.runLatest:
+            with self.latestLock:
+                func, args, callback = self.latest.pop(args[0], (None, None, None))
+        self.deliver(callback, (False, message))
+
+    # Queue up a call to func(*args). If a callback is given it will be called
+    # with func's return value the next time dispatchResults() runs. Returns
+    # false (and the callback gets a false return code) if too many jobs of
+    # this priority are waiting already.
+    def submit(self, func, *args, callback=None, priority=priorityInteractive):
+        if not self.queueJob(priority, (func, args, callback)):
+            self.rejectJob(callback)
+            return False
+        return True
+
+    # Like submit(), but if a job for the same key is still waiting to be run,
+    # it is replaced with this one instead of queueing another. Used for the
+    # sliders, where only the most recent value matters.
+    def submitLatest(self, key, func, *args, callback=None, priority=priorityInteractive):
+        with self.latestLock:
+            alreadyQueued = key in self.latest
+            self.latest[key] = (func, args, callback)
+        if not alreadyQueued and not self.queueJob(priority, (self.runLatest, (key,), None)):
+            with self.latestLock:
+                self.latest.pop(key, None)
+            self.rejectJob(callback)
+            return False
+        return True
+
+    # Queue a volume ramp (see ampConfig.rampVolume), cancelling any ramp
+    # that's still running or waiting to run
+    def submitRamp(self, target, duration, curve='linear', callback=None, priority=priorityScene, origin=None):
+        self.cancelRamp()
+        self.rampCancel = threading.Event()
+        if origin != None:
+            return self.submit(self.runAs, origin, self.ampConfig.rampVolume, target, duration, curve,
+                               self.rampCancel, callback=callback, priority=priority)
+        return self.submit(self.ampConfig.rampVolume, target, duration, curve, self.rampCancel,
+                           callback=callback, priority=priority)
+
+    # Job: run func(*args) with the requests it sends recorded in the amp's
+    # history as coming from 'origin' (see amplifierConfig.setRequestOrigin)
+    def runAs(self, origin, func, *args):
+        previous = self.ampConfig.requestOrigin
+        self.ampConfig.setRequestOrigin(origin)
+        try:
+            return func(*args)
+        finally:
+            self.ampConfig.setRequestOrigin(previous)
+
+    # Stop the current volume ramp (if any) where it is
+    def cancelRamp(self):
+        if self.rampCancel != None:
+            self.rampCancel.set()
+            self.rampCancel = None
+
+    # For callers that aren't running an event loop (scripts, other threads):
+    # queue func(*args) and get a pendingCall to wait on, or wait right away
+    # with call(). Several callAsync()s on different workers run in parallel.
+    # If the queue for this priority is full these wait (up to 'timeout'
+    # seconds) for room, which is how busy callers get slowed down.
+    def callAsync(self, func, *args, priority=priorityInteractive, timeout=None):
+        pending = pendingCall()
+        if not self.queueJob(priority, (func, args, pending), timeout):
+            self.rejectJob(pending)
+        return pending
+
+    def call(self, func, *args, timeout=None, priority=priorityInteractive):
+        return self.callAsync(func, *args, priority=priority, timeout=timeout).wait(timeout)
+
+    # Queue func(*args) for a job that only touches the config, not the amp.
+    # These don't wait for a connection: they're run between jobs and while
+    # reconnecting. Gets a pendingCall or a callback like callAsync/submit.
+    def submitConfigJob(self, func, *args, callback=None):
+        self.configJobs.put((func, args, callback))
+        # cut short a reconnect backoff
+        self.wakeup.set()
+
+    # Run the waiting config jobs
+    def runConfigJobs(self):
+        while True:
+            try:
+                func, args, callback = self.configJobs.get_nowait()
+            except queue.Empty:
+                return
+            self.runJob(func, args, callback)
+
+    # Hand a callback and value straight to the result queue, for code that
+    # runs on the worker thread (e.g. state cache callbacks)
+    def post(self, callback, result=None):
+        self.results.put((callback, result))
+
+    # Register a function that's called as callback(connected, message) on the
+    # worker thread whenever the connection is made, lost or being retried
+    def setConnectionCallback(self, callback):
+        self.connectionCallback = callback
+
+    def reportConnection(self, connected, message):
+        if self.connectionCallback != None:
+            self.connectionCallback(connected, message)
+
+    # Register a function that's called as callback(ret, value) on the worker
+    # thread when the config file changed - with the changed keys, or a false
+    # return code and a message if the new file couldn't be used
+    def setConfigCallback(self, callback):
+        self.configCallback = callback
+
+    # Reload the config if its file changed, and pick up the settings we use
+    def checkConfig(self):
+        self.lastConfigCheck = time.monotonic()
+        (ret, changed) = self.ampConfig.reloadIfChanged()
+        if ret and len(changed) == 0:
+            return
+        if ret:
+            self.minInterval = self.ampConfig.getCommandInterval()
+            self.keepaliveInterval = self.ampConfig.getKeepaliveInterval()
+            self.reconnectMaxDelay = self.ampConfig.getReconnectMaxDelay()
+            self.configCheckInterval = self.ampConfig.getConfigCheckInterval()
+            if 'address' in changed or 'port' in changed:
+                self.restartConnection()
+        if self.configCallback != None:
+            self.configCallback(ret, changed)
+
+    # Job: connect to the amp and keep the connection up from now on. Returns
+    # the ampConfig.connect() result - if it failed, we keep retrying anyway.
+    def connectAmp(self):
+        if not self.ampConfig.getAddress():
+            # nothing to connect to until an address is configured
+            self.reportConnection(False, "Missing IP address")
+            return (False, "Missing IP address")
+        self.wantConnected = True
+        self.ampConfig.close()
+        result = self.ampConfig.connect()
+        self.lastActivity = time.monotonic()
+        self.reportConnection(result[0], result[1])
+        return result
+
+    # Ask for a fresh connection (e.g. the address in the config changed).
+    # Safe to call from any thread, it also cuts short a reconnect backoff.
+    def restartConnection(self):
+        self.restartRequested = True
+        self.wakeup.set()
+
+    # Keep trying to connect, backing off exponentially between attempts, until
+    # it works or we're told to stop. Returns true if we got connected.
+    def reconnect(self):
+        delay = 0.5
+        attempt = 1
+        while not self.stopping.is_set():
+            # the fix for a wrong address may well be on its way in the config
+            self.runConfigJobs()
+            if time.monotonic() - self.lastConfigCheck > self.configCheckInterval:
+                self.checkConfig()
+                # we're about to connect to the new address anyway
+                self.restartRequested = False
+            self.reportConnection(False, 'Reconnecting (attempt ' + str(attempt) + ')')
+            self.ampConfig.close()
+            (ret, message) = self.ampConfig.connect()
+            if ret:
+                self.lastActivity = time.monotonic()
+                self.reportConnection(True, message)
+                return True
+            # wait before the next try, but wake up straight away on stop()
+            # or restartConnection()
+            if self.wakeup.wait(delay):
+                self.wakeup.clear()
+                self.restartRequested = False
+                delay = 0.5
+            else:
+                delay = min(delay * 2, self.reconnectMaxDelay)
+            attempt += 1
+        return False
+
+    # Ask the worker to finish - anything already queued is run first (the
+    # stop marker comes after every priority)
+    def stop(self):
+        self.cancelRamp()
+        self.stopping.set()
+        self.wakeup.set()
+        self.jobs.put((len(queueLimits), next(self.jobNumbers), None))
+
+    # Thread body: run jobs until we get the stop marker
+    def run(self):
+        while True:
+            self.runConfigJobs()
+            try:
+                (priority, number, job) = self.jobs.get(timeout=self.pollInterval)
+            except queue.Empty:
+                self.checkForUpdates()
+                continue
+            if job == None:
+                break
+            self.jobTaken(priority)
+            func, args, callback = job
+            # hold queued jobs until we're connected again
+            if self.wantConnected and not self.ampConfig.isConnected() and func != self.connectAmp:
+                if not self.reconnect():
+                    # stopped first - nobody gets left waiting for their job
+                    self.dropJob(job, "Not connected")
+                    self.dropQueuedJobs("Not connected")
+                    break
+            self.runJob(func, args, callback)
+
+    # Fail every job still on the queue
+    def dropQueuedJobs(self, message):
+        while True:
+            try:
+                (priority, number, job) = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            if job != None:
+                self.jobTaken(priority)
+                self.dropJob(job, message)
+
+    # A job is off the queue, make room for another one of its priority
+    def jobTaken(self, priority):
+        with self.queueSpace:
+            self.queued[priority] -= 1
+            self.queueSpace.notify_all()
+
+    # The ampConfig's pause hook: wait(seconds) in slices, running any
+    # interactive jobs that come in meanwhile. Returns early if wait() returns
+    # true. A job run from here just waits.
+    def runUrgent(self, seconds, wait):
+        if self.pausing:
+            return wait(seconds)
+        self.pausing = True
+        try:
+            deadline = time.monotonic() + seconds
+            while True:
+                self.runInteractive()
+                remaining = max(0, deadline - time.monotonic())
+                result = wait(min(remaining, self.pollInterval))
+                if result or remaining <= self.pollInterval:
+                    return result
+        finally:
+            self.pausing = False
+
+    # Run the interactive jobs that are waiting, leaving anything else queued
+    def runInteractive(self):
+        while self.ampConfig.isConnected():
+            try:
+                (priority, number, job) = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            if priority != priorityInteractive:
+                # put it back, it keeps its place in the queue
+                self.jobs.put((priority, number, job))
+                return
+            self.jobTaken(priority)
+            func, args, callback = job
+            self.runJob(func, args, callback)
+
+    # Idle time - pick up any unsolicited updates from the amp, and make sure
+    # the connection is still alive
+    def checkForUpdates(self):
+        if time.monotonic() - self.lastConfigCheck > self.configCheckInterval:
+            self.checkConfig()
+        if self.restartRequested:
+            self.wakeup.clear()
+            self.restartRequested = False
+            self.wantConnected = True
+            self.ampConfig.close()
+        if not self.wantConnected:
+            return
+        if not self.ampConfig.isConnected():
+            self.reconnect()
+            return
+        try:
+            if len(self.ampConfig.pollUpdates()) > 0:
+                self.lastActivity = time.monotonic()
+            elif time.monotonic() - self.lastActivity > self.keepaliveInterval:
+                # the amp answers power queries even in standby, so no
+                # answer means the connection is dead
+                (ret, resp) = self.ampConfig.probePower()
+                self.lastActivity = time.monotonic()
+                if not ret or 'power' not in resp:
+                    self.ampConfig.close()
+        except OSError:
+            pass
+        if not self.ampConfig.isConnected():
+            self.reportConnection(False, "Connection lost")
+
+    # Run a single job and queue its callback. If the connection dropped
+    # while the job was running, reconnect and run it one more time - unless
+    # it sent a toggle (see amplifierConfig.noteSent), which may have reached
+    # the amp before the drop. Then we just find out where the amp is now.
+    def runJob(self, func, args, callback):
+        retried = False
+        # a job run from runUrgent mustn't affect the one it interrupted
+        outerSentRelative = self.ampConfig.sentRelative
+        while True:
+            self.ampConfig.sentRelative = False
+            wasConnected = self.ampConfig.isConnected()
+            try:
+                result = func(*args)
+            except Exception as e:
+                # keep the worker alive, and report the failure the same way
+                # the ampConfig methods do - a false return code and a message
+                result = (False, str(e))
+            lostConnection = wasConnected and not self.ampConfig.isConnected()
+            if lostConnection and self.wantConnected and not retried:
+                retried = True
+                if self.reconnect():
+                    if not self.ampConfig.sentRelative:
+                        continue
+                    self.refreshState()
+                    result = (False, "Connection lost, the amp may or may not have done it")
+            break
+        self.ampConfig.sentRelative = outerSentRelative
+        self.lastActivity = time.monotonic()
+        self.deliver(callback, result)
+
+    # Read the amp's settings into the state cache (the connection was just
+    # made again, so it's empty) - the amp only answers the power query in
+    # standby
+    def refreshState(self):
+        try:
+            (ret, resp) = self.ampConfig.queryPower()
+            if ret and resp.get('power') == 'on':
+                self.ampConfig.querySourceInfo()
+        except OSError:
+            pass
+
+    # Run the newest job for a submitLatest() key. If we sent this control
+    # very recently we wait out the rest of the interval first - any values
+    # that come in while we wait just replace the pending one, and other
+    # interactive jobs are run meanwhile (see runUrgent).
+    def runLatest(self, key):
+        wait = self.lastSent.get(key, 0) + self.minInterval - time.monotonic()
+        if wait > 0:
+            self.runUrgent(wait, self.stopping.wait)
+        with self.latestLock:
+            func, args, callback = self.latest.pop(key)
+        self.lastSent[key] = time.monotonic()
+        self.runJob(func, args, callback)
+
+    # Run the callbacks for any finished jobs, call this from the owner's thread
+    def dispatchResults(self):
+        while True:
+            try:
+                callback, result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            callback(result)
@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import argparse
+import datetime
+from ampConfig import amplifierConfig, findConfigs, presetValue, rampCurves
+
+# Command line remote for scripts, cron jobs and home automation. It only
+# needs the protocol layer (no tkinter, no worker thread): it loads one amp
+# config, connects, does one thing and disconnects. For example:
+#   python3 rotel.py query volume source
+#   python3 rotel.py set volume 30
+#   python3 rotel.py set mute on
+#   python3 rotel.py --amp "Living room" scene "Vinyl evening"
+#   python3 rotel.py command power_off
+#   python3 rotel.py ramp 20 --duration 10 --curve ease-out
+#   python3 rotel.py --json query power
+#   python3 rotel.py --daemon state
+#   python3 rotel.py --trace-file trace.log query volume
+#   python3 rotel.py discover --network 192.168.1.0/24 --save
+#   python3 rotel.py history --key volume --since "2025-01-31 00:00"
+#
+# The amp is picked with --amp (a config name or file name) from the configs
+# directory next to this script, or with --config pointing at a config file.
+# The exit code is 0 on success and 1 on failure, --json prints the result (or
+# the error) as JSON instead of plain text.
+#
+# With --daemon the amp is reached through a running ampDaemon (see there)
+# instead of connecting to it directly, and 'state' is answered from the
+# daemon's state cache without asking the amp. --daemon-address picks a daemon
+# other than the default one (and implies --daemon).
+#
+# 'discover' searches the local network for amps (see ampDiscovery), using
+# the port from the amp's config. With --save and exactly one amp found, its
+# address is written to the config.
+#
+# 'history' shows what the amp's history (see ampHistory) recorded, newest
+# last. It's read from the database without connecting to the amp.
+#
+# --trace prints the timings of the exchanges with the amp (see ampTrace) to
+# stderr when we're done, --trace-file also writes a transcript to a file.
+
+defaultConfigDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs")
+defaultDaemonAddress = '127.0.0.1:9597'
+
+# settings shown by the 'state' action
+stateKeys = ['power', 'source', 'volume', 'mute', 'bypass', 'bass', 'treble', 'balance']
+
+# Find the config file for an amp by its config name or file name (with or
+# without '.json'), or the first one with an address if no name is given
+def findAmpConfig(configDir, ampName):
+    configs = findConfigs(configDir)
+    if ampName == None:
+        for entry in configs:
+            amp = amplifierConfig(entry['filename'])
+            if amp.configValid and amp.getAddress():
+                return (True, amp)
+        return (False, "No amp config with an address in " + configDir)
+    for entry in configs:
+        fileName = os.path.basename(entry['filename'])
+        if ampName in (entry['name'], fileName, os.path.splitext(fileName)[0]):
+            return (True, amplifierConfig(entry['filename']))
+    names = [entry['name'] for entry in configs if entry['name'] != None]
+    return (False, "Unknown amp: " + ampName + ", choose from: " + ', '.join(names))
+
+# Set one setting, the value is given the way the amp reports it ('on',
+# 'off', '30', 'cd' ...)
+def setSetting(amp, key, value):
+    if key == 'power':
+        if value not in ('on', 'off', 'standby'):
+            return (False, "Power must be on or off")
+        return amp.setPower(value == 'on')
+    if key in ('mute', 'bypass') and value not in ('on', 'off'):
+        return (False, key.capitalize() + " must be on or off")
+    try:
+        value = presetValue(key, value)
+    except ValueError:
+        return (False, "Bad value for " + key + ": " + value)
+    if key == 'volume':
+        return amp.setVolume(value)
+    if key == 'source':
+        if value not in amp.getSourceIds():
+            return (False, "Unknown source: " + value + ", choose from: " + ', '.join(amp.getSourceIds()))
+        return amp.setSource(value)
+    if key == 'mute':
+        return amp.setMute(value == 'on')
+    if key == 'bypass':
+        return amp.setBypass(value == 'on')
+    if key == 'bass':
+        return amp.setBass(value)
+    if key == 'treble':
+        return amp.setTreble(value)
+    if key == 'balance':
+        return amp.setBalance(value)
+    return (False, "Unknown setting: " + key)
+
+# All of the amp's settings, only asking the amp for the ones the state cache
+# doesn't have (which is all of them, unless we're going through the daemon)
+def getState(amp):
+    if amp.state.get('power') == None:
+        amp.queryPower()
+    if amp.state.get('power') == 'on':
+        missing = [key for key in stateKeys if amp.state.get(key) == None]
+        if len(missing) > 0:
+            amp.doQuery(missing)
+    state = amp.state.snapshot()
+    values = dict()
+    for key in stateKeys:
+        if key in state:
+            values[key] = state[key]
+    return (True, values)
+
+def runList(args):
+    amps = []
+    for entry in findConfigs(args.configs):
+        amp = amplifierConfig(entry['filename'])
+        amps.append({'name': entry['name'], 'file': entry['filename'],
+                     'address': amp.getAddress() if amp.configValid else None})
+    return (True, amps)
+
+# Look for amps on the network, and put the address in the amp's config if
+# asked to and there's no doubt which one it is
+def runDiscover(args, amp):
+    from ampDiscovery import discoverForConfig
+    try:
+        amps = discoverForConfig(amp, args.network, connectTimeout=args.timeout, replyTimeout=args.timeout)
+    except ValueError as e:
+        return (False, "Bad network: " + str(e))
+    if args.save:
+        if len(amps) != 1:
+            return (False, "Found " + str(len(amps)) + " amps, not saving an address")
+        amp.setAddress(amps[0]['address'])
+        try:
+            (ret, message) = amp.saveConfig()
+        except OSError as e:
+            (ret, message) = (False, str(e))
+        if not ret:
+            return (False, message)
+    return (True, amps)
+
+# Recorded events, with readable times unless they're for a script
+def runHistory(args, amp):
+    times = []
+    for text in (args.since, args.until):
+        try:
+            times.append(datetime.datetime.fromisoformat(text).timestamp() if text != None else None)
+        except ValueError:
+            return (False, "Bad time: " + text + ", use e.g. 2025-01-31 or '2025-01-31 02:00'")
+    (ret, events) = amp.getHistory(times[0], times[1], args.key, args.limit)
+    if ret and not args.json:
+        for event in events:
+            event['time'] = datetime.datetime.fromtimestamp(event['time']).isoformat(' ', 'seconds')
+    return (ret, events)
+
+# Everything else needs a connection to the amp
+def runAmpCommand(args, amp):
+    if args.action == 'scene' and args.name == None:
+        return (True, amp.getPresetNames())
+    if args.action == 'history':
+        return runHistory(args, amp)
+
+    amp.setRequestOrigin('cli')
+    (ret, message) = amp.connect()
+    if not ret:
+        return (False, "Could not connect to " + str(amp.getAddress()) + ": " + message)
+    try:
+        if args.action == 'state':
+            return getState(amp)
+        if args.action == 'query':
+            return amp.doQuery(args.keys)
+        if args.action == 'set':
+            return setSetting(amp, args.key, args.value)
+        if args.action == 'command':
+            argLength = None
+            if args.arg != None and args.arg.isdigit():
+                argLength = len(args.arg)
+            return amp.doCommand(args.name, args.arg, argLength)
+        if args.action == 'scene':
+            return amp.applyPreset(args.name)
+        if args.action == 'ramp':
+            return amp.rampVolume(args.target, args.duration, args.curve)
+    except OSError as e:
+        return (False, str(e))
+    finally:
+        amp.close()
+    return (False, "Unknown action")
+
+def printResult(ret, value, asJson):
+    if asJson:
+        if ret:
+            print(json.dumps(value))
+        else:
+            print(json.dumps({'error': value}))
+        return
+    if not ret:
+        print('Error: ' + str(value), file=sys.stderr)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            print(str(key) + '=' + str(item))
+    elif isinstance(value, list):
+        for item in value:
+            if isinstance(item, dict):
+                print(', '.join(str(k) + '=' + str(v) for k, v in item.items()))
+            else:
+                print(item)
+    else:
+        print(value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Control a Rotel amp from the command line')
+    parser.add_argument('--amp', help='config name or file name of the amp to control')
+    parser.add_argument('--config', help='amp config file to use (instead of --amp)')
+    parser.add_argument('--configs', default=defaultConfigDir, help='directory with the amp configs')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    parser.add_argument('--trace', action='store_true', help='print protocol timings')
+    parser.add_argument('--trace-file', help='write a transcript of the traffic to this file (implies --trace)')
+    parser.add_argument('--daemon', action='store_true', help='go through an ampDaemon')
+    parser.add_argument('--daemon-address', help='host:port or Unix socket path of the ampDaemon (default ' +
+                        defaultDaemonAddress + ', implies --daemon)')
+    actions = parser.add_subparsers(dest='action', required=True)
+
+    actions.add_parser('list', help='list the amp configs')
+    actions.add_parser('state', help='show all settings')
+    query = actions.add_parser('query', help='query settings, e.g. "query volume source"')
+    query.add_argument('keys', nargs='+')
+    setter = actions.add_parser('set', help='change a setting, e.g. "set volume 30"')
+    setter.add_argument('key', choices=['power', 'source', 'volume', 'mute', 'bypass', 'bass', 'treble', 'balance'])
+    setter.add_argument('value')
+    command = actions.add_parser('command', help='send a command from the config, e.g. "command mute_on"')
+    command.add_argument('name')
+    command.add_argument('arg', nargs='?', help='argument for commands that take one')
+    scene = actions.add_parser('scene', help='apply a preset, or list them without a name')
+    scene.add_argument('name', nargs='?')
+    ramp = actions.add_parser('ramp', help='fade the volume to a new level')
+    ramp.add_argument('target', type=int)
+    ramp.add_argument('--duration', type=float, default=5.0, help='seconds (default 5)')
+    ramp.add_argument('--curve', default='linear', choices=list(rampCurves.keys()))
+    discover = actions.add_parser('discover', help='search the network for amps')
+    discover.add_argument('--network', help='subnet to search, e.g. 192.168.1.0/24 (default: the local /24)')
+    discover.add_argument('--timeout', type=float, default=0.5, help='connect and reply deadline in seconds (default 0.5)')
+    discover.add_argument('--save', action='store_true', help="save the address to the amp's config if one amp was found")
+    history = actions.add_parser('history', help='show recorded state changes and requests')
+    history.add_argument('--key', help='only this setting, e.g. volume')
+    history.add_argument('--since', help='start time, e.g. "2025-01-31 02:00"')
+    history.add_argument('--until', help='end time')
+    history.add_argument('--limit', type=int, default=100, help='show at most this many, the most recent (default 100)')
+    args = parser.parse_args()
+    if args.daemon_address != None:
+        args.daemon = True
+    else:
+        args.daemon_address = defaultDaemonAddress
+
+    if args.action == 'list' and not args.daemon:
+        (ret, value) = runList(args)
+    elif args.action == 'discover':
+        # always done from here, the daemon's amps have addresses already
+        if args.config != None:
+            amp = amplifierConfig(args.config)
+            (ret, value) = (amp.configValid, "Invalid config: " + args.config)
+        else:
+            (ret, value) = findAmpConfig(args.configs, args.amp)
+            amp = value
+        if ret:
+            (ret, value) = runDiscover(args, amp)
+    elif args.daemon:
+        # only loaded when needed, it's not as light as ampConfig
+        from ampRemote import ampDaemonClient, remoteAmplifierConfig
+        client = ampDaemonClient(args.daemon_address)
+        (ret, value) = client.connect()
+        if ret and args.action == 'list':
+            (ret, value) = client.call('amps')
+            value = value['amps'] if ret else value
+            client.close()
+        elif ret:
+            amp = remoteAmplifierConfig(args.amp, client=client)
+            (ret, value) = (amp.configValid, "Unknown amp: " + str(args.amp))
+            if ret:
+                (ret, value) = runAmpCommand(args, amp)
+            client.close()
+    else:
+        if args.config != None:
+            amp = amplifierConfig(args.config)
+            (ret, value) = (amp.configValid, "Invalid config: " + args.config)
+        else:
+            (ret, value) = findAmpConfig(args.configs, args.amp)
+            amp = value
+        if ret:
+            if args.trace or args.trace_file != None:
+                from ampTrace import ampTracer
+                amp.setTracer(ampTracer(args.trace_file))
+            (ret, value) = runAmpCommand(args, amp)
+            if args.trace or args.trace_file != None:
+                print(amp.tracer.report(), file=sys.stderr)
+            # write out the history before we go
+            if amp.history != None:
+                amp.history.close()
+
+    printResult(ret, value, args.json)
+    return 0 if ret else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,54 @@
-import os
 import sys
-from ampConfig import amplifierConfig
+import argparse
+from ampController import multiAmpController
 from rotelRemoteGui import RotelRemoteGuiMain
 
 def main():
-    # TODO: arg parsing, config selection - only one config so far.
+    # Every amp config in the configs directory is loaded and connected to, the
+    # amp to show first can be given by name on the command line. With --daemon
+    # the amps are the ones a running ampDaemon has, reached through it.
+    parser = argparse.ArgumentParser(description='Rotel amp remote control')
+    parser.add_argument('amp', nargs='?', help='amp to show first')
+    parser.add_argument('--daemon', action='store_true', help='use the amps of an ampDaemon')
+    parser.add_argument('--daemon-address', help='host:port or Unix socket path of the ampDaemon '
+                        '(default 127.0.0.1:9597, implies --daemon)')
+    args = parser.parse_args()
+
     configDir = "configs"
-    configFile = os.path.join(configDir, "Rotel_A14_mkii_fw3_08.json")
+    if args.daemon or args.daemon_address != None:
+        from ampRemote import ampDaemonClient, remoteAmplifierConfig, defaultDaemonAddress
+        address = args.daemon_address if args.daemon_address != None else defaultDaemonAddress
+        client = ampDaemonClient(address)
+        (ret, message) = client.connect()
+        if not ret:
+            print(message)
+            return 1
+        (ret, amps) = client.call('amps')
+        client.close()
+        if not ret:
+            print(amps)
+            return 1
+        controller = multiAmpController(amps=[remoteAmplifierConfig(name, address) for name in amps['amps']])
+    else:
+        controller = multiAmpController(configDir)
+    if len(controller.getAmpNames()) == 0:
+        print('No amp configs found in ' + configDir)
+        return 1
 
-    # Read the amp config from the config file
-    myAmpConfig = amplifierConfig(configFile)
+    ampName = args.amp
+    if ampName != None:
+        if controller.getAmp(ampName) == None:
+            print('Unknown amp: ' + ampName + ', choose from: ' + ', '.join(controller.getAmpNames()))
+            return 1
 
-    # start the GUI and pass in the config file
-    gui = RotelRemoteGuiMain(myAmpConfig)
+    # start the GUI and pass in the amps
+    for name in controller.getAmpNames():
+        controller.getAmp(name).setRequestOrigin('gui')
+    controller.start()
+    gui = RotelRemoteGuiMain(controller, ampName)
 
-    # disconnect from the amp if needed
-    myAmpConfig.close()
+    # disconnect from the amps
+    controller.stop()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
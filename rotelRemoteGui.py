@@ -1,13 +1,17 @@
-from ampConfig import amplifierConfig
+from ampConfig import amplifierConfig, settingRanges
+from ampWorker import priorityScene, priorityPolling
 import tkinter as tk
 from tkinter import simpledialog
 from tkinter import messagebox
+import threading
 import time
 
 class ConfigDialog(simpledialog.Dialog):
     # Class variables for default config values
     ampname = ""
     ampaddress = ""
+    # the amp's config, for the port to search on
+    ampconfig = None
 
     # Simple config dialog to let user set IP address
     def body(self, master):
@@ -28,8 +32,65 @@ class ConfigDialog(simpledialog.Dialog):
         self.entry2.grid(row=1, column=1)
         self.savecheck.grid(row=3, column=1)
 
+        # Search the network for the amp rather than typing the address in.
+        # If more than one turns up they're listed to pick from.
+        self.discoverButton = tk.Button(master, text="Discover", command=self.discover)
+        self.discoverButton.grid(row=1, column=2, padx=4)
+        self.discoverStatus = tk.Label(master, text="")
+        self.discoverStatus.grid(row=2, column=0, columnspan=3, sticky="w")
+        self.discoverList = tk.Listbox(master, height=4)
+        self.discoverList.bind('<<ListboxSelect>>', self.discoverPicked)
+        self.discoverResult = None
+
         return self.entry1 # initial focus
 
+    # Discovery takes a second or two, so it runs on a thread of its own and
+    # we check back for the result (tk isn't to be touched from other threads)
+    def discover(self):
+        if ConfigDialog.ampconfig == None:
+            return
+        self.discoverButton.config(state="disabled")
+        self.discoverStatus.config(text="Searching...")
+        self.discoverList.grid_remove()
+        self.discoverResult = None
+        threading.Thread(target=self.discoverThread, daemon=True).start()
+        self.after(100, self.discoverPoll)
+
+    def discoverThread(self):
+        from ampDiscovery import discoverForConfig
+        try:
+            self.discoverResult = discoverForConfig(ConfigDialog.ampconfig)
+        except OSError:
+            self.discoverResult = []
+
+    def discoverPoll(self):
+        if self.discoverResult == None:
+            self.after(100, self.discoverPoll)
+            return
+        amps = self.discoverResult
+        self.discoverButton.config(state="normal")
+        if len(amps) == 0:
+            self.discoverStatus.config(text="No amps found")
+        elif len(amps) == 1:
+            self.discoverStatus.config(text="Found " + amps[0]['address'])
+            self.setDiscoveredAddress(amps[0]['address'])
+        else:
+            self.discoverStatus.config(text="Found " + str(len(amps)) + " amps, pick one:")
+            self.discoverList.delete(0, tk.END)
+            for amp in amps:
+                self.discoverList.insert(tk.END, amp['address'] + " (" + str(amp['power']) + ")")
+            self.discoverList.grid(row=4, column=0, columnspan=3, sticky="we")
+            self.discoverAmps = amps
+
+    def discoverPicked(self, event):
+        selection = self.discoverList.curselection()
+        if len(selection) > 0:
+            self.setDiscoveredAddress(self.discoverAmps[selection[0]]['address'])
+
+    def setDiscoveredAddress(self, address):
+        self.entry2.delete(0, tk.END)
+        self.entry2.insert(0, address)
+
     # The apply function is called when the user hits 'OK'
     def apply(self):
         amp_name = self.entry1.get()
@@ -38,34 +99,43 @@ class ConfigDialog(simpledialog.Dialog):
         self.result = (amp_name, ip_address, save_config)
 
 # Main GUI class - quick and dirty layout and callbacks.
-# Eventually this will likely have the updates being handled in a separate thread
-# so the GUI doesn't stutter when it's talking to the amp (and it would be able to
-# poll the amp periodically to detect source changes done via the front panel or
-# remote), but this is OK enough for a first stab.
+# All of the talking to the amp is done by an ampWorker thread so the GUI doesn't
+# stutter while it waits for replies. Callbacks hand the worker a job and render
+# the result when it comes back (see pollWorker), they never touch the socket.
+# The widgets are drawn from the ampConfig's state cache, which the worker keeps
+# up to date with the amp's replies and with the updates the amp sends when the
+# front panel or remote is used, so we don't need to re-query after every click.
+#
+# The amps and their workers belong to a multiAmpController, which has already
+# started connecting to all of them. If there's more than one amp, a menu on the
+# status side switches the window between them - every amp keeps its connection
+# and state cache, so switching is instant.
 
 class RotelRemoteGuiMain:
 
-    # Utility method to try to connect to an amp's IP address
-    def connectIfPossible(self):
-        if self.ampConfig == None:
-            return (False, "No config loaded")
-
-        # Use the ampConfig's connect method to set up a TCP link
-        (retcode, connectMessage) = self.ampConfig.connect()
-        if retcode == False:
-            return
-
     # GUI class constructor - set up our defaults and widget layouts.
-    def __init__(self, ampConfig):
-        self.ampConfig = ampConfig
-
-        self.connectIfPossible()
-        connected = self.ampConfig.isConnected()
+    def __init__(self, controller, ampName=None):
+        self.controller = controller
+        if ampName == None:
+            ampName = controller.getDefaultAmpName()
+
+        # The amp's worker thread owns its connection and tells us when it
+        # drops/comes back, see selectAmp for hooking up to it.
+        self.ampName = ampName
+        self.ampConfig = controller.getAmp(ampName)
+        self.worker = controller.getWorker(ampName)
+        self.renderQueued = False
 
         # couple of defaults
-        connectText = 'Not Connected'
         powerOn = False
         self.bypassValue = True
+        self.volumeFixed = False
+        self.renderedSource = None
+        # when the user last moved each slider, see sliderRecentlyMoved
+        self.sliderMoved = dict()
+        # what the widgets are showing, see showOption and showSliderValue
+        self.shownOptions = dict()
+        self.shownValues = dict()
 
         # create a main window with a frame, the window can be expanded
         self.mainwin = tk.Tk()
@@ -108,12 +178,6 @@ class RotelRemoteGuiMain:
         self.sourceFrame.grid(row=1, column=1, rowspan=(self.rowCount - 2), sticky='news', columnspan=1)
         self.sourceScroll.config(command=self.sourceList.yview)
 
-        # populate the source list using the ampConfig's methods
-        sourcenames = []
-        sources = self.ampConfig.getSourceIds()
-        for s in sources:
-            self.sourceList.insert(tk.END, ampConfig.getSourceLabel(s))
-
         # Volume slider
         self.volumeValue = tk.IntVar()
 
@@ -129,7 +193,7 @@ class RotelRemoteGuiMain:
 
         self.volumeSlider = tk.Scale(self.mainframe, label='Volume', variable=self.volumeValue, orient=tk.HORIZONTAL, from_=minVol, to=maxVol, command=self.volumeUpdate)
         self.volumeSlider.grid(row=(self.rowCount - 1), column=1, sticky='news', columnspan=1)
-        self.volumeSlider.set(20)
+        self.showSliderValue('volume', self.volumeValue, 20)
 
         self.toneFrame = tk.Frame(self.mainframe)
 
@@ -137,11 +201,11 @@ class RotelRemoteGuiMain:
         tone_min, tone_max = self.ampConfig.getToneMinMax()
         self.bassSlider = tk.Scale(self.toneFrame, label='Bass', variable=self.bassValue, orient=tk.HORIZONTAL, from_=tone_min, to=tone_max, command=self.bassUpdate)
         self.bassSlider.pack(side=tk.TOP, expand=1, fill=tk.Y)
-        self.bassSlider.set(0)
+        self.showSliderValue('bass', self.bassValue, 0)
 
         self.trebleSlider = tk.Scale(self.toneFrame, label='Treble', variable=self.trebleValue, orient=tk.HORIZONTAL, from_=tone_min, to=tone_max, command=self.trebleUpdate)
         self.trebleSlider.pack(side=tk.TOP, expand=1, fill=tk.Y)
-        self.trebleSlider.set(0)
+        self.showSliderValue('treble', self.trebleValue, 0)
 
         # Tone bypass button will disable the bass and treble sliders if the bypass is on.
         self.bypassButton = tk.Button(self.toneFrame, text='Bypass is on', borderwidth=2, relief='groove', command=self.bypassToggle)
@@ -150,151 +214,338 @@ class RotelRemoteGuiMain:
         balance_min, balance_max = self.ampConfig.getBalanceMinMax()
         self.balanceSlider = tk.Scale(self.toneFrame, label='Balance (L-R)', variable=self.balanceValue, orient=tk.HORIZONTAL, from_=balance_min, to=balance_max, command=self.balanceUpdate)
         self.balanceSlider.pack(side=tk.TOP, expand=1, fill=tk.Y)
-        self.balanceSlider.set(0)
+        self.showSliderValue('balance', self.balanceValue, 0)
 
         self.toneFrame.grid(row=1, column=0, sticky='news', columnspan=1)
 
-        # Status frame will have one big free-form status label
+        # Preset frame under the tone controls - pick a preset and apply it, or
+        # save the current settings as a new one. The list is filled in by selectAmp.
+        self.presetFrame = tk.Frame(self.mainframe)
+        self.presetVar = tk.StringVar()
+        self.presetMenu = tk.OptionMenu(self.presetFrame, self.presetVar, '')
+        self.presetMenu.pack(side=tk.TOP, fill=tk.X)
+        self.presetApplyButton = tk.Button(self.presetFrame, text='Apply Preset', borderwidth=2, relief='groove', command=self.applyPreset)
+        self.presetApplyButton.pack(side=tk.TOP, fill=tk.X)
+        self.presetSaveButton = tk.Button(self.presetFrame, text='Save Preset...', borderwidth=2, relief='groove', command=self.savePreset)
+        self.presetSaveButton.pack(side=tk.TOP, fill=tk.X)
+        self.presetFrame.grid(row=2, column=0, rowspan=(self.rowCount - 3), sticky='news', columnspan=1)
+
+        # Status frame will have one big free-form status label, with an amp
+        # selector above it if we know about more than one amp
         self.statusFrame = tk.Frame(self.mainframe)
+        ampNames = self.controller.getAmpNames()
+        if len(ampNames) > 1:
+            self.ampVar = tk.StringVar(value=ampName)
+            self.ampMenu = tk.OptionMenu(self.statusFrame, self.ampVar, *ampNames, command=self.selectAmp)
+            self.ampMenu.pack(side=tk.TOP, fill=tk.X)
+        self.connLabel = tk.Label(self.statusFrame, borderwidth=2, relief='groove')
+        self.connLabel.pack(side=tk.TOP, expand=1, fill=tk.BOTH)
+        self.statusFrame.grid(row=1, column=2, rowspan=(self.rowCount -2), sticky='news', columnspan=1)
 
-        # Enable the power button if we're connected
-        if connected:
-            self.powerButton['state'] = tk.NORMAL
-            connLabelText = 'Connected'
+        # Hook up to the amp and fill in the widgets (which stay disabled until
+        # the worker has connected)
+        self.selectAmp(ampName)
+
+        # Start polling the workers for finished jobs, then start the GUI
+        self.pollWorker()
+        self.mainwin.mainloop()
+
+    # Check for finished worker jobs and run their callbacks on the Tk thread
+    def pollWorker(self):
+        for name in self.controller.getAmpNames():
+            self.controller.getWorker(name).dispatchResults()
+        self.mainwin.after(50, self.pollWorker)
+
+    # Switch the window to another amp (also used for the first one)
+    def selectAmp(self, name):
+        # stop listening to the previous amp
+        self.ampConfig.state.removeCallback(self.stateChanged)
+        self.worker.setConnectionCallback(None)
+        self.worker.setConfigCallback(None)
+
+        self.ampName = name
+        self.ampConfig = self.controller.getAmp(name)
+        self.worker = self.controller.getWorker(name)
+        self.ampConfig.state.addCallback(self.stateChanged)
+        self.worker.setConnectionCallback(self.connectionChanged)
+        self.worker.setConfigCallback(self.configChanged)
+        self.renderedSource = None
+        self.volumeFixed = False
+        self.sliderMoved = dict()
+        self.loadConfigWidgets()
+
+        if self.ampConfig.isConnected():
+            self.updateStatusLabel('Connected')
+            # the worker may have connected before we were listening, make
+            # sure the state cache has been filled in
+            if self.ampConfig.state.get('power') == None:
+                self.adjustControls(doPower=True)
         else:
-            connLabelText = 'Not Connected'
+            self.updateStatusLabel('Not Connected')
+        self.renderControls()
+
+    # Set up the widgets that come from the amp's config - the source list,
+    # slider ranges and presets
+    def loadConfigWidgets(self):
+        self.loadSources()
+        self.loadSliderRanges()
+        self.loadPresets()
+        # the other options get shown again too
+        self.shownOptions = dict()
+
+    # Populate the source list using the ampConfig's methods
+    def loadSources(self):
+        self.sourceList['state'] = tk.NORMAL
+        self.shownOptions.pop((str(self.sourceList), 'state'), None)
+        self.sourceList.delete(0, tk.END)
+        for s in self.ampConfig.getSourceIds():
+            self.sourceList.insert(tk.END, self.ampConfig.getSourceLabel(s))
+        # the source list has been refilled, so the selection needs redoing
+        self.renderedSource = None
+
+    # Slider ranges can differ from amp to amp
+    def loadSliderRanges(self):
+        minVol, maxVol = self.ampConfig.getVolumeMinMax()
+        self.volumeSlider.config(from_=minVol, to=maxVol)
+        tone_min, tone_max = self.ampConfig.getToneMinMax()
+        self.bassSlider.config(from_=tone_min, to=tone_max)
+        self.trebleSlider.config(from_=tone_min, to=tone_max)
+        balance_min, balance_max = self.ampConfig.getBalanceMinMax()
+        self.balanceSlider.config(from_=balance_min, to=balance_max)
 
+    # Put the connection state and some config info on the status label
+    def updateStatusLabel(self, connLabelText):
         addr = self.ampConfig.getAddress()
         name = self.ampConfig.getName()
 
-        # Put some config info on the status label
         connLabelText += '\nConfig: ' + name
 
         if addr != None and len(addr) > 0:
             connLabelText += '\nIP Address: ' + addr
         else:
             connLabelText += '\nNo address - please configure'
-
-        self.connLabel = tk.Label(self.statusFrame, text=connLabelText, borderwidth=2, relief='groove')
-        self.connLabel.pack(side=tk.TOP, expand=1, fill=tk.BOTH)
-        self.statusFrame.grid(row=1, column=2, rowspan=(self.rowCount -2), sticky='news', columnspan=1)
-
-        # The adjustControls method queries stuff from the amp and sets the widgets accordingly
-        self.adjustControls(doPower=True)
-
-        # Start the GUI
-        self.mainwin.mainloop()
+        self.connLabel.config(text=connLabelText)
+
+    # Fill in the preset menu from the current amp's config
+    def loadPresets(self):
+        menu = self.presetMenu['menu']
+        menu.delete(0, tk.END)
+        names = self.ampConfig.getPresetNames()
+        for name in names:
+            menu.add_command(label=name, command=lambda value=name: self.presetVar.set(value))
+        if self.presetVar.get() not in names:
+            self.presetVar.set(names[0] if len(names) > 0 else '')
+
+    # Worker config callback - the config file changed, runs on the worker
+    # thread so pass it on
+    def configChanged(self, ret, changed):
+        self.worker.post(self.showConfigChange, (ret, changed))
+
+    # Redraw what the new config affects. A config that couldn't be loaded is
+    # just mentioned on the status label, we carry on with the old one.
+    def showConfigChange(self, result):
+        (ret, changed) = result
+        status = 'Connected' if self.ampConfig.isConnected() else 'Not Connected'
+        if not ret:
+            self.updateStatusLabel(status + '\n' + changed)
+            return
+        # only rebuild the widgets the changed keys are shown in. 'sources'
+        # also changes when a source's capabilities are learned, which just
+        # needs a redraw, the list only when the sources themselves change.
+        if 'presets' in changed:
+            self.loadPresets()
+        rangeKeys = [key for ranges in settingRanges.values() for key in ranges[:2]]
+        redraw = False
+        if 'sources' in changed:
+            labels = [self.ampConfig.getSourceLabel(s) for s in self.ampConfig.getSourceIds()]
+            if list(self.sourceList.get(0, tk.END)) != labels:
+                self.loadSources()
+            redraw = True
+        if any(key in changed for key in rangeKeys):
+            self.loadSliderRanges()
+            redraw = True
+        self.updateStatusLabel(status)
+        if redraw:
+            self.renderControls()
+
+    # Worker connection callback - runs on the worker thread, so pass it on
+    def connectionChanged(self, connected, message):
+        self.worker.post(self.showConnection, (connected, message))
+
+    # Show the connection state, and refresh everything once we're connected
+    def showConnection(self, result):
+        (connected, message) = result
+        if connected:
+            self.updateStatusLabel('Connected')
+            # The adjustControls method queries stuff from the amp and sets the widgets accordingly
+            self.adjustControls(doPower=True)
+        else:
+            self.updateStatusLabel('Not Connected (' + message + ')')
+            self.renderControls()
 
     # adjustControls does all fo the heavy lifting when it comes to updating the interface's
     # controls to match the current state of the amp. If connected, it checks the power state
-    # and if the amp is on it queries a bunch of the config values.
+    # and if the amp is on it queries a bunch of the config values. The querying is done by
+    # the worker (queryControls), the answers land in the state cache and the widgets are
+    # redrawn from there (renderControls).
 
     def adjustControls(self, doPower=False):
+        self.worker.submit(self.queryControls, doPower, callback=self.renderControls, priority=priorityPolling)
 
-        # There isn't really a good way that I found to figure out if a source's
-        # volume is set to a fixed value. This attempts to handle that by setting
-        # the 'fixed' value to false, then handling a special condition later when
-        # we attempt to set the volume (see notes around the setVolume function)
-        self.volumeFixed = False
-        self.volumeSlider.config(label='Volume')
+    # Runs on the worker thread - refreshes the state cache from the amp
+    def queryControls(self, doPower=False):
+        # See if we are connected
+        if not self.ampConfig.isConnected():
+            return
+
+        # We're connected, so we need to find our power state before
+        # querying the other settings. The 'doPower' argument will be false
+        # if we are calling this function from a callback that would need
+        # power to operate, so it's a shortcut that makes an assumption
+        if doPower == True:
+            # query the power - if the amp is in standby, this is the only
+            # query it can answer
+            self.ampConfig.queryPower()
+            if self.ampConfig.state.get('power') != 'on':
+                return
+
+        # get source information - this returns a bunch of config info
+        # about the amp all in one go.
+        self.ampConfig.querySourceInfo()
+
+    # State cache callback, this runs on the worker thread so we just ask the
+    # Tk thread for a redraw (only one, however many values changed)
+    def stateChanged(self, key, oldValue, newValue, origin):
+        if not self.renderQueued:
+            self.renderQueued = True
+            self.worker.post(self.renderFromCache, time.perf_counter())
+
+    # 'changed' is when the state change came in, if the amp is being traced
+    # we record how long it took to get it on the screen
+    def renderFromCache(self, changed=None):
+        self.renderQueued = False
+        self.renderControls()
+        tracer = self.ampConfig.tracer
+        if tracer != None and changed != None:
+            tracer.observe('gui render delay', time.perf_counter() - changed)
+
+    # True if the user moved a slider in the last second - while they're
+    # dragging, replies for older values would yank the slider back
+    def sliderRecentlyMoved(self, key):
+        return time.monotonic() - self.sliderMoved.get(key, 0) < 1.0
+
+    # Runs on the Tk thread - set the widgets to match the state cache. Only
+    # the widgets that actually differ from the state are touched (see
+    # showOption and showSliderValue), so a redraw after one value changed
+    # costs one widget update rather than a dozen.
+    def renderControls(self, result=None):
+        started = time.perf_counter()
+        state = self.ampConfig.state.snapshot()
+        powerOn = state.get('power') == 'on'
 
         # See if we are connected
         connected = self.ampConfig.isConnected()
         if not connected:
             # disable a bunch of controls
-            self.powerButton['state'] = tk.DISABLED
-            self.muteButton['state'] = tk.DISABLED
-            self.sourceList['state'] = tk.DISABLED
-            self.volumeSlider['state'] = tk.DISABLED
-            self.bassSlider['state'] = tk.DISABLED
-            self.trebleSlider['state'] = tk.DISABLED
-            self.balanceSlider['state'] = tk.DISABLED
-            self.bypassButton['state'] = tk.DISABLED
+            self.showControlsEnabled(False, power=False, presets=False)
+        elif powerOn:
+            # great, the amp's power is on, let's activate some controls.
+            # The amp doesn't tell us if a source's volume is set to a fixed
+            # value, the ampConfig finds out the first time it tries to set
+            # the volume on it (see volumeDone) and remembers it in the config.
+            # The bass and treble sliders only work with the tone bypass off.
+            self.volumeFixed = self.ampConfig.isFixedVolume(state.get('source'))
+            if 'bypass' in state:
+                self.bypassValue = state['bypass'] == 'on'
+            self.showControlsEnabled(True, power=True, presets=True)
+            self.showOption(self.volumeSlider, 'state', tk.DISABLED if self.volumeFixed else tk.NORMAL)
+            self.showOption(self.volumeSlider, 'label', 'Volume (fixed)' if self.volumeFixed else 'Volume')
+            self.showOption(self.bassSlider, 'state', tk.DISABLED if self.bypassValue else tk.NORMAL)
+            self.showOption(self.trebleSlider, 'state', tk.DISABLED if self.bypassValue else tk.NORMAL)
+            self.showOption(self.powerButton, 'text', 'Power is on')
+
+            if 'source' in state:
+                sourceMsg = state['source']
+                self.renderedSource = sourceMsg
+
+                # our source list is in the same order as the ampConfig's source
+                # list so we can re-use the index to highlight our list value.
+                # The longer-term goal would be to add the ability to show/hide
+                # sources, so this may not always be the case, but for now it works.
+                sourceIndex = self.ampConfig.getSourceIndex(sourceMsg)
+                if sourceIndex != None and self.sourceList.curselection() != (sourceIndex,):
+                    self.sourceList.selection_clear(0, tk.END)
+                    self.sourceList.selection_set(sourceIndex)
+
+            # get volume
+            if 'volume' in state:
+                self.showSliderValue('volume', self.volumeValue, state['volume'])
+
+            # mute
+            if 'mute' in state:
+                self.showOption(self.muteButton, 'text', 'Mute is ' + state['mute'])
+
+            # tone bypass state
+            if 'bypass' in state:
+                self.showOption(self.bypassButton, 'text', 'Bypass is ' + state['bypass'])
+
+            # find and set the bass, treble and balance values
+            if 'bass' in state:
+                self.showSliderValue('bass', self.bassValue, state['bass'])
+            if 'treble' in state:
+                self.showSliderValue('treble', self.trebleValue, state['treble'])
+            if 'balance' in state:
+                self.showSliderValue('balance', self.balanceValue, state['balance'])
+
         else:
-            # We're connected, so we need to find our power state before
-            # adjusting the other widgets. The 'doPower' argument will be false
-            # if we are calling this function from a callback that would need
-            # power to operate, so it's a shortcut that makes an assumption
-
-            if doPower == False:
-                # assume the power is on
-                powerOn = True
-            else:
-                # query the power - if the amp is in standby, this is the only
-                # query it can answer
-                powerOn = False
-                (ret, powerResp) = self.ampConfig.queryPower()
-                if ret == True and 'power' in powerResp:
-                    if powerResp['power'] == 'on':
-                        powerOn = True
-
-            if powerOn:
-                # great, the amp's power is on, let's activate some controls
-                self.powerButton.config(text='Power is on')
-                self.muteButton['state'] = tk.NORMAL
-                self.sourceList['state'] = tk.NORMAL
-                self.volumeSlider['state'] = tk.NORMAL
-                self.bassSlider['state'] = tk.NORMAL
-                self.trebleSlider['state'] = tk.NORMAL
-                self.balanceSlider['state'] = tk.NORMAL
-                self.bypassButton['state'] = tk.NORMAL
-
-                # get source information - this returns a bunch of config info
-                # about the amp all in one go.
-                (ret, resp) = self.ampConfig.querySourceInfo()
-                if not ret:
-                    # if the query fails, we can't do much.
-                    # TODO: do a popup here with the error message from ampConfig
-                    return
-                # the 'resp' return value is a dict with a bunch of keys that we
-                # map to widgets
-                if 'source' in resp:
-                    sourceMsg = resp['source']
-                    # our source list is in the same order as the ampConfig's source
-                    # list so we can re-use the index to highlight our list value.
-                    # The longer-term goal would be to add the ability to show/hide
-                    # sources, so this may not always be the case, but for now it works.
-                    self.sourceList.selection_set(self.ampConfig.getSourceIndex(sourceMsg))
-
-                # get volume
-                if 'volume' in resp:
-                    volMsg = resp['volume']
-                    self.volumeValue.set(int(volMsg))
-
-                # mute
-                if 'mute' in resp:
-                    self.muteButton.config(text='Mute is ' + resp['mute'])
-
-                # tone bypass state
-                if 'bypass' in resp:
-                    self.bypassButton.config(text='Bypass is ' + resp['bypass'])
-                    if resp['bypass'] == 'on':
-                        self.bypassValue = True
-                        # disable the bass and trble sliders
-                        self.trebleSlider['state'] = tk.DISABLED
-                        self.bassSlider['state'] = tk.DISABLED
-                    else:
-                        self.bypassValue = False
-                        # enable the bass and treble sliders
-                        self.trebleSlider['state'] = tk.NORMAL
-                        self.bassSlider['state'] = tk.NORMAL
-
-                # find and set the bass and treble values
-                if 'bass' in resp:
-                    self.bassValue.set(resp['bass'])
-                if 'treble' in resp:
-                    self.trebleValue.set(resp['treble'])
-
-            else:
-                # power is not on, but we're connected so we must be in standby
-                self.powerButton.config(text='<Standby>')
-                self.muteButton['state'] = tk.DISABLED
-                self.sourceList['state'] = tk.DISABLED
-                self.volumeSlider['state'] = tk.DISABLED
-                self.bassSlider['state'] = tk.DISABLED
-                self.trebleSlider['state'] = tk.DISABLED
-                self.balanceSlider['state'] = tk.DISABLED
-                self.bypassButton['state'] = tk.DISABLED
+            # power is not on, but we're connected so we must be in standby
+            # (applying a preset will power the amp on)
+            self.showControlsEnabled(False, power=True, presets=True)
+            self.showOption(self.powerButton, 'text', '<Standby>')
+
+        if self.ampConfig.tracer != None:
+            self.ampConfig.tracer.observe('gui render', time.perf_counter() - started)
+
+    # Enable or disable the amp controls (the power and preset buttons have
+    # their own say). The volume and tone sliders are left to the caller
+    # when they're enabled.
+    def showControlsEnabled(self, enabled, power, presets):
+        state = tk.NORMAL if enabled else tk.DISABLED
+        self.showOption(self.powerButton, 'state', tk.NORMAL if power else tk.DISABLED)
+        self.showOption(self.presetApplyButton, 'state', tk.NORMAL if presets else tk.DISABLED)
+        widgets = [self.muteButton, self.sourceList, self.balanceSlider, self.bypassButton]
+        if not enabled:
+            widgets += [self.volumeSlider, self.bassSlider, self.trebleSlider]
+        for widget in widgets:
+            self.showOption(widget, 'state', state)
+
+    # Set a widget option, unless it's already showing that value
+    def showOption(self, widget, option, value):
+        key = (str(widget), option)
+        if self.shownOptions.get(key) != value:
+            self.shownOptions[key] = value
+            widget[option] = value
+
+    # Move a slider to a value from the amp. The value is remembered so the
+    # slider's callback can tell this from the user moving it (Tk calls it
+    # either way) and doesn't send it straight back to the amp. A slider the
+    # user is dragging is left alone - replies for older values would yank it
+    # back.
+    def showSliderValue(self, key, variable, value):
+        if self.sliderRecentlyMoved(key) or self.shownValues.get(key) == value:
+            return
+        self.shownValues[key] = value
+        variable.set(value)
+
+    # Slider callback helper - true if 'newvalue' is just the slider showing
+    # what showSliderValue gave it, otherwise it's a move by the user
+    def sliderEcho(self, key, newvalue):
+        value = int(float(newvalue))
+        if self.shownValues.get(key) == value:
+            return True
+        self.shownValues[key] = value
+        self.sliderMoved[key] = time.monotonic()
+        return False
 
     ## Callback functions
 
@@ -308,37 +559,60 @@ class RotelRemoteGuiMain:
         sources = self.ampConfig.getSourceIds()
         sourceId = sources[index]
 
-        # Ask the amp to set the new source
-        (ret, newSource) = self.ampConfig.setSource(sourceId)
-
-        # adjust widgets based on new source value
-        self.adjustControls()
+        # Ask the amp to set the new source, the widgets get updated from
+        # the amp's reply via the state cache
+        self.worker.submit(self.ampConfig.setSource, sourceId)
 
     # Called when the power button is clicked
     def powerToggle(self):
-        # Send a power toggle command to the amp
-        self.ampConfig.powerToggle()
-
-        # powering on might take a few seconds, sleep for 5 sec.
-        time.sleep(5)
-        # adjust the controls, along with a power query
+        # Send a power toggle command to the amp, powering on might take a few
+        # seconds so the worker waits until the amp reports its new power state
+        # and then we adjust the controls (along with a power query).
+        self.showOption(self.powerButton, 'state', tk.DISABLED)
+        self.showOption(self.powerButton, 'text', 'Powering on...' if self.ampConfig.state.get('power') != 'on' else 'Powering off...')
+        self.worker.submit(self.ampConfig.powerToggleAndWait, callback=self.powerDone)
+
+    # Worker callback once the power change is done (or has timed out)
+    def powerDone(self, result):
+        (ret, message) = result
+        if not ret:
+            self.updateStatusLabel('Connected' if self.ampConfig.isConnected() else 'Not Connected')
+            messagebox.showerror('Power', message, parent=self.mainwin)
         self.adjustControls(doPower=True)
 
+    # Apply the selected preset, only the settings that differ get sent
+    def applyPreset(self):
+        name = self.presetVar.get()
+        if name == '':
+            return
+        self.worker.submit(self.ampConfig.applyPreset, name, callback=self.presetDone, priority=priorityScene)
+
+    # Worker callback once a preset has been applied
+    def presetDone(self, result):
+        (ret, message) = result
+        if not ret:
+            messagebox.showerror('Preset', message, parent=self.mainwin)
+
+    # Save the current settings as a preset in the amp's config file
+    def savePreset(self):
+        name = simpledialog.askstring('Save Preset', 'Preset name:', parent=self.mainwin)
+        if name:
+            (ret, message) = self.ampConfig.storePreset(name)
+            if not ret:
+                messagebox.showerror('Save Preset', message, parent=self.mainwin)
+            self.loadPresets()
+            self.presetVar.set(name)
+
     # Toggle the mute status
     def muteToggle(self):
-        self.ampConfig.muteToggle()
-        self.adjustControls()
+        self.worker.submit(self.ampConfig.muteToggle)
 
     # Toggle the tone bypass status
     def bypassToggle(self):
         # we cached the previous bypass value when we connected or
         # powered on, so we ask for the opposite state since the amp
         # does not have a 'bypass_toggle' command.
-        if self.bypassValue == True:
-            self.ampConfig.setBypass(False)
-        else:
-            self.ampConfig.setBypass(True)
-        self.adjustControls()
+        self.worker.submit(self.ampConfig.setBypass, not self.bypassValue)
 
     # Pop up the config dialog.
     def show_dialog(self):
@@ -346,50 +620,64 @@ class RotelRemoteGuiMain:
         # conifg popup before it is created.
         ConfigDialog.ampname = self.ampConfig.getName()
         ConfigDialog.ampaddress = self.ampConfig.getAddress()
+        ConfigDialog.ampconfig = self.ampConfig
         dialog = ConfigDialog(self.mainwin, title="Configure Remote")
 
         if dialog.result:
             # we got an 'OK' - process the values
+            oldAddress = self.ampConfig.getAddress()
             self.ampConfig.setName(dialog.result[0])
             self.ampConfig.setAddress(dialog.result[1])
 
-            # This will save the configuration but will not attempt to
-            # connect - the user will need to restart the GUI to connect.
-            # TODO: connect automatically if address is new/changed
+            # Reconnect if the address changed, the worker picks up the new
+            # address from the config and reports back when it's connected.
+            if dialog.result[1] != oldAddress:
+                self.worker.restartConnection()
+
             if dialog.result[2] == 1:
-                self.ampConfig.saveConfig()
+                (ret, message) = self.ampConfig.saveConfig()
+                if not ret:
+                    messagebox.showerror('Settings', message, parent=self.mainwin)
 
     # Callback for adjusting the volume level
     def volumeUpdate(self, newvalue):
+        # the slider following the amp (e.g. during a fade) isn't a move
+        if self.sliderEcho('volume', newvalue):
+            return
+        # moving the slider takes over from a fade in progress
+        self.worker.cancelRamp()
         if self.volumeFixed == False:
             # if we don't think the volume level for the current source is fixed, update the volume
-            ret, replies = self.ampConfig.setVolume(newvalue)
-
-            # Special case that was mentioned previously - if the volume is
-            # fixed, the amp will ignore this command and will not send a
-            # response - so if we successfully sent the command (ret is true)
-            # but we did not get anything in the replies, we assume the volume is
-            # fixed and we don't try updating the volume again until the source is
-            # changed.
-            if ret == True and len(replies) == 0:
-                self.volumeFixed = True
-                # update the volume slider label
-                self.volumeSlider.config(label='Volume (fixed)')
+            self.worker.submitLatest('volume_set', self.ampConfig.setVolume, newvalue, callback=self.volumeDone)
+
+    # Worker callback once a volume command has been answered (or not)
+    def volumeDone(self, result):
+        # Special case - if the volume is fixed, the amp will ignore this
+        # command and will not send a response. setVolume notices and marks
+        # the source as fixed, so redraw to lock the slider.
+        if self.ampConfig.isFixedVolume(self.renderedSource) != self.volumeFixed:
+            self.renderControls()
 
     # Callback for the bass slider
     def bassUpdate(self, newvalue):
+        if self.sliderEcho('bass', newvalue):
+            return
         if self.bypassValue == False:
-            ret, replies = self.ampConfig.setBass(newvalue)
+            self.worker.submitLatest('bass_set', self.ampConfig.setBass, newvalue)
 
 
     # Callback for the treble slider
     def trebleUpdate(self, newvalue):
+        if self.sliderEcho('treble', newvalue):
+            return
         if self.bypassValue == False:
-            ret, replies = self.ampConfig.setTreble(newvalue)
+            self.worker.submitLatest('treble_set', self.ampConfig.setTreble, newvalue)
 
     # Balance slider callback - always active
     def balanceUpdate(self, newvalue):
-        ret, replies = self.ampConfig.setBalance(newvalue)
+        if self.sliderEcho('balance', newvalue):
+            return
+        self.worker.submitLatest('balance_set', self.ampConfig.setBalance, newvalue)
 
 
 